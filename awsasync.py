@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+""" AWS Async Class
+
+This module contains the AsyncAws() class, an asyncio front-end for the
+Aws() class:
+
+- Every create, list and delete method of Aws() can be awaited. The blocking
+  boto3 call runs on a thread pool sized to the concurrency limit, so one
+  event loop can drive many operations at once
+- The start, stop, terminate and wait methods poll with asyncio.sleep() in
+  between describe calls, so cancelling the task stops the wait right away
+- Paginated listings (S3 objects, EC2 instances) are async iterators
+
+This is not non-blocking I/O. boto3 has no async transport, so each call in
+flight still holds a thread of the pool for its whole round trip, and at
+most "limit" calls run at once. Cancelling a task that awaits a call stops
+the wait, but the boto3 call already sent runs to completion on its thread.
+
+Example:
+
+    async with AsyncAws(limit=64) as aws:
+        subs = await asyncio.gather(
+            aws.create_subnet("10.94.11.0/24", "us-west-2a"),
+            aws.create_subnet("10.94.111.0/24", "us-west-2b"))
+        async for inst in aws.query_inst(states="running"):
+            print(inst["InstanceId"])
+
+"""
+
+# Import modules
+
+import asyncio
+import functools
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from awsclass import Aws
+
+# Aws() methods that are awaited as they are, on the thread pool
+
+ASYNCMETHODS = {
+    "create_subnet", "delete_subnet", "list_subnets_all", "list_subnets_az",
+    "create_inst", "create_insts", "start_inst", "stop_inst", "list_inst",
+    "ren_inst", "modify_inst", "create_alb", "list_alb", "delete_alb",
+    "set_alb", "create_target_group", "list_target_groups", "set_targets",
+    "delete_target_group", "create_keypair", "list_keypair",
+    "delete_keypair", "create_bucket", "delete_bucket", "empty_bucket",
+    "list_buckets", "list_files",
+    "upload_file", "download_file", "sync", "resolve", "resolve_all",
+    "sweep", "list_regions", "list_azs",
+}
+
+# Number of items an async iterator takes from a listing per trip to the
+# thread pool
+
+BATCH = 500
+
+
+class AsyncAws():
+    def __init__(self, aws=None, limit=32):
+        self.aws = aws or Aws()
+        self.limit = limit
+        self.sem = asyncio.Semaphore(limit)
+        self.pool = ThreadPoolExecutor(max_workers=limit)
+
+    async def __aenter__(self):
+        return(self)
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+# Shut down the thread pool. Calls still running finish in the background.
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+# Run a blocking call on the thread pool, at most "limit" at a time.
+# Returns its result.
+
+    async def run(self, func, *args, **kwargs):
+        async with self.sem:
+            loop = asyncio.get_running_loop()
+            return(await loop.run_in_executor(
+                self.pool, functools.partial(func, *args, **kwargs)))
+
+# Awaitable versions of the Aws() methods listed in ASYNCMETHODS.
+
+    def __getattr__(self, name):
+        if name not in ASYNCMETHODS:
+            raise AttributeError(name)
+        method = getattr(self.aws, name)
+
+        async def call(*args, **kwargs):
+            return(await self.run(method, *args, **kwargs))
+        call.__name__ = name
+        return(call)
+
+# Bulk start, stop and terminate EC2 instances methods. The calls are sent
+# on the thread pool and the wait is done on the event loop. Returns the list
+# of instance IDs that AWS accepted.
+
+    async def start_insts(self, instids, wait=False):
+        done = await self.run(self.aws.start_insts, instids, wait=False)
+        if wait:
+            await self.wait_insts(done, "running")
+        return(done)
+
+    async def stop_insts(self, instids, wait=False):
+        done = await self.run(self.aws.stop_insts, instids, wait=False)
+        if wait:
+            await self.wait_insts(done, "stopped")
+        return(done)
+
+    async def term_insts(self, instids, wait=True):
+        done = await self.run(self.aws.term_insts, instids, wait=False)
+        if wait:
+            await self.wait_insts(done, "terminated")
+        return(done)
+
+    async def term_inst(self, instid):
+        done = await self.term_insts([instid])
+        return(done[0] if done else None)
+
+# Wait for instances method. Same as Aws.wait_insts(), but sleeps on the event
+# loop between checks, so it can be cancelled. Returns the list of instance
+# IDs that reached the state.
+
+    async def wait_insts(self, instids, state, delay=2, timeout=900,
+                         maxdelay=15):
+        check, waiting, reached = self.aws.inst_check(instids, state)
+        return(await self.wait_for("instances", state, check, waiting,
+                                   reached, delay, timeout, maxdelay))
+
+# Wait for load balancers and target groups methods. Same as
+# Aws.wait_albs() and Aws.wait_tgs(), but sleeping on the event loop.
+
+    async def wait_albs(self, albs, state="active", delay=2, timeout=900,
+                        maxdelay=15):
+        check, waiting, reached = self.aws.alb_check(albs, state)
+        return(await self.wait_for("load balancers", state, check, waiting,
+                                   reached, delay, timeout, maxdelay))
+
+    async def wait_tgs(self, tgs, state="free", delay=2, timeout=900,
+                       maxdelay=15):
+        check, waiting, reached = self.aws.tg_check(tgs, state)
+        return(await self.wait_for("target groups", state, check, waiting,
+                                   reached, delay, timeout, maxdelay))
+
+# Run a wait and print how it went, like Aws.wait_for(). Returns the list of
+# items that reached the state.
+
+    async def wait_for(self, what, state, check, waiting, reached, delay,
+                       timeout, maxdelay):
+        print("\nWaiting on {} {} to reach {}".format(
+            len(waiting), what, state))
+        if not await self.poll(check, delay, timeout, maxdelay):
+            print("Timed out with {} {} not {}: {}".format(
+                len(waiting), what, state, ", ".join(sorted(waiting))))
+        print("{} {} are {}".format(len(reached), what, state))
+        return(reached)
+
+# Poll method. Runs the blocking check() on the thread pool with the same
+# growing delays as Aws.poll(), sleeping on the event loop in between.
+# Returns the last result of check().
+
+    async def poll(self, check, delay=2, timeout=900, maxdelay=15,
+                   backoff=1.5):
+        end = time.monotonic() + timeout
+        while not await self.run(check):
+            left = end - time.monotonic()
+            if left <= 0:
+                return(False)
+            await asyncio.sleep(min(delay, left))
+            delay = min(maxdelay, delay * backoff)
+        return(True)
+
+# Async iterator over a blocking generator. Items are taken BATCH at a time
+# on the thread pool. The generator is closed when the loop ends, breaks or
+# is cancelled, on the thread pool, or right here if the pool has been shut
+# down by close().
+
+    async def iterate(self, gen):
+        try:
+            while True:
+                items = await self.run(
+                    lambda: list(itertools.islice(gen, BATCH)))
+                for item in items:
+                    yield(item)
+                if len(items) < BATCH:
+                    return
+        finally:
+            try:
+                self.pool.submit(close_gen, gen)
+            except RuntimeError:
+                close_gen(gen)
+
+# Async iterators for the paginated listings. They take the same arguments
+# as Aws.list_objects() and Aws.query_inst().
+
+    def list_objects(self, *args, **kwargs):
+        return(self.iterate(self.aws.list_objects(*args, **kwargs)))
+
+    def query_inst(self, *args, **kwargs):
+        return(self.iterate(self.aws.query_inst(*args, **kwargs)))
+
+
+# Close a generator, unless it is still running in another thread after its
+# task was cancelled. It is then left to finish its current item and be
+# garbage collected.
+
+def close_gen(gen):
+    try:
+        gen.close()
+    except ValueError:
+        pass
@@ -0,0 +1,807 @@
+#!/usr/bin/env python3
+
+""" AWS Benchmarks
+
+This program times parts of the AWS tools without talking to AWS:
+
+- startup: cold-start time of a single 'lbuck'-style command, up to the point
+  where the first API call would be sent. "before" builds every client and
+  resource up front the way Aws() and awstool.py used to, "after" builds only
+  the S3 client that 'lbuck' needs, the way they do now. Each run is a fresh
+  Python process, so the times include loading Python, boto3 and the
+  botocore service models
+- scale: the listing, creation and teardown paths of Aws(), Stack() and
+  Teardown() against an in-memory stand-in for AWS holding 10k instances,
+  1k subnets and 1M S3 objects. Each benchmark is timed and its peak memory
+  measured with tracemalloc. The results can be saved as a baseline, and a
+  later run fails if a benchmark gets slower or uses more memory than the
+  baseline by more than the tolerance
+
+"""
+
+# Import modules
+
+import argparse
+import contextlib
+import datetime
+import ipaddress
+import itertools
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from botocore import xform_name
+from concurrent.futures import ThreadPoolExecutor
+
+# Settings used by the benchmark processes, so no real credentials file or
+# AWS account is needed
+
+benchcfg = """[default]
+region = us-west-2
+key = benchkey
+secgroup = sg-00000000
+ami = ami-00000000
+ec2type = t2.micro
+vpc = vpc-00000000
+"""
+
+# Baseline file of the scale benchmarks, and the smallest changes in time and
+# peak memory that count as a regression, so tiny results don't fail on noise
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "bench_baseline.json")
+MINSECONDS = 0.05
+MINMB = 1.0
+
+# Code run by each startup process. Both stop right before the API call of
+# 'lbuck'.
+
+startup_code = {
+    "before": """
+from awsclass import Aws
+aws = Aws()
+aws.ec2r, aws.ec2c, aws.s3r, aws.s3c, aws.elbv2c, aws.vpc
+aws.s3c.list_buckets
+""",
+    "after": """
+from awsclass import Aws
+aws = Aws()
+aws.s3c.list_buckets
+""",
+}
+
+# Time one fresh Python process running the given code. Returns the wall
+# time in seconds.
+
+
+def time_process(code, env):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], env=env, check=True,
+                   cwd=os.path.dirname(os.path.abspath(__file__)))
+    return(time.perf_counter() - start)
+
+# Environment for the benchmark processes: a throwaway credentials file and
+# dummy keys, so building clients never looks for real credentials.
+
+
+def bench_env(tmpdir):
+    credfile = os.path.join(tmpdir, "credentials")
+    with open(credfile, "w") as f:
+        f.write(benchcfg)
+    env = dict(os.environ)
+    env.update({"AWSTOOL_CREDENTIALS": credfile,
+                "AWS_ACCESS_KEY_ID": "bench",
+                "AWS_SECRET_ACCESS_KEY": "bench",
+                "AWS_EC2_METADATA_DISABLED": "true"})
+    return(env)
+
+# Startup benchmark. Runs each mode "runs" times, alternating between them,
+# and prints the median and best times. Returns a dict of the medians.
+
+
+def bench_startup(runs):
+    times = {mode: [] for mode in startup_code}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        env = bench_env(tmpdir)
+        time_process("import boto3", env)
+        for _ in range(runs):
+            for mode, code in startup_code.items():
+                times[mode].append(time_process(code, env))
+
+    print("\nCold start of an 'lbuck' command ({} runs):".format(runs))
+    medians = {}
+    for mode, secs in times.items():
+        medians[mode] = statistics.median(secs)
+        print("  {:<7} median {:.3f}s  best {:.3f}s".format(
+            mode, medians[mode], min(secs)))
+    print("  saved   {:.3f}s per start ({:.0%})".format(
+        medians["before"] - medians["after"],
+        1 - medians["after"] / medians["before"]))
+    return(medians)
+
+
+# HTTP response handed back by the stand-in in place of a real one.
+
+class Reply():
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+        self.content = b""
+
+
+# Stand-in for AWS used by the scale benchmarks. It answers the API calls of
+# every client built from the shared session out of in-memory fixtures: a
+# before-parameter-build handler keeps the parameters of each call in its
+# context, and a before-call handler returns the response, so botocore never
+# sends the request. Each operation is a method named after the service and
+# the operation in snake case, such as ec2_describe_instances. Only what the
+# tools use is modelled: instances, subnets, network interfaces and key
+# pairs, load balancers with their listeners and target groups, and one S3
+# bucket of generated objects.
+
+class StandIn():
+    def __init__(self):
+        self.reset()
+
+    def install(self, session):
+        session.events.register("before-parameter-build", self.keep_params)
+        session.events.register("before-call", self.respond)
+
+    def keep_params(self, params, context, **kwargs):
+        context["standin"] = dict(params)
+
+    def respond(self, model, context, **kwargs):
+        name = "{}_{}".format(model.service_model.service_name,
+                              xform_name(model.name))
+        parsed = getattr(self, name)(context.get("standin", {}))
+        if "Error" in parsed:
+            http = Reply(400)
+        else:
+            http = Reply(200)
+        parsed["ResponseMetadata"] = {"HTTPStatusCode": http.status_code,
+                                      "RetryAttempts": 0}
+        return(http, parsed)
+
+# Load a fixture. Instances are spread evenly across the subnets, one in four
+# stopped, and each load balancer spans three subnets with a listener and a
+# target group. Every tenth subnet also holds a detached network interface.
+
+    def reset(self, instances=0, subnets=0, objects=0, albs=0):
+        self.ids = itertools.count(1)
+        self.instances = {}
+        self.insubnet = {}
+        self.subnets = {}
+        self.enis = {}
+        self.keypairs = {}
+        self.albs = {}
+        self.tgs = {}
+        self.targets = {}
+        self.listeners = {}
+        self.tags = {}
+        self.tokens = {}
+        self.objects = objects
+
+        for n in range(subnets):
+            sub = self.ec2_create_subnet({
+                "CidrBlock": "10.{}.{}.0/24".format(n // 256, n % 256),
+                "AvailabilityZone": "us-west-2" + "abc"[n % 3]})["Subnet"]
+            if n % 10 == 0:
+                self.add_eni(sub["SubnetId"], "available")
+        subids = sorted(self.subnets)
+        for n in range(instances):
+            inst = self.ec2_run_instances({
+                "MaxCount": 1, "SubnetId": subids[n % len(subids)],
+                "TagSpecifications": [{"ResourceType": "instance", "Tags": [
+                    {"Key": "Name", "Value": "web{}".format(n)}]}]})
+            if n % 4 == 0:
+                inst["Instances"][0]["State"] = {"Name": "stopped"}
+        for n in range(albs):
+            tg = self.elbv2_create_target_group(
+                {"Name": "tg{}".format(n)})["TargetGroups"][0]
+            alb = self.elbv2_create_load_balancer({
+                "Name": "alb{}".format(n),
+                "Subnets": subids[3 * n:3 * n + 3]})["LoadBalancers"][0]
+            self.elbv2_create_listener({
+                "LoadBalancerArn": alb["LoadBalancerArn"],
+                "DefaultActions": [{"Type": "forward",
+                                    "TargetGroupArn": tg["TargetGroupArn"]}]})
+
+    def newid(self, kind):
+        return("{}-{:08x}".format(kind, next(self.ids)))
+
+    def error(self, code, message):
+        return({"Error": {"Code": code, "Message": message}})
+
+# Return one page of records and the token of the next one. Tokens are the
+# index of the first record of the page.
+
+    def page(self, records, p, token="NextToken", size="MaxResults",
+             nexttoken=None):
+        start = int(p.get(token) or 0)
+        end = start + (p.get(size) or len(records) or 1)
+        more = {nexttoken or token: str(end)} if end < len(records) else {}
+        return(records[start:end], more)
+
+# Apply describe filters to records. Each filter name maps to the value it
+# checks; "tag:<key>" checks a tag.
+
+    def filtered(self, records, filters, fields):
+        for f in filters or []:
+            values = set(f["Values"])
+            if f["Name"].startswith("tag:"):
+                key = f["Name"][4:]
+                records = [r for r in records if {
+                    t["Key"]: t["Value"] for t in r.get("Tags", [])}.get(key)
+                    in values]
+            else:
+                get = fields[f["Name"]]
+                records = [r for r in records if get(r) in values]
+        return(records)
+
+    # EC2 instances
+
+    def ec2_run_instances(self, p):
+        if p.get("ClientToken") in self.tokens:
+            params, made = self.tokens[p["ClientToken"]]
+            if params != repr(sorted(p.items())):
+                return(self.error("IdempotentParameterMismatch",
+                                  "The client token '{}' was already used "
+                                  "with different parameters"
+                                  .format(p["ClientToken"])))
+            return({"Instances": made})
+        name = [t for spec in p.get("TagSpecifications", [])
+                for t in spec["Tags"]]
+        made = []
+        for _ in range(p["MaxCount"]):
+            sub = self.subnets[p["SubnetId"]]
+            inst = {"InstanceId": self.newid("i"),
+                    "State": {"Name": "running"},
+                    "InstanceType": p.get("InstanceType", "t2.micro"),
+                    "KeyName": p.get("KeyName"),
+                    "SubnetId": sub["SubnetId"], "VpcId": sub["VpcId"],
+                    "Placement": {"AvailabilityZone": sub["AvailabilityZone"]},
+                    "Tags": list(name)}
+            self.instances[inst["InstanceId"]] = inst
+            self.insubnet.setdefault(sub["SubnetId"], []).append(inst)
+            made.append(inst)
+        if p.get("ClientToken"):
+            self.tokens[p["ClientToken"]] = (repr(sorted(p.items())), made)
+        return({"Instances": made})
+
+    def ec2_describe_instances(self, p):
+        ids = p.get("InstanceIds") or [
+            v for f in p.get("Filters", []) if f["Name"] == "instance-id"
+            for v in f["Values"]]
+        if ids:
+            records = [self.instances[i] for i in ids if i in self.instances]
+        else:
+            records = list(self.instances.values())
+        records = self.filtered(records, p.get("Filters"), {
+            "instance-id": lambda r: r["InstanceId"],
+            "instance-state-name": lambda r: r["State"]["Name"],
+            "subnet-id": lambda r: r["SubnetId"],
+            "availability-zone": lambda r: r["Placement"]["AvailabilityZone"],
+        })
+        records, more = self.page(records, p)
+        return(dict({"Reservations": [{"Instances": records}]}, **more))
+
+    def set_state(self, p, state):
+        for instid in p["InstanceIds"]:
+            if instid not in self.instances:
+                return(self.error("InvalidInstanceID.NotFound",
+                                  "The instance ID '{}' does not exist"
+                                  .format(instid)))
+        for instid in p["InstanceIds"]:
+            self.instances[instid]["State"] = {"Name": state}
+        return({})
+
+    def ec2_start_instances(self, p):
+        return(self.set_state(p, "running"))
+
+    def ec2_stop_instances(self, p):
+        return(self.set_state(p, "stopped"))
+
+    def ec2_terminate_instances(self, p):
+        return(self.set_state(p, "terminated"))
+
+    def ec2_modify_instance_attribute(self, p):
+        inst = self.instances[p["InstanceId"]]
+        if inst["State"]["Name"] != "stopped":
+            return(self.error("IncorrectInstanceState", "The instance '{}' "
+                              "is not in the 'stopped' state."
+                              .format(p["InstanceId"])))
+        inst["InstanceType"] = p["InstanceType"]["Value"]
+        return({})
+
+    def ec2_create_tags(self, p):
+        for resid in p["Resources"]:
+            record = self.instances.get(resid) or self.subnets.get(resid)
+            if record is not None:
+                record["Tags"] = [t for t in record.get("Tags", [])
+                                  if t["Key"] not in {
+                                      n["Key"] for n in p["Tags"]}]
+                record["Tags"] += p["Tags"]
+        return({})
+
+    # Subnets and network interfaces
+
+    def ec2_create_subnet(self, p):
+        sub = {"SubnetId": self.newid("subnet"), "CidrBlock": p["CidrBlock"],
+               "AvailabilityZone": p["AvailabilityZone"],
+               "AvailableIpAddressCount": 251, "VpcId": "vpc-00000000",
+               "State": "available", "Tags": self.spec_tags(p)}
+        self.subnets[sub["SubnetId"]] = sub
+        return({"Subnet": sub})
+
+    def ec2_describe_subnets(self, p):
+        records = self.filtered(list(self.subnets.values()),
+                                p.get("Filters"), {
+            "subnet-id": lambda r: r["SubnetId"],
+            "availabilityZone": lambda r: r["AvailabilityZone"],
+            "availability-zone": lambda r: r["AvailabilityZone"],
+            "vpc-id": lambda r: r["VpcId"],
+        })
+        records, more = self.page(records, p)
+        return(dict({"Subnets": records}, **more))
+
+    def ec2_delete_subnet(self, p):
+        subid = p["SubnetId"]
+        if subid not in self.subnets:
+            return(self.error("InvalidSubnetID.NotFound",
+                              "The subnet ID '{}' does not exist"
+                              .format(subid)))
+        if any(i["State"]["Name"] != "terminated"
+               for i in self.insubnet.get(subid, [])) or any(
+                   n["SubnetId"] == subid for n in self.enis.values()):
+            return(self.error("DependencyViolation",
+                              "The subnet '{}' has dependencies and cannot "
+                              "be deleted.".format(subid)))
+        del self.subnets[subid]
+        return({})
+
+    def spec_tags(self, p):
+        return([t for spec in p.get("TagSpecifications", [])
+                for t in spec["Tags"]])
+
+    def add_eni(self, subid, status, owner=None):
+        eni = {"NetworkInterfaceId": self.newid("eni"), "SubnetId": subid,
+               "Status": status, "owner": owner}
+        self.enis[eni["NetworkInterfaceId"]] = eni
+
+    def ec2_describe_network_interfaces(self, p):
+        records = self.filtered(list(self.enis.values()), p.get("Filters"), {
+            "network-interface-id": lambda r: r["NetworkInterfaceId"],
+            "subnet-id": lambda r: r["SubnetId"],
+            "status": lambda r: r["Status"],
+        })
+        records, more = self.page(records, p)
+        return(dict({"NetworkInterfaces": [
+            {k: v for k, v in r.items() if k != "owner"} for r in records]},
+            **more))
+
+    def ec2_delete_network_interface(self, p):
+        self.enis.pop(p["NetworkInterfaceId"], None)
+        return({})
+
+    # Key pairs
+
+    def ec2_create_key_pair(self, p):
+        self.keypairs[p["KeyName"]] = {"KeyName": p["KeyName"],
+                                       "KeyFingerprint": "00:00",
+                                       "Tags": self.spec_tags(p)}
+        return(dict(self.keypairs[p["KeyName"]], KeyMaterial="-----"))
+
+    def ec2_describe_key_pairs(self, p):
+        return({"KeyPairs": self.filtered(
+            list(self.keypairs.values()), p.get("Filters"),
+            {"key-name": lambda r: r["KeyName"]})})
+
+    def ec2_delete_key_pair(self, p):
+        self.keypairs.pop(p["KeyName"], None)
+        return({})
+
+    def ec2_describe_vpcs(self, p):
+        return({"Vpcs": [{"VpcId": "vpc-00000000", "CidrBlock": "10.0.0.0/16",
+                          "CidrBlockAssociationSet": [
+                              {"CidrBlock": "10.{}.0.0/16".format(n),
+                               "CidrBlockState": {"State": "associated"}}
+                              for n in range(5)]}]})
+
+    def ec2_describe_regions(self, p):
+        return({"Regions": [{"RegionName": "us-west-2"},
+                            {"RegionName": "us-east-1"}]})
+
+    def ec2_describe_availability_zones(self, p):
+        return({"AvailabilityZones": [
+            {"ZoneName": "us-west-2" + az, "State": "available"}
+            for az in "abc"]})
+
+    # Load balancers, listeners and target groups
+
+    def elbv2_create_load_balancer(self, p):
+        arn = "arn:aws:elasticloadbalancing:us-west-2:0:loadbalancer/app/{}" \
+            .format(p["Name"])
+        alb = {"LoadBalancerArn": arn, "LoadBalancerName": p["Name"],
+               "DNSName": "{}.elb.amazonaws.com".format(p["Name"]),
+               "State": {"Code": "active"}, "Type": "application",
+               "VpcId": "vpc-00000000", "AvailabilityZones": [
+                   {"SubnetId": s, "ZoneName":
+                    self.subnets[s]["AvailabilityZone"]}
+                   for s in p["Subnets"]]}
+        self.albs[arn] = alb
+        self.tags[arn] = p.get("Tags", [])
+        for subid in p["Subnets"]:
+            self.add_eni(subid, "in-use", arn)
+        return({"LoadBalancers": [alb]})
+
+    def elbv2_set_subnets(self, p):
+        arn = p["LoadBalancerArn"]
+        self.albs[arn]["AvailabilityZones"] = [
+            {"SubnetId": s, "ZoneName": self.subnets[s]["AvailabilityZone"]}
+            for s in p["Subnets"]]
+        for eni in [e for e, n in self.enis.items() if n["owner"] == arn]:
+            del self.enis[eni]
+        for subid in p["Subnets"]:
+            self.add_eni(subid, "in-use", arn)
+        return({"AvailabilityZones": self.albs[arn]["AvailabilityZones"]})
+
+    def elbv2_describe_load_balancers(self, p):
+        records = list(self.albs.values())
+        for arg, key in (("Names", "LoadBalancerName"),
+                         ("LoadBalancerArns", "LoadBalancerArn")):
+            if p.get(arg):
+                records = [a for a in records if a[key] in p[arg]]
+                if len(records) < len(set(p[arg])):
+                    return(self.error("LoadBalancerNotFound",
+                                      "One or more load balancers not found"))
+        records, more = self.page(records, p, "Marker", "PageSize",
+                                  "NextMarker")
+        return(dict({"LoadBalancers": records}, **more))
+
+    def elbv2_delete_load_balancer(self, p):
+        arn = p["LoadBalancerArn"]
+        self.albs.pop(arn, None)
+        for tg in self.tgs.values():
+            if arn in tg["LoadBalancerArns"]:
+                tg["LoadBalancerArns"].remove(arn)
+        for ln in [a for a, ln in self.listeners.items()
+                   if ln["LoadBalancerArn"] == arn]:
+            del self.listeners[ln]
+        for eni in [e for e, n in self.enis.items() if n["owner"] == arn]:
+            del self.enis[eni]
+        return({})
+
+    def elbv2_create_listener(self, p):
+        arn = p["LoadBalancerArn"].replace(":loadbalancer/", ":listener/") + \
+            "/80"
+        self.listeners[arn] = {"ListenerArn": arn, "Port": 80,
+                               "LoadBalancerArn": p["LoadBalancerArn"],
+                               "DefaultActions": p["DefaultActions"]}
+        for action in p["DefaultActions"]:
+            lbs = self.tgs[action["TargetGroupArn"]]["LoadBalancerArns"]
+            lbs.append(p["LoadBalancerArn"])
+        return({"Listeners": [self.listeners[arn]]})
+
+    def elbv2_describe_listeners(self, p):
+        return({"Listeners": [ln for ln in self.listeners.values()
+                              if ln["LoadBalancerArn"] ==
+                              p.get("LoadBalancerArn")]})
+
+    def elbv2_modify_listener(self, p):
+        ln = self.listeners[p["ListenerArn"]]
+        for action in ln["DefaultActions"]:
+            lbs = self.tgs[action["TargetGroupArn"]]["LoadBalancerArns"]
+            lbs.remove(ln["LoadBalancerArn"])
+        for action in p["DefaultActions"]:
+            lbs = self.tgs[action["TargetGroupArn"]]["LoadBalancerArns"]
+            lbs.append(ln["LoadBalancerArn"])
+        ln["DefaultActions"] = p["DefaultActions"]
+        return({"Listeners": [ln]})
+
+    def elbv2_delete_listener(self, p):
+        self.listeners.pop(p["ListenerArn"], None)
+        return({})
+
+    def elbv2_create_target_group(self, p):
+        arn = "arn:aws:elasticloadbalancing:us-west-2:0:targetgroup/{}" \
+            .format(p["Name"])
+        self.tgs[arn] = {"TargetGroupArn": arn, "TargetGroupName": p["Name"],
+                         "Protocol": "HTTP", "Port": 80,
+                         "VpcId": "vpc-00000000", "LoadBalancerArns": []}
+        self.targets[arn] = []
+        self.tags[arn] = p.get("Tags", [])
+        return({"TargetGroups": [self.tgs[arn]]})
+
+    def elbv2_register_targets(self, p):
+        self.targets[p["TargetGroupArn"]] += [t["Id"] for t in p["Targets"]]
+        return({})
+
+    def elbv2_deregister_targets(self, p):
+        gone = {t["Id"] for t in p["Targets"]}
+        self.targets[p["TargetGroupArn"]] = [
+            t for t in self.targets[p["TargetGroupArn"]] if t not in gone]
+        return({})
+
+    def elbv2_describe_target_groups(self, p):
+        records = list(self.tgs.values())
+        for arg, key in (("Names", "TargetGroupName"),
+                         ("TargetGroupArns", "TargetGroupArn")):
+            if p.get(arg):
+                records = [t for t in records if t[key] in p[arg]]
+                if len(records) < len(set(p[arg])):
+                    return(self.error("TargetGroupNotFound",
+                                      "One or more target groups not found"))
+        if p.get("LoadBalancerArn"):
+            records = [t for t in records
+                       if p["LoadBalancerArn"] in t["LoadBalancerArns"]]
+        records, more = self.page(records, p, "Marker", "PageSize",
+                                  "NextMarker")
+        return(dict({"TargetGroups": records}, **more))
+
+    def elbv2_describe_target_health(self, p):
+        return({"TargetHealthDescriptions": [
+            {"Target": {"Id": t}, "TargetHealth": {"State": "healthy"}}
+            for t in self.targets.get(p["TargetGroupArn"], [])]})
+
+    def elbv2_delete_target_group(self, p):
+        tg = self.tgs.get(p["TargetGroupArn"])
+        if tg and tg["LoadBalancerArns"]:
+            return(self.error("ResourceInUse", "Target group '{}' is "
+                              "currently in use by a listener or a rule"
+                              .format(p["TargetGroupArn"])))
+        self.tgs.pop(p["TargetGroupArn"], None)
+        return({})
+
+    def elbv2_describe_tags(self, p):
+        return({"TagDescriptions": [
+            {"ResourceArn": arn, "Tags": self.tags.get(arn, [])}
+            for arn in p["ResourceArns"]]})
+
+    # S3. The "logs" bucket holds self.objects objects spread over 100
+    # top-level prefixes. Keys are generated a page at a time.
+
+    def s3_list_buckets(self, p):
+        return({"Buckets": [{"Name": "logs", "CreationDate": EPOCH}]})
+
+    def s3_list_objects_v2(self, p):
+        per = max(1, -(-self.objects // 100))
+        prefix = p.get("Prefix", "")
+        if p.get("Delimiter") and not prefix:
+            days = -(-self.objects // per)
+            return({"KeyCount": days, "CommonPrefixes": [
+                {"Prefix": "day{:02d}/".format(d)} for d in range(days)]})
+        if prefix:
+            first = int(prefix[3:5]) * per
+            last = min(self.objects, first + per)
+        else:
+            first, last = 0, self.objects
+        start = first + int(p.get("ContinuationToken") or 0)
+        end = min(last, start + p.get("MaxKeys", 1000))
+        resp = {"KeyCount": end - start, "Contents": [
+            {"Key": "day{:02d}/obj{:07d}".format(n // per, n), "Size": 1024,
+             "ETag": "\"0\"", "LastModified": EPOCH}
+            for n in range(start, end)]}
+        if end < last:
+            resp.update(IsTruncated=True,
+                        NextContinuationToken=str(end - first))
+        return(resp)
+
+
+# Fixed date used for the generated S3 objects
+
+EPOCH = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+# Scale benchmark paths. Each takes a fresh Aws() object, runs one path of the
+# tools and checks the outcome, raising RuntimeError if it is wrong, so the
+# benchmarks also catch changes that make a path faster by breaking it.
+
+
+def check(ok, what):
+    if not ok:
+        raise RuntimeError(what)
+
+
+def run_list_inst(aws, standin):
+    check(len(aws.list_inst()) == len(standin.instances),
+          "list_inst missed instances")
+
+
+def run_query_inst(aws, standin):
+    found = list(aws.query_inst(states="running",
+                                fields=["InstanceId", "Name", "SubnetId"]))
+    check(len(found) == sum(i["State"]["Name"] == "running"
+                            for i in standin.instances.values()),
+          "query_inst missed instances")
+
+
+def run_list_subnets(aws, standin):
+    check(len(aws.list_subnets_all()) == len(standin.subnets),
+          "list_subnets_all missed subnets")
+
+
+def run_list_files(aws, standin):
+    check(sum(map(len, aws.list_files().values())) == standin.objects,
+          "list_files missed objects")
+
+
+def run_list_split(aws, standin):
+    check(sum(1 for _ in aws.list_objects(split=True)) == standin.objects,
+          "list_objects(split=True) missed objects")
+
+
+def run_build_stack(aws, standin):
+    from awsorch import Stack
+    stack = Stack()
+    key = stack.add("keypair", aws.create_keypair, "webkey")
+    subs = [stack.add("sub{}".format(n), aws.create_subnet,
+                      "10.94.{}.0/24".format(n), "us-west-2" + az)
+            for n, az in enumerate("abc")]
+    insts = [stack.add("inst{}".format(n), aws.create_inst, sub, key,
+                       "web-{}".format(n)) for n, sub in enumerate(subs)]
+    tg = stack.add("tg", aws.create_target_group, "web-tg", *insts)
+    stack.add("alb", aws.create_alb, "web-alb", *subs, tg)
+    stack.run()
+    check(not stack.failed and not stack.skipped, "build_stack failed")
+
+
+def run_create_insts(aws, standin):
+    made = aws.create_insts(10000, sorted(standin.subnets), "webkey", "web")
+    check(len(made) == 10000, "create_insts missed instances")
+
+
+def run_alloc_subnets(aws, standin):
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        made = list(pool.map(lambda n: aws.create_subnet(
+            "/26", "us-west-2" + "abc"[n % 3]), range(1000)))
+    nets = sorted(ipaddress.ip_network(sub["CidrBlock"])
+                  for sub in standin.subnets.values())
+    check(None not in made and len(nets) == 2000 and
+          not any(a.overlaps(b) for a, b in zip(nets, nets[1:])),
+          "alloc_subnets handed out overlapping blocks")
+
+
+def run_teardown(aws, standin):
+    from awsorch import Teardown
+    teardown = Teardown(aws)
+    teardown.discover(subnets=sorted(standin.subnets))
+    failed = teardown.run()
+    check(not any(failed.values()) and not standin.subnets and
+          not standin.albs, "teardown left resources behind")
+
+
+# Scale benchmarks: the fixture each one loads and the path it runs
+
+SCALE = {
+    "list_inst": ({"instances": 10000, "subnets": 1000}, run_list_inst),
+    "query_inst": ({"instances": 10000, "subnets": 1000}, run_query_inst),
+    "list_subnets_all": ({"subnets": 1000}, run_list_subnets),
+    "list_files": ({"objects": 1000000}, run_list_files),
+    "list_objects_split": ({"objects": 1000000}, run_list_split),
+    "build_stack": ({}, run_build_stack),
+    "create_insts": ({"subnets": 1000}, run_create_insts),
+    "alloc_subnets": ({"subnets": 1000}, run_alloc_subnets),
+    "teardown": ({"instances": 10000, "subnets": 1000, "albs": 10},
+                 run_teardown),
+}
+
+# Run one scale benchmark once on a freshly loaded fixture and a fresh Aws()
+# object, with its output thrown away. Returns the wall time in seconds and,
+# with trace=True, the peak memory allocated by the path in MB.
+
+
+def scale_once(standin, fixture, path, trace=False):
+    from awsclass import Aws
+    standin.reset(**fixture)
+    aws = Aws()
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            path(aws, standin)
+        finally:
+            secs = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1] if trace else 0
+            tracemalloc.stop()
+    return(secs, peak / 1024 ** 2)
+
+# Compare results with a baseline. A benchmark regresses when its time or
+# peak memory is more than "tolerance" above the baseline, and by more than
+# MINSECONDS or MINMB. A benchmark missing from the baseline also fails, so
+# a lost baseline is not mistaken for a clean run. Returns the list of
+# regressions.
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if not old:
+            regressions.append("{} has no baseline".format(name))
+            continue
+        for metric, floor in (("seconds", MINSECONDS), ("peak_mb", MINMB)):
+            if (result[metric] > old[metric] * (1 + tolerance) and
+                    result[metric] - old[metric] > floor):
+                regressions.append("{} {} {:.3f} -> {:.3f}".format(
+                    name, metric, old[metric], result[metric]))
+    return(regressions)
+
+# Scale benchmark. Runs each benchmark "runs" times for its median time, then
+# once more under tracemalloc for its peak memory, and prints the results next
+# to the baseline if there is one. With save=True the results become the new
+# baseline. Returns the results and the list of regressions.
+
+
+def bench_scale(runs, names=None, baseline=BASELINE, save=False,
+                tolerance=0.25):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.environ.update(bench_env(tmpdir))
+        import awsclass
+        standin = StandIn()
+        standin.install(awsclass.get_session())
+
+        results = {}
+        for name, (fixture, path) in SCALE.items():
+            if names and name not in names:
+                continue
+            secs = [scale_once(standin, fixture, path)[0]
+                    for _ in range(runs)]
+            peak = scale_once(standin, fixture, path, trace=True)[1]
+            results[name] = {"seconds": statistics.median(secs),
+                             "best": min(secs), "peak_mb": peak}
+
+    try:
+        with open(baseline) as f:
+            old = json.load(f)
+    except (OSError, ValueError):
+        old = {}
+
+    print("\nScale benchmarks ({} runs):".format(runs))
+    for name, result in results.items():
+        line = "  {:<20} median {:7.3f}s  best {:7.3f}s  peak {:8.1f} MB" \
+            .format(name, result["seconds"], result["best"],
+                    result["peak_mb"])
+        if name in old:
+            line += "  (baseline {:.3f}s, {:.1f} MB)".format(
+                old[name]["seconds"], old[name]["peak_mb"])
+        print(line)
+
+    if save:
+        with open(baseline, "w") as f:
+            json.dump(dict(old, **results), f, indent=1, sort_keys=True)
+        print("Baseline saved to {}".format(baseline))
+        return(results, [])
+    regressions = compare(results, old, tolerance)
+    for regression in regressions:
+        print("REGRESSION: {}".format(regression))
+    if not old:
+        print("No baseline at {}; run with --save to create one".format(
+            baseline))
+    return(results, regressions)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("suite", choices=["startup", "scale"])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--only", action="append", choices=sorted(SCALE),
+                        help="scale benchmark to run (repeatable)")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true",
+                        help="save the scale results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    if args.suite == "startup":
+        bench_startup(args.runs)
+    elif args.suite == "scale":
+        results, regressions = bench_scale(
+            args.runs, args.only, args.baseline, args.save, args.tolerance)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+""" AWS CIDR Allocator
+
+This module contains the CidrAllocator() class. It hands out subnet CIDR
+blocks of a VPC that do not overlap each other or the existing subnets:
+
+- The free space of the VPC CIDR blocks is kept as aligned blocks, with one
+  free list per prefix length (a buddy allocator). Each free list is a heap,
+  lowest address first, so subnets are packed from the bottom of the VPC
+- allocate(24) takes the smallest free block that fits and splits it down to
+  a /24, putting the unused halves back on their free lists. That is a few
+  heap operations per prefix length, O(log n) in the number of free blocks
+- claim() takes a given CIDR block, and fails at once if it is not free
+- release() puts a block back and merges it with its buddy while the buddy
+  is free too
+- Blocks are reserved under a lock, so threads creating subnets at the same
+  time never get the same block
+
+"""
+
+# Import modules
+
+import heapq
+import ipaddress
+import threading
+
+# Smallest and largest subnets AWS allows
+
+MINPREFIX = 16
+MAXPREFIX = 28
+
+
+class CidrAllocator():
+    def __init__(self, vpcblocks, used=None):
+        self.heaps = [[] for _ in range(33)]
+        self.free = set()
+        self.used = {}
+        self.owners = {}
+        self.vpcs = sorted(ipaddress.ip_network(b) for b in vpcblocks)
+        self.lock = threading.Lock()
+
+        used = used or {}
+        taken = sorted(ipaddress.ip_network(cidr) for cidr in used)
+        for cidr, owner in used.items():
+            self.assign(ipaddress.ip_network(cidr), owner)
+        for vpc in self.vpcs:
+            cursor = int(vpc.network_address)
+            end = int(vpc.broadcast_address)
+            for net in taken:
+                if not net.subnet_of(vpc):
+                    continue
+                if int(net.network_address) > cursor:
+                    self.add_range(cursor, int(net.network_address) - 1)
+                cursor = max(cursor, int(net.broadcast_address) + 1)
+            if cursor <= end:
+                self.add_range(cursor, end)
+
+# Add the addresses from "first" to "last" to the free lists, as the fewest
+# aligned blocks that cover them.
+
+    def add_range(self, first, last):
+        for net in ipaddress.summarize_address_range(
+                ipaddress.IPv4Address(first), ipaddress.IPv4Address(last)):
+            self.push(net.prefixlen, int(net.network_address))
+
+    def push(self, prefix, start):
+        self.free.add((prefix, start))
+        heapq.heappush(self.heaps[prefix], start)
+
+# Take the lowest free block of a prefix length, or None. Blocks merged away
+# by release() are still in the heap, so they are skipped here.
+
+    def pop(self, prefix):
+        heap = self.heaps[prefix]
+        while heap:
+            start = heapq.heappop(heap)
+            if (prefix, start) in self.free:
+                self.free.remove((prefix, start))
+                return(start)
+        return(None)
+
+# Allocate a block of a prefix length, such as 24, for "owner" (any label,
+# such as an AZ). Returns the block as an IPv4Network, or None if no free
+# block is large enough. Raises ValueError for a prefix AWS does not allow.
+
+    def allocate(self, prefix, owner=None):
+        if not MINPREFIX <= prefix <= MAXPREFIX:
+            raise ValueError("Subnets must be /{} to /{}, not /{}".format(
+                MINPREFIX, MAXPREFIX, prefix))
+        with self.lock:
+            for size in range(prefix, -1, -1):
+                start = self.pop(size)
+                if start is not None:
+                    break
+            else:
+                return(None)
+            while size < prefix:
+                size += 1
+                self.push(size, start + (1 << (32 - size)))
+            net = ipaddress.ip_network((start, prefix))
+            self.assign(net, owner)
+            return(net)
+
+# Reserve a given CIDR block for "owner". Returns it as an IPv4Network.
+# Raises ValueError if it overlaps a block in use or is outside the VPC.
+
+    def claim(self, cidr, owner=None):
+        net = ipaddress.ip_network(cidr)
+        start = int(net.network_address)
+        with self.lock:
+            for size in range(net.prefixlen, -1, -1):
+                block = start & ~((1 << (32 - size)) - 1)
+                if (size, block) in self.free:
+                    break
+            else:
+                raise ValueError("{} overlaps a subnet or is outside the VPC"
+                                 .format(net))
+            self.free.remove((size, block))
+            while size < net.prefixlen:
+                size += 1
+                half = 1 << (32 - size)
+                if start & half:
+                    self.push(size, block)
+                    block += half
+                else:
+                    self.push(size, block + half)
+            self.assign(net, owner)
+            return(net)
+
+# Record the owner of a block in use, such as the subnet ID once the subnet
+# exists.
+
+    def assign(self, net, owner):
+        net = ipaddress.ip_network(net)
+        old = self.used.get(net)
+        if old is not None:
+            self.owners.pop(old, None)
+        self.used[net] = owner
+        if owner is not None:
+            self.owners[owner] = net
+
+# Put a block back, given as a CIDR block or as its owner. Blocks not in use
+# are ignored. A block is not merged past the VPC CIDR block it is in, as a
+# subnet cannot span two of them. Returns the block, or None.
+
+    def release(self, cidr_or_owner):
+        with self.lock:
+            net = self.owners.get(cidr_or_owner)
+            if net is None:
+                try:
+                    net = ipaddress.ip_network(cidr_or_owner)
+                except ValueError:
+                    return(None)
+            if net not in self.used:
+                return(None)
+            self.owners.pop(self.used.pop(net), None)
+
+            prefix, start = net.prefixlen, int(net.network_address)
+            while prefix > 0:
+                buddy = start ^ (1 << (32 - prefix))
+                parent = ipaddress.ip_network((min(start, buddy), prefix - 1))
+                if ((prefix, buddy) not in self.free or
+                        not any(parent.subnet_of(vpc) for vpc in self.vpcs)):
+                    break
+                self.free.remove((prefix, buddy))
+                start = min(start, buddy)
+                prefix -= 1
+            self.push(prefix, start)
+            return(net)
+
+# Number of free addresses left.
+
+    def available(self):
+        with self.lock:
+            return(sum(1 << (32 - prefix) for prefix, start in self.free))
@@ -16,27 +16,309 @@ This program is an AWS class utility that performs the following:
 # Import modules
 
 import boto3
+import hashlib
+import json
+import mmap
+import os
+import queue
+import re
+import threading
+import time
+import types
+from collections import OrderedDict
+from awscidr import CidrAllocator
+from awsout import Output
+from awsretry import Throttle
+from awsstats import CallStats
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
+from functools import lru_cache
+
+# Location of the credentials file holding the settings of the tool. Can be
+# moved with the AWSTOOL_CREDENTIALS environment variable.
+
+CREDFILE = os.environ.get(
+    "AWSTOOL_CREDENTIALS", "/home/ec2-user/.aws/credentials")
+
+# Patterns of resource IDs, and the words used for each resource type in
+# messages. ARNs always start with "arn:".
+
+IDPATTERNS = {"instances": re.compile(r"i-[0-9a-f]+$"),
+              "subnets": re.compile(r"subnet-[0-9a-f]+$")}
+KINDNAMES = {"albs": "load balancer", "targetgroups": "target group",
+             "listeners": "listener", "instances": "instance",
+             "subnets": "subnet"}
+
+# Most instance IDs accepted by one start/stop/terminate call, most values
+# accepted by one describe filter, and most keys accepted by one S3
+# DeleteObjects call.
+
+MAXIDS = 1000
+MAXFILTER = 200
+MAXKEYS = 1000
+
+# Most names or ARNs accepted by one describe_load_balancers or
+# describe_target_groups call, and the error codes of those calls when one of
+# them does not exist.
+
+MAXELBV2 = 20
+NOTFOUND = {"LoadBalancerNotFound", "TargetGroupNotFound"}
+
+# S3 multipart limits: smallest part (except the last one) and most parts per
+# upload.
+
+MB = 1024 ** 2
+MINPART = 5 * MB
+MAXPARTS = 10000
+
+# Fields and text format of the records of each listing method. See awsout.py.
+
+SUBNETFIELDS = ["SubnetId", "CidrBlock", "AvailabilityZone",
+                "AvailableIpAddressCount", "Name"]
+SUBNETTEXT = ("Subnet ID = {SubnetId} with CIDR of {CidrBlock} in AZ "
+              "{AvailabilityZone} with {AvailableIpAddressCount} "
+              "available IPs")
+INSTFIELDS = ["InstanceId", "InstanceType", "Name", "State"]
+INSTTEXT = "ID: {InstanceId} Type: {InstanceType} Name: {Name} State: {State}"
+ALBFIELDS = ["LoadBalancerName", "DNSName", "State"]
+ALBTEXT = "LB Name = {LoadBalancerName}  DNS Name = {DNSName}"
+TGFIELDS = ["TargetGroupName", "TargetGroupArn"]
+TGTEXT = "TG Name = {TargetGroupName}  ARN = {TargetGroupArn}"
+KEYFIELDS = ["KeyName", "KeyFingerprint"]
+KEYTEXT = "Key pair = {KeyName}, fingerprint = {KeyFingerprint}"
+BUCKFIELDS = ["Name", "CreationDate"]
+BUCKTEXT = "{Name}"
+FILEFIELDS = ["Bucket", "Key", "Size", "ETag", "LastModified"]
+FILETEXT = "Bucket: {Bucket}  File: {Key}"
+REGIONFIELDS = ["Region", "Kind", "Id", "Name", "Detail"]
+REGIONTEXT = "{Region:<16} {Kind:<13} {Id:<26} {Name:<24} {Detail}"
+
+# Default time-to-live in seconds of each resource type in the inventory
+# cache.
+
+CACHE_TTLS = {"subnets": 300, "instances": 30, "albs": 60,
+              "targetgroups": 60, "keypairs": 300, "buckets": 300,
+              "regions": 3600, "azs": 3600}
+
+
+# Inventory cache. Keeps the response of each describe call for the TTL of
+# its resource type, and at most "maxsize" responses, dropping the least
+# recently used first. Counts hits and misses per resource type. Each type
+# has a generation that invalidate() bumps, and a response fetched across an
+# invalidation is returned but not kept, as it may be from before the change.
+
+class InvCache():
+    def __init__(self, ttls=None, maxsize=256):
+        self.ttls = dict(CACHE_TTLS, **(ttls or {}))
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = {}
+        self.misses = {}
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def get(self, kind, key, fetch):
+        with self.lock:
+            entry = self.entries.get((kind, key))
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end((kind, key))
+                self.hits[kind] = self.hits.get(kind, 0) + 1
+                return(entry[1])
+            self.misses[kind] = self.misses.get(kind, 0) + 1
+            generation = self.generations.get(kind, 0)
+
+        value = fetch()
+        with self.lock:
+            if self.generations.get(kind, 0) != generation:
+                return(value)
+            self.entries[(kind, key)] = (
+                time.monotonic() + self.ttls.get(kind, 60), value)
+            self.entries.move_to_end((kind, key))
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return(value)
+
+    def invalidate(self, *kinds):
+        with self.lock:
+            for kind in kinds:
+                self.generations[kind] = self.generations.get(kind, 0) + 1
+            for entry in [e for e in self.entries if e[0] in kinds]:
+                del self.entries[entry]
+
+    def stats(self):
+        with self.lock:
+            return({kind: {"hits": self.hits.get(kind, 0),
+                           "misses": self.misses.get(kind, 0)}
+                    for kind in sorted(set(self.hits) | set(self.misses))})
+
+
+# Name index. Maps the names of resources to their IDs or ARNs, per resource
+# type. A name can map to more than one resource (two instances can share a
+# Name tag). A type is only known once it has been loaded in full, after which
+# single entries are added and removed as resources are created and deleted.
+
+class NameIndex():
+    def __init__(self):
+        self.names = {}
+        self.loaded = set()
+        self.lock = threading.Lock()
+
+    def load(self, kind, pairs):
+        names = {}
+        for name, value in pairs:
+            if name:
+                names.setdefault(name, set()).add(value)
+        with self.lock:
+            self.names[kind] = names
+            self.loaded.add(kind)
+
+    def get(self, kind, name):
+        with self.lock:
+            return(set(self.names.get(kind, {}).get(name, ())))
+
+    def add(self, kind, name, value):
+        if not name:
+            return
+        with self.lock:
+            self.names.setdefault(kind, {}).setdefault(name, set()).add(value)
+
+# Remove resources by value, or every value starting with "prefix".
+
+    def discard(self, kind, values=(), prefix=None):
+        values = set(values)
+        with self.lock:
+            names = self.names.get(kind, {})
+            for name in list(names):
+                names[name] = {v for v in names[name] if v not in values and
+                               not (prefix and v.startswith(prefix))}
+                if not names[name]:
+                    del names[name]
+
+
+# Load the configuration settings from the "credentials" file. The file is
+# only read once per process.
+
+@lru_cache(maxsize=None)
+def load_config(path=CREDFILE):
+    awscfg = ConfigParser()
+    awscfg.read(path)
+    return(awscfg)
+
+
+# Read a setting for a region. A section named after the region (such as
+# [us-east-1]) overrides the [default] section, since the VPC, AMI, security
+# group and key pair of one region do not exist in another.
+
+def region_setting(awscfg, region, key):
+    if awscfg.has_option(region, key):
+        return(awscfg.get(region, key))
+    return(awscfg.get("default", key))
+
+
+# Build the botocore client settings from the connection settings in the
+# "credentials" file. All of them are optional:
+#
+#   max_pool_connections = <HTTP connections kept per client, default 50>
+#   connect_timeout = <seconds to wait for a connection, default 10>
+#   read_timeout = <seconds to wait for a response, default 60>
+#   tcp_keepalive = <send TCP keep-alive probes, default true>
+#
+# Retries are left to the Throttle() of the Aws() object, so botocore is told
+# to make a single attempt.
+
+def client_config(awscfg):
+    section = awscfg["default"]
+    return(Config(
+        max_pool_connections=section.getint("max_pool_connections", 50),
+        connect_timeout=section.getfloat("connect_timeout", 10),
+        read_timeout=section.getfloat("read_timeout", 60),
+        tcp_keepalive=section.getboolean("tcp_keepalive", True),
+        retries={"mode": "standard", "total_max_attempts": 1}))
+
+
+# Build the retry and rate limiting settings (see awsretry.py) from the
+# "credentials" file. All of them are optional:
+#
+#   max_attempts = <tries per API call, default 8>
+#   api_rate = <starting calls per second of each API family, default 20>
+#   api_burst = <calls each API family can make at once, default 40>
+#   api_maxrate = <highest calls per second of each API family, default 100>
+
+def throttle_config(awscfg):
+    section = awscfg["default"]
+    return(Throttle(
+        rate=section.getfloat("api_rate", 20),
+        burst=section.getfloat("api_burst", 40),
+        maxrate=section.getfloat("api_maxrate", 100),
+        max_attempts=section.getint("max_attempts", 8)))
+
+
+# Shared boto3 session. Every client and resource in the process is built
+# from the one botocore session inside it, so the service models and
+# credentials are only loaded once. Building clients from a session is not
+# thread-safe, so it is done under sessionlock.
+
+session = None
+sessionlock = threading.RLock()
+
+
+def get_session():
+    global session
+    with sessionlock:
+        if session is None:
+            session = boto3.session.Session()
+        return(session)
 
 
 class Aws():
-    def __init__(self):
-        awscfg = ConfigParser()
-        awscfg.read("/home/ec2-user/.aws/credentials")
-        self.region = awscfg.get("default", "region")
-        self.mykey = awscfg.get("default", "key")
-        self.mysg = awscfg.get("default", "secgroup")
-        self.myami = awscfg.get("default", "ami")
-        self.ec2type = awscfg.get("default", "ec2type")
-        self.myvpc = awscfg.get("default", "vpc")
-
-        self.ec2r = boto3.resource("ec2")
-        self.ec2c = boto3.client("ec2")
-        self.s3r = boto3.resource("s3")
-        self.s3c = boto3.client("s3")
-        self.elbv2c = boto3.client("elbv2")
-
-        self.vpc = self.ec2r.Vpc(self.myvpc)
+    def __init__(self, region=None):
+        awscfg = load_config()
+        self.region = region or awscfg.get("default", "region")
+        self.mykey = region_setting(awscfg, self.region, "key")
+        self.mysg = region_setting(awscfg, self.region, "secgroup")
+        self.myami = region_setting(awscfg, self.region, "ami")
+        self.ec2type = region_setting(awscfg, self.region, "ec2type")
+        self.myvpc = region_setting(awscfg, self.region, "vpc")
+
+        # Regions swept by the multi-region methods when none are given: the
+        # optional "regions" setting (comma-separated), or just this region.
+        # The Aws() object of each other region is built on first use and
+        # shared by every object in the set.
+
+        self.regions = [r.strip() for r in awscfg["default"].get(
+            "regions", self.region).split(",") if r.strip()]
+        self.regional = {self.region: self}
+        self.regionlock = threading.Lock()
+
+        # Clients and resources are built on first use. Building them loads
+        # the botocore service models, which is most of the startup time.
+        # Clients are thread-safe and shared by every thread using this
+        # object, while resources are not, so each thread gets its own.
+
+        self.botocfg = client_config(awscfg)
+        self.throttle = throttle_config(awscfg)
+        self.callstats = CallStats()
+        self.clients = {}
+        self.local = threading.local()
+        self.cache = None
+        self.index = NameIndex()
+        self.allocator = None
+        self.alloclock = threading.Lock()
+
+        # Multipart transfer settings, both optional in the "credentials"
+        # file: part_size in MB (default 8) and transfer_workers, the number
+        # of parts sent at once (default 10).
+
+        self.partsize = int(
+            awscfg["default"].getfloat("part_size", 8) * MB)
+        self.xferworkers = awscfg["default"].getint("transfer_workers", 10)
+
+        # Output mode of the listing methods (see awsout.py), from the
+        # optional "output" setting. Each listing call can pass its own.
+
+        self.output = Output(awscfg["default"].get("output", "text"))
 
         self.userdata = """#cloud-config
 repo_update: true
@@ -50,77 +332,473 @@ runcmd:
  - service nginx start
 """
 
-# Create VPC subnet method. Returns the newly-created subnet ID.
-
-    def create_subnet(self, subnetvar, az):
-        self.subnetvar = subnetvar
-        self.az = az
-
+# Get a client or resource method. Builds it from the shared session the
+# first time it is asked for (per thread for resources).
+
+    def client(self, service, kind="client"):
+        if kind == "client":
+            store = self.clients
+        else:
+            store = self.local.__dict__.setdefault("resources", {})
+
+        if service not in store:
+            with sessionlock:
+                if service not in store:
+                    made = getattr(get_session(), kind)(
+                        service, region_name=self.region,
+                        config=self.botocfg)
+                    hooked = made if kind == "client" else made.meta.client
+                    self.throttle.register(hooked)
+                    self.callstats.register(hooked)
+                    store[service] = made
+        return(store[service])
+
+# Print and return the call, retry and throttle counters of each API family.
+
+    def retry_stats(self):
+        return(self.throttle.stats())
+
+# Print and return the call count, latency percentiles, retries and response
+# bytes of each API operation, slowest in total first.
+
+    def call_stats(self):
+        return(self.callstats.report())
+
+# Export the call statistics as "json" or "prom" (Prometheus text), written to
+# "path" if one is given. Returns the text.
+
+    def export_stats(self, fmt="json", path=None):
+        if fmt == "prom":
+            text = self.callstats.to_prometheus()
+        else:
+            text = self.callstats.to_json()
+        if path:
+            with open(path, "w") as f:
+                f.write(text)
+        return(text)
+
+# Get the Aws() object of another region. It has its own clients, name index,
+# cache and throttle (AWS rate limits are per region) but shares the call
+# statistics of this one.
+
+    def in_region(self, region):
+        with self.regionlock:
+            if region not in self.regional:
+                other = Aws(region)
+                other.regions = self.regions
+                other.regional = self.regional
+                other.regionlock = self.regionlock
+                other.callstats = self.callstats
+                other.output = self.output
+                if self.cache is not None:
+                    other.enable_cache(self.cache.ttls, self.cache.maxsize)
+                self.regional[region] = other
+            return(self.regional[region])
+
+# List the regions enabled for the account. Returns the list of region names.
+
+    def all_regions(self):
+        listreg = self.describe("regions", self.ec2c.describe_regions)
+        return(sorted(r["RegionName"] for r in listreg["Regions"]))
+
+# Turn a regions argument into a list of region names: None for the regions
+# setting, "all" for every enabled region, or a list or comma-separated
+# string of names.
+
+    def pick_regions(self, regions=None):
+        if regions is None:
+            return(list(self.regions))
+        if regions == "all":
+            return(self.all_regions())
+        if isinstance(regions, str):
+            regions = regions.split(",")
+        return([r.strip() for r in regions if r.strip()])
+
+# Sweep method. Calls an Aws() method by name in each region, "workers"
+# regions at a time. Listings that are generators are read in full. A region
+# that fails (bad region name, no access, endpoint down) is reported and left
+# out, and the sweep goes on. Returns a dict of region to result. The errors
+# are stored in the "errors" dict, if one is passed in, as region to message.
+
+    def sweep(self, method, *args, regions=None, workers=8, errors=None,
+              **kwargs):
+        regions = self.pick_regions(regions)
+
+        def run(region):
+            result = getattr(self.in_region(region), method)(*args, **kwargs)
+            return(list(result) if isinstance(result, types.GeneratorType)
+                   else result)
+
+        results = {}
+        if errors is None:
+            errors = {}
+        if not regions:
+            return(results)
+        workers = min(workers, len(regions))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {region: pool.submit(run, region) for region in regions}
+            for region, future in futures.items():
+                try:
+                    results[region] = future.result()
+                except (boto3.exceptions.botocore.client.ClientError,
+                        BotoCoreError) as e:
+                    errors[region] = str(e)
+                    print("Region {}: {}".format(region, e))
+        return(results)
+
+# List resources across regions method. Takes the resource types to list (see
+# INVENTORY, all of them by default) and the regions as for pick_regions().
+# Prints one table sorted by region. Returns the list of records, each a dict
+# with the Region, Kind, Id, Name and Detail of one resource.
+
+    def list_regions(self, kinds=None, regions=None, workers=8, output=None):
+        kinds = listify(kinds) if kinds else list(INVENTORY)
+        unknown = [kind for kind in kinds if kind not in INVENTORY]
+        if unknown:
+            print("Unknown resource types: {}. Choose from {}".format(
+                ", ".join(unknown), ", ".join(INVENTORY)))
+            return(None)
+        errors = {}
+        results = self.sweep("inventory", kinds, regions=regions,
+                             workers=workers, errors=errors)
+        records = [rec for region in sorted(results)
+                   for rec in results[region]]
+        title = "\n" + REGIONTEXT.format(
+            Region="Region", Kind="Kind", Id="ID", Name="Name",
+            Detail="Detail")
+        with self.listing(output, REGIONFIELDS, REGIONTEXT, title) as out:
+            for rec in records:
+                out.emit(rec)
+            summary = "\n{} resources in {} regions".format(
+                len(records), len(results))
+            if errors:
+                summary += ", {} regions failed: {}".format(
+                    len(errors), ", ".join(sorted(errors)))
+            out.note(summary)
+        return(records)
+
+# Inventory method. Describes the resource types given in this region, with
+# no printing. Returns the list of records, tagged with the region.
+
+    def inventory(self, kinds):
+        records = []
+        for kind in kinds:
+            for item in INVENTORY[kind](self):
+                records.append(dict(item, Region=self.region, Kind=kind))
+        return(records)
+
+# List the availability zones of the region that are up. Returns the list of
+# zone names.
+
+    def list_azs(self):
+        listaz = self.describe(
+            "azs", self.ec2c.describe_availability_zones,
+            Filters=[{"Name": "state", "Values": ["available"]}])
+        return(sorted(z["ZoneName"] for z in listaz["AvailabilityZones"]))
+
+    @property
+    def ec2r(self):
+        return(self.client("ec2", "resource"))
+
+    @property
+    def ec2c(self):
+        return(self.client("ec2"))
+
+    @property
+    def s3r(self):
+        return(self.client("s3", "resource"))
+
+    @property
+    def s3c(self):
+        return(self.client("s3"))
+
+    @property
+    def elbv2c(self):
+        return(self.client("elbv2"))
+
+    @property
+    def vpc(self):
+        return(self.ec2r.Vpc(self.myvpc))
+
+# Start a listing in the given output mode, or in self.output if none is
+# given. "output" can be a mode name or an Output() object.
+
+    def listing(self, output, fields, text, title=None):
+        if output is None:
+            output = self.output
+        elif isinstance(output, str):
+            output = Output(output)
+        return(output.listing(fields, text, title))
+
+# Turn on the inventory cache. Listing methods then reuse describe results
+# until the TTL of their resource type runs out, and methods that change a
+# resource type drop its cached results. "ttls" overrides CACHE_TTLS for some
+# resource types.
+
+    def enable_cache(self, ttls=None, maxsize=256):
+        self.cache = InvCache(ttls, maxsize)
+
+# Print and return the cache hit and miss counters of each resource type.
+
+    def cache_stats(self):
+        if self.cache is None:
+            print("The inventory cache is not enabled")
+            return({})
+        stats = self.cache.stats()
+        for kind, count in stats.items():
+            print("{:<14} hits = {hits}  misses = {misses}".format(
+                kind, **count))
+        return(stats)
+
+# Call a describe method for a resource type, through the cache if it is
+# enabled.
+
+    def describe(self, kind, call, **kwargs):
+        if self.cache is None:
+            return(call(**kwargs))
+        key = (call.__name__, repr(sorted(kwargs.items())))
+        return(self.cache.get(kind, key, lambda: call(**kwargs)))
+
+# Drop the cached results of resource types after a change.
+
+    def invalidate(self, *kinds):
+        if self.cache is not None:
+            self.cache.invalidate(*kinds)
+
+# Resolve method. Turns a name into the ID or ARN of a resource. "kind" is
+# one of "albs", "targetgroups", "listeners" (named "<alb name>:<port>"),
+# "instances" (by Name tag) and "subnets" (by Name tag or CIDR block). IDs and
+# ARNs are returned as they are. The first lookup of a type loads every name
+# of that type with one paginated describe, and a name that is not found
+# reloads it once in case the resource was made elsewhere. Returns None, and
+# says why, if the name matches nothing or more than one resource.
+
+    def resolve(self, kind, value):
+        found = self.resolve_all(kind, [value])
+        if len(found) > 1:
+            print("The name {} matches {} {}s: {}".format(
+                value, len(found), KINDNAMES[kind], ", ".join(found)))
+            return(None)
+        return(found[0] if found else None)
+
+# Resolve a list of names, IDs or ARNs of one type. A name that matches
+# several resources gives all of them. Names that match nothing are reported
+# and left out. Returns the list of IDs or ARNs.
+
+    def resolve_all(self, kind, values):
+        found = []
+        for value in values:
+            pattern = IDPATTERNS.get(kind)
+            if value.startswith("arn:") or (pattern and pattern.match(value)):
+                found.append(value)
+                continue
+            fresh = kind not in self.index.loaded
+            if fresh:
+                self.index_kind(kind, value)
+            matches = self.index.get(kind, value)
+            if not matches and not fresh:
+                self.index_kind(kind, value)
+                matches = self.index.get(kind, value)
+            if not matches:
+                print("No {} named {}".format(KINDNAMES[kind], value))
+            found.extend(sorted(matches))
+        return(found)
+
+# Load the names of a resource type into the index with one paginated
+# describe. Listeners are loaded per load balancer, for the one in "name". A
+# failed describe is reported and leaves the index as it was.
+
+    def index_kind(self, kind, name=None):
         try:
-            newsub = self.vpc.create_subnet(
-                CidrBlock=subnetvar,
-                AvailabilityZone=az)
-            self.vpc.create_tags(
-                Resources=[newsub.id],
-                Tags=[{"Key": "Name", "Value": "subnet-{}-{}".format(
-                    newsub.availability_zone[-2:],
-                    newsub.cidr_block.split(".")[2])}])
-            print("\nThe subnet ID created was {}".format(newsub.id))
-            return(newsub.id)
+            self.load_names(kind, name)
         except boto3.exceptions.botocore.client.ClientError as e:
             print(e.response["Error"]["Message"].strip("\""))
 
-# Delete VPC subnet method. Returns the newly-deleted subnet ID.
+    def load_names(self, kind, name):
+        if kind == "listeners":
+            albname = name.rsplit(":", 1)[0]
+            for albarn in self.resolve_all("albs", [albname]):
+                pages = self.elbv2c.get_paginator(
+                    "describe_listeners").paginate(LoadBalancerArn=albarn)
+                for page in pages:
+                    for ln in page["Listeners"]:
+                        self.index.add("listeners", "{}:{}".format(
+                            albname, ln["Port"]), ln["ListenerArn"])
+            self.index.loaded.add(kind)
+            return
+
+        if kind == "albs":
+            pages = self.elbv2c.get_paginator(
+                "describe_load_balancers").paginate()
+            pairs = [(a["LoadBalancerName"], a["LoadBalancerArn"])
+                     for page in pages for a in page["LoadBalancers"]]
+        elif kind == "targetgroups":
+            pages = self.elbv2c.get_paginator(
+                "describe_target_groups").paginate()
+            pairs = [(t["TargetGroupName"], t["TargetGroupArn"])
+                     for page in pages for t in page["TargetGroups"]]
+        elif kind == "instances":
+            pairs = [(tag_name(i), i["InstanceId"]) for i in self.query_inst(
+                states=["pending", "running", "stopping", "stopped"])]
+        elif kind == "subnets":
+            pages = self.ec2c.get_paginator("describe_subnets").paginate()
+            pairs = []
+            for page in pages:
+                for sub in page["Subnets"]:
+                    pairs.append((tag_name(sub), sub["SubnetId"]))
+                    pairs.append((sub["CidrBlock"], sub["SubnetId"]))
+        self.index.load(kind, pairs)
+
+# Drop deleted resources from the name index, and give the CIDR blocks of
+# deleted subnets back to the allocator.
+
+    def unindex(self, kind, values):
+        self.index.discard(kind, values)
+        if kind == "subnets" and self.allocator is not None:
+            for subid in values:
+                self.allocator.release(subid)
+        if kind == "albs":
+            for arn in values:
+                self.index.discard("listeners", prefix=arn.replace(
+                    ":loadbalancer/", ":listener/") + "/")
+
+# CIDR allocator of the VPC (see awscidr.py). Loaded the first time it is
+# needed with the CIDR blocks of the VPC and of its subnets, then kept up to
+# date as subnets are created and deleted through this object.
+
+    def cidr_allocator(self):
+        with self.alloclock:
+            if self.allocator is None:
+                vpc = self.ec2c.describe_vpcs(VpcIds=[self.myvpc])["Vpcs"][0]
+                blocks = [a["CidrBlock"] for a in vpc.get(
+                    "CidrBlockAssociationSet", [])
+                    if a["CidrBlockState"]["State"] == "associated"]
+                pages = self.ec2c.get_paginator("describe_subnets").paginate(
+                    Filters=[{"Name": "vpc-id", "Values": [self.myvpc]}])
+                used = {sub["CidrBlock"]: sub["SubnetId"]
+                        for page in pages for sub in page["Subnets"]}
+                self.allocator = CidrAllocator(
+                    blocks or [vpc["CidrBlock"]], used)
+            return(self.allocator)
+
+# Create VPC subnet method. "subnetvar" is a CIDR block, or a prefix length
+# such as "/24" for the next free block of that size in the VPC. Once the
+# allocator is loaded, given blocks are checked against it before the call.
+# A "/NN" block that AWS says conflicts with a subnet made elsewhere stays
+# marked as used, and the next free block is tried. "tags" is an optional
+# dict of extra tags. Returns the newly-created subnet ID.
+
+    def create_subnet(self, subnetvar, az, tags=None):
+        self.subnetvar = subnetvar
+        self.az = az
+        prefix = subnetvar if subnetvar.startswith("/") else None
+
+        while True:
+            try:
+                if prefix:
+                    net = self.cidr_allocator().allocate(int(prefix[1:]), az)
+                    if net is None:
+                        print("No free {} block left in {}".format(
+                            prefix, self.myvpc))
+                        return(None)
+                    self.subnetvar = subnetvar = str(net)
+                elif self.allocator is not None:
+                    self.allocator.claim(subnetvar, az)
+            except ValueError as e:
+                print(e)
+                return(None)
+            except boto3.exceptions.botocore.client.ClientError as e:
+                print(e.response["Error"]["Message"].strip("\""))
+                return(None)
+
+            newsub = None
+            try:
+                newsub = self.vpc.create_subnet(
+                    CidrBlock=subnetvar,
+                    AvailabilityZone=az,
+                    **self.tag_specs("subnet", tags))
+                if self.allocator is not None:
+                    self.allocator.assign(subnetvar, newsub.id)
+                subname = "subnet-{}-{}".format(
+                    newsub.availability_zone[-2:],
+                    newsub.cidr_block.split(".")[2])
+                self.vpc.create_tags(
+                    Resources=[newsub.id],
+                    Tags=[{"Key": "Name", "Value": subname}])
+                self.invalidate("subnets")
+                self.index.add("subnets", subname, newsub.id)
+                self.index.add("subnets", newsub.cidr_block, newsub.id)
+                print("\nThe subnet ID created was {}".format(newsub.id))
+                return(newsub.id)
+            except boto3.exceptions.botocore.client.ClientError as e:
+                if newsub is not None:
+                    self.invalidate("subnets")
+                conflict = e.response["Error"]["Code"] == \
+                    "InvalidSubnet.Conflict"
+                if self.allocator is not None and newsub is None and \
+                        not conflict:
+                    self.allocator.release(subnetvar)
+                print(e.response["Error"]["Message"].strip("\""))
+                if not (conflict and prefix):
+                    return(None)
+                print("Trying the next free {} block".format(prefix))
+
+# Delete VPC subnet method. The subnet is given by ID, Name tag or CIDR
+# block. Returns the newly-deleted subnet ID.
 
     def delete_subnet(self, subid):
-        self.subid = subid
+        self.subid = subid = self.resolve("subnets", subid)
+        if subid is None:
+            return(None)
 
         try:
             self.ec2c.delete_subnet(SubnetId=subid)
+            self.invalidate("subnets")
+            self.unindex("subnets", [subid])
             print("\nThe subnet {} was deleted.".format(subid))
             return(subid)
         except boto3.exceptions.botocore.client.ClientError as e:
             print(e.response["Error"]["Message"].strip("\""))
 
 # List VPC subnets method. Returns a dict of the subnet ID and corresponding
-# CIDR block.
-
-    def list_subnets_all(self):
-        listsub = self.ec2c.describe_subnets()
-        lsdict = {}
-
-        for sub in listsub["Subnets"]:
-            print(
-                "Subnet ID = {SubnetId} with CIDR of {CidrBlock} in AZ "
-                "{AvailabilityZone} with {AvailableIpAddressCount} "
-                "available IPs".format(**sub))
-            lsdict[sub["SubnetId"]] = sub["CidrBlock"]
+# CIDR block. Like every listing method, it takes an "output" mode (see
+# awsout.py) and writes each page of records as it arrives.
 
-        return(lsdict)
+    def list_subnets_all(self, output=None):
+        return(self.list_subnets(output))
 
 # List subnets for a particular AZ method. Returns a dict of the subnet ID and
 # corresponding CIDR block for the AZ specified.
 
-    def list_subnets_az(self, subaz):
+    def list_subnets_az(self, subaz, output=None):
         self.subaz = subaz
+        return(self.list_subnets(output, Filters=[
+            {"Name": "availabilityZone", "Values": [subaz]}]))
+
+    def list_subnets(self, output, **kwargs):
         lsdict = {}
+        pages = self.describe_pages(
+            "subnets", self.ec2c, "describe_subnets", **kwargs)
 
-        listsubaz = self.ec2c.describe_subnets(
-            Filters=[{"Name": "availabilityZone", "Values": [self.subaz]}])
-
-        for sub in listsubaz["Subnets"]:
-            print(
-                "Subnet ID = {SubnetId} with CIDR of {CidrBlock} in AZ "
-                "{AvailabilityZone} with {AvailableIpAddressCount} "
-                "available IPs".format(**sub))
-            lsdict[sub["SubnetId"]] = sub["CidrBlock"]
+        with self.listing(output, SUBNETFIELDS, SUBNETTEXT) as out:
+            for page in pages:
+                for sub in page["Subnets"]:
+                    out.emit(project(sub, SUBNETFIELDS))
+                    lsdict[sub["SubnetId"]] = sub["CidrBlock"]
 
         return(lsdict)
 
-# Create new EC2 instances method. Returns the newly-created instance ID.
-
-    def create_inst(self, subid, key, instname):
-        self.subid = subid
+# Create new EC2 instances method. The subnet is given by ID, Name tag or
+# CIDR block. "tags" is an optional dict of extra tags, and "insttype"
+# overrides the ec2type setting. A client "token" makes the call idempotent:
+# sent again with the same token, it returns the instance launched the first
+# time instead of launching another. Returns the newly-created instance ID.
+
+    def create_inst(self, subid, key, instname, tags=None, insttype=None,
+                    token=None):
+        self.subid = subid = self.resolve("subnets", subid)
+        if subid is None:
+            return(None)
         self.mykey = key
         self.instname = instname
         # waitrun = self.ec2c.get_waiter("instance_running")
@@ -128,38 +806,116 @@ runcmd:
         try:
             newinst = self.ec2c.run_instances(
                 ImageId=self.myami, MinCount=1,
-                MaxCount=1, KeyName=self.mykey, InstanceType=self.ec2type,
-                SecurityGroupIds=[self.mysg], SubnetId=self.subid,
-                UserData=self.userdata)
-            self.ec2c.create_tags(
-                Resources=[newinst["Instances"][0]["InstanceId"]],
-                Tags=[{"Key": "Name", "Value": instname}])
+                MaxCount=1, KeyName=key,
+                InstanceType=insttype or self.ec2type,
+                SecurityGroupIds=[self.mysg], SubnetId=subid,
+                UserData=self.userdata,
+                TagSpecifications=self.name_tags(instname, tags),
+                **({"ClientToken": token} if token else {}))
+            self.invalidate("instances")
+            self.index.add(
+                "instances", instname, newinst["Instances"][0]["InstanceId"])
             # waitrun.wait(InstanceIds=[newinst["Instances"][0]["InstanceId"]])
             print(
                 "\nThe instance ID created was {} and is named {}".format(
-                    newinst["Instances"][0]["InstanceId"], self.instname))
+                    newinst["Instances"][0]["InstanceId"], instname))
             return(newinst["Instances"][0]["InstanceId"])
         except boto3.exceptions.botocore.client.ClientError as e:
             print(e.response["Error"]["Message"].strip("\""))
 
-# Start and stop EC2 instances methods. Returns the started or stopped
-# instance ID.
+# Create many EC2 instances method. Launches "count" instances spread evenly
+# across the given subnets with one run_instances call per subnet, named at
+# launch time. A subnet that can only take part of its share (for example on
+# InsufficientInstanceCapacity) passes the rest on to the next subnet, until
+# every subnet has been tried with nothing left to add. Subnets are given by
+# ID, Name tag or CIDR block. With a client "token", each run_instances call
+# gets its own token made from it, so the whole launch can be sent again
+# without launching twice. Returns the list of new instance IDs, which may be
+# shorter than "count".
+
+    def create_insts(self, count, subids, key, instname, token=None):
+        subids = self.resolve_all("subnets", subids)
+        if not subids:
+            return([])
+        share, extra = divmod(count, len(subids))
+        wants = [share + (i < extra) for i in range(len(subids))]
+        instids = []
+        carry = 0
+        stalled = 0
+        i = 0
+
+        while (sum(wants) + carry) and stalled < len(subids):
+            n = i % len(subids)
+            want = wants[n] + carry
+            wants[n] = 0
+            i += 1
+            if not want:
+                continue
+            got = []
+            try:
+                newinst = self.ec2c.run_instances(
+                    ImageId=self.myami, MinCount=1, MaxCount=want,
+                    KeyName=key, InstanceType=self.ec2type,
+                    SecurityGroupIds=[self.mysg], SubnetId=subids[n],
+                    UserData=self.userdata,
+                    TagSpecifications=self.name_tags(instname),
+                    **({"ClientToken": "{}-{}".format(token, i)}
+                       if token else {}))
+                got = [inst["InstanceId"] for inst in newinst["Instances"]]
+            except boto3.exceptions.botocore.client.ClientError as e:
+                print("Subnet {}: {}".format(
+                    subids[n], e.response["Error"]["Message"].strip("\"")))
+            instids.extend(got)
+            self.invalidate("instances")
+            for instid in got:
+                self.index.add("instances", instname, instid)
+            carry = want - len(got)
+            stalled = stalled + 1 if carry and not got else 0
+
+        print(
+            "\nLaunched {} of {} instances named {}".format(
+                len(instids), count, instname))
+        return(instids)
+
+# Tag specification that names instances at launch, with any extra tags.
+
+    def name_tags(self, name, tags=None):
+        return([{"ResourceType": "instance",
+                 "Tags": [{"Key": "Name", "Value": name}] + tag_list(tags)}])
+
+# TagSpecifications argument of an EC2 create call for a dict of tags, or no
+# argument at all if there are none.
+
+    def tag_specs(self, restype, tags):
+        if not tags:
+            return({})
+        return({"TagSpecifications": [
+            {"ResourceType": restype, "Tags": tag_list(tags)}]})
+
+# Start and stop EC2 instances methods. The instance is given by ID or Name
+# tag. Returns the started or stopped instance ID.
 
     def start_inst(self, instid):
-        self.instid = instid
+        self.instid = instid = self.resolve("instances", instid)
+        if instid is None:
+            return(None)
 
         try:
-            self.ec2c.start_instances(InstanceIds=[self.instid])
-            print("Started instance {}".format(self.instid))
+            self.ec2c.start_instances(InstanceIds=[instid])
+            self.invalidate("instances")
+            print("Started instance {}".format(instid))
             return(instid)
         except boto3.exceptions.botocore.client.ClientError as e:
             print(e.response["Error"]["Message"].strip("\""))
 
     def stop_inst(self, instid):
-        self.instid = instid
+        self.instid = instid = self.resolve("instances", instid)
+        if instid is None:
+            return(None)
 
         try:
             self.ec2c.stop_instances(InstanceIds=[instid])
+            self.invalidate("instances")
             print("Stopped instance {}".format(instid))
             return(instid)
         except boto3.exceptions.botocore.client.ClientError as e:
@@ -169,11 +925,15 @@ runcmd:
 # waiter to wait for the instance to be fully terminated before continuing.
 
     def term_inst(self, instid):
-        self.instid = instid
+        self.instid = instid = self.resolve("instances", instid)
+        if instid is None:
+            return(None)
 
         try:
             self.ec2c.terminate_instances(InstanceIds=[instid])
-            print("\nWaiting on instance {} to terminate").format(instid)
+            self.invalidate("instances")
+            self.unindex("instances", [instid])
+            print("\nWaiting on instance {} to terminate".format(instid))
             waitterm = self.ec2c.get_waiter("instance_terminated")
             waitterm.wait(InstanceIds=[instid])
             print("\nTerminated instance {}".format(instid))
@@ -181,157 +941,586 @@ runcmd:
         except boto3.exceptions.botocore.client.ClientError as e:
             print(e.response["Error"]["Message"].strip("\""))
 
+# Bulk start, stop and terminate EC2 instances methods. Any number of
+# instance IDs or Name tags can be given (a name stands for every instance
+# carrying it). They are sent in chunks of up to MAXIDS per call,
+# with all the chunks issued at the same time. With wait=True, one shared
+# poller waits for every instance to reach its final state. Returns the list
+# of instance IDs that AWS accepted.
+
+    def start_insts(self, instids, wait=False):
+        done = self.bulk_inst(self.ec2c.start_instances, instids, "Started")
+        if wait:
+            self.wait_insts(done, "running")
+        return(done)
+
+    def stop_insts(self, instids, wait=False):
+        done = self.bulk_inst(self.ec2c.stop_instances, instids, "Stopped")
+        if wait:
+            self.wait_insts(done, "stopped")
+        return(done)
+
+    def term_insts(self, instids, wait=True):
+        done = self.bulk_inst(
+            self.ec2c.terminate_instances, instids, "Terminated")
+        if wait:
+            self.wait_insts(done, "terminated")
+        return(done)
+
+# Send one start/stop/terminate call per chunk of instance IDs, all at once.
+# A chunk that fails is reported and left out of the returned list.
+
+    def bulk_inst(self, call, instids, verb):
+        def send(chunk):
+            try:
+                call(InstanceIds=chunk)
+                self.invalidate("instances")
+                if verb == "Terminated":
+                    self.unindex("instances", chunk)
+                return(chunk)
+            except boto3.exceptions.botocore.client.ClientError as e:
+                print(e.response["Error"]["Message"].strip("\""))
+                return([])
+
+        instids = self.resolve_all("instances", instids)
+        chunks = [instids[i:i + MAXIDS]
+                  for i in range(0, len(instids), MAXIDS)]
+        done = []
+        if chunks:
+            with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+                for chunk in pool.map(send, chunks):
+                    done.extend(chunk)
+        print("{} {} of {} instances".format(verb, len(done), len(instids)))
+        return(done)
+
+# Wait for instances method. Polls with one describe_instances call per chunk
+# of instance IDs until every instance has reached the given state. Instances
+# that are no longer returned count as terminated. Returns the list of
+# instance IDs that reached the state.
+
+    def wait_insts(self, instids, state, delay=2, timeout=900, maxdelay=15):
+        check, waiting, reached = self.inst_check(instids, state)
+        return(self.wait_for("instances", state, check, waiting, reached,
+                             delay, timeout, maxdelay))
+
+# Build the check for wait_insts(). Returns the check function with the set
+# of instance IDs still waiting and the list of those that reached the state,
+# both of which it updates each time it is called.
+
+    def inst_check(self, instids, state):
+        waiting = set(instids)
+        reached = []
+
+        def check():
+            seen = set()
+            todo = sorted(waiting)
+            for i in range(0, len(todo), MAXFILTER):
+                pages = self.ec2c.get_paginator(
+                    "describe_instances").paginate(
+                        Filters=[{"Name": "instance-id",
+                                  "Values": todo[i:i + MAXFILTER]}])
+                for page in pages:
+                    for res in page["Reservations"]:
+                        for inst in res["Instances"]:
+                            seen.add(inst["InstanceId"])
+                            if inst["State"]["Name"] == state:
+                                waiting.discard(inst["InstanceId"])
+                                reached.append(inst["InstanceId"])
+            for instid in waiting - seen:
+                waiting.discard(instid)
+                if state == "terminated":
+                    reached.append(instid)
+                else:
+                    print("Instance {} was not found".format(instid))
+            return(not waiting)
+
+        return(check, waiting, reached)
+
+# Run a wait with the check built by one of the *_check() methods, and print
+# how it went. Returns the list of items that reached the state.
+
+    def wait_for(self, what, state, check, waiting, reached, delay, timeout,
+                 maxdelay):
+        print("\nWaiting on {} {} to reach {}".format(
+            len(waiting), what, state))
+        if not self.poll(check, delay, timeout, maxdelay):
+            print("Timed out with {} {} not {}: {}".format(
+                len(waiting), what, state, ", ".join(sorted(waiting))))
+        print("{} {} are {}".format(len(reached), what, state))
+        return(reached)
+
+# Poll method. Calls check() until it returns True or the timeout runs out.
+# The first wait is "delay" seconds and each wait after that is "backoff"
+# times longer, up to "maxdelay", so short waits finish quickly without
+# long ones making too many calls. Returns the last result of check().
+
+    def poll(self, check, delay=2, timeout=900, maxdelay=15, backoff=1.5):
+        end = time.monotonic() + timeout
+        while not check():
+            left = end - time.monotonic()
+            if left <= 0:
+                return(False)
+            time.sleep(min(delay, left))
+            delay = min(maxdelay, delay * backoff)
+        return(True)
+
 # List EC2 instances method. Returns a dict of the instance ID with
 # corresponding name.
 
-    def list_inst(self):
-        listinst = self.ec2c.describe_instances()
+    def list_inst(self, states=None, tags=None, subnets=None, azs=None,
+                  output=None):
         dcinst = {}
-        for res in listinst["Reservations"]:
-            for inst in res["Instances"]:
-                print(
-                    "ID: {InstanceId} Type: {InstanceType} Name: "
-                    "{Tags[0][Value]} State: {State[Name]}".format(**inst))
-                dcinst.update(
-                    {inst["Tags"][0]["Value"]: inst["State"]["Name"]})
+        with self.listing(output, INSTFIELDS, INSTTEXT) as out:
+            for inst in self.query_inst(states, tags, subnets, azs):
+                name = tag_name(inst)
+                out.emit({"InstanceId": inst["InstanceId"],
+                          "InstanceType": inst["InstanceType"],
+                          "Name": name, "State": inst["State"]["Name"]})
+                dcinst[inst["InstanceId"]] = name
         return(dcinst)
 
-# Rename an EC2 instance method. Returns the instance ID that was renamed.
+# Query EC2 instances method. Yields the instances matching every filter
+# given, one at a time. States, tags (a dict of tag key to value or list of
+# values), subnets and AZs are sent to AWS as describe filters, and the
+# results are read one page at a time, so a large fleet streams in constant
+# memory. With "fields", each record is a dict of just those dotted paths
+# (see project()). Otherwise it is the full instance dict.
+
+    def query_inst(self, states=None, tags=None, subnets=None, azs=None,
+                   fields=None, pagesize=1000):
+        filters = []
+        for name, values in (("instance-state-name", states),
+                             ("subnet-id", subnets),
+                             ("availability-zone", azs)):
+            if values:
+                filters.append({"Name": name, "Values": listify(values)})
+        for key, values in (tags or {}).items():
+            filters.append({"Name": "tag:{}".format(key),
+                            "Values": listify(values)})
+
+        pages = self.describe_pages(
+            "instances", self.ec2c, "describe_instances", Filters=filters,
+            PaginationConfig={"PageSize": pagesize})
+        for page in pages:
+            for res in page["Reservations"]:
+                for inst in res["Instances"]:
+                    yield(project(inst, fields) if fields else inst)
+
+# Page through a describe call for a resource type. Without the cache the
+# pages are fetched lazily; with it the whole list of pages is cached.
+
+    def describe_pages(self, kind, client, opname, **kwargs):
+        pages = client.get_paginator(opname).paginate(**kwargs)
+        if self.cache is None:
+            return(pages)
+        key = (opname, repr(sorted(kwargs.items())))
+        return(self.cache.get(kind, key, lambda: list(pages)))
+
+# Rename an EC2 instance method. The instance is given by ID or Name tag.
+# Returns the instance ID that was renamed.
 
     def ren_inst(self, instid, newname):
-        self.instid = instid
+        self.instid = instid = self.resolve("instances", instid)
         self.newname = newname
+        if instid is None:
+            return(None)
 
         try:
             self.ec2c.create_tags(
                 Resources=[instid],
                 Tags=[{"Key": "Name", "Value": newname}])
+            self.invalidate("instances")
+            self.unindex("instances", [instid])
+            self.index.add("instances", newname, instid)
             print("The instance was renamed to {}".format(newname))
             return(instid)
         except boto3.exceptions.botocore.client.ClientError as e:
             print(e.response["Error"]["Message"].strip("\""))
 
-# Create an Application Load Balancer method. Returns the DNS name of the
-# newly-created Application Load Balancer.
+# Change the type or the state ("running" or "stopped") of an EC2 instance
+# method. The instance is given by ID or Name tag. The type can only be
+# changed while the instance is stopped, so it is stopped first, and started
+# again afterwards unless state="stopped". Returns the instance ID.
 
-    def create_alb(self, albname, sub1, sub2, sub3, tgarn):
-        self.albname = albname
-        self.sub1 = sub1
-        self.sub2 = sub2
-        self.sub3 = sub3
-        self.tgarn = tgarn
+    def modify_inst(self, instid, insttype=None, state=None):
+        self.instid = instid = self.resolve("instances", instid)
+        if instid is None:
+            return(None)
+
+        try:
+            inst = self.ec2c.describe_instances(InstanceIds=[instid])[
+                "Reservations"][0]["Instances"][0]
+            now = inst["State"]["Name"]
+            state = state or ("stopped" if now in ("stopping", "stopped")
+                              else "running")
+            if insttype and insttype != inst["InstanceType"]:
+                if now in ("pending", "running"):
+                    self.ec2c.stop_instances(InstanceIds=[instid])
+                if now != "stopped":
+                    self.wait_insts([instid], "stopped")
+                now = "stopped"
+                self.ec2c.modify_instance_attribute(
+                    InstanceId=instid, InstanceType={"Value": insttype})
+                print("Instance {} is now {}".format(instid, insttype))
+            if state == "running" and now in ("stopping", "stopped"):
+                self.ec2c.start_instances(InstanceIds=[instid])
+                print("Started instance {}".format(instid))
+            elif state == "stopped" and now in ("pending", "running"):
+                self.ec2c.stop_instances(InstanceIds=[instid])
+                print("Stopped instance {}".format(instid))
+            self.invalidate("instances")
+            return(instid)
+        except boto3.exceptions.botocore.client.ClientError as e:
+            print(e.response["Error"]["Message"].strip("\""))
+
+# Create an Application Load Balancer method. The subnets can be given by
+# ID, Name tag or CIDR block and the target group by name or ARN. "tags" is an
+# optional dict of tags. Returns the DNS name of the newly-created
+# Application Load Balancer.
 
-        # tgarn = self.elbv2c.describe_target_groups(
-        # Names=[tgname])["TargetGroups"][0]["TargetGroupArn"]
+    def create_alb(self, albname, sub1, sub2, sub3, tgarn, wait=False,
+                   tags=None):
+        self.albname = albname
+        self.sub1 = sub1 = self.resolve("subnets", sub1)
+        self.sub2 = sub2 = self.resolve("subnets", sub2)
+        self.sub3 = sub3 = self.resolve("subnets", sub3)
+        self.tgarn = tgarn = self.resolve("targetgroups", tgarn)
+        if None in (sub1, sub2, sub3, tgarn):
+            return(None)
 
         try:
             newalb = self.elbv2c.create_load_balancer(
                 Name=albname,
                 Subnets=[sub1, sub2, sub3], SecurityGroups=[self.mysg],
-                Scheme="internet-facing", IpAddressType="ipv4")
-            self.elbv2c.create_listener(
-                LoadBalancerArn=newalb["LoadBalancers"][0]["LoadBalancerArn"],
+                Scheme="internet-facing", IpAddressType="ipv4",
+                **({"Tags": tag_list(tags)} if tags else {}))
+            self.invalidate("albs")
+            albarn = newalb["LoadBalancers"][0]["LoadBalancerArn"]
+            self.index.add("albs", albname, albarn)
+            listener = self.elbv2c.create_listener(
+                LoadBalancerArn=albarn,
                 Protocol="HTTP", Port=80,
                 DefaultActions=[{"Type": "forward", "TargetGroupArn": tgarn}])
+            self.index.add("listeners", albname + ":80",
+                           listener["Listeners"][0]["ListenerArn"])
             print(
                 "ALB created. The DNS name is {}".format(
                     newalb["LoadBalancers"][0]["DNSName"]))
+            if wait:
+                self.wait_albs([albname], "active")
             return(newalb["LoadBalancers"][0]["DNSName"])
         except boto3.exceptions.botocore.client.ClientError as e:
             print(e.response["Error"]["Message"].strip("\""))
 
+# Change an Application Load Balancer method. The load balancer is given by
+# name or ARN. "subnets" replaces its subnets (by ID, Name tag or CIDR
+# block), and "tgarn" the target group (by name or ARN) that its port 80
+# listener forwards to. Returns the ARN of the Application Load Balancer.
+
+    def set_alb(self, albname, subnets=None, tgarn=None):
+        self.albname = albname
+        albarn = self.resolve("albs", albname)
+        subids = self.resolve_all("subnets", subnets or [])
+        if albarn is None or len(subids) != len(subnets or []):
+            return(None)
+        if tgarn:
+            tgarn = self.resolve("targetgroups", tgarn)
+            if tgarn is None:
+                return(None)
+
+        try:
+            if subids:
+                self.elbv2c.set_subnets(LoadBalancerArn=albarn,
+                                        Subnets=subids)
+                self.invalidate("albs")
+                print("ALB {} now uses subnets {}".format(
+                    albname, ", ".join(subids)))
+            if tgarn:
+                action = [{"Type": "forward", "TargetGroupArn": tgarn}]
+                listeners = self.elbv2c.describe_listeners(
+                    LoadBalancerArn=albarn)["Listeners"]
+                ports = {ln["Port"]: ln["ListenerArn"] for ln in listeners}
+                if 80 in ports:
+                    self.elbv2c.modify_listener(ListenerArn=ports[80],
+                                                DefaultActions=action)
+                else:
+                    self.elbv2c.create_listener(
+                        LoadBalancerArn=albarn, Protocol="HTTP", Port=80,
+                        DefaultActions=action)
+                self.invalidate("targetgroups")
+                print("ALB {} now forwards to {}".format(albname, tgarn))
+            return(albarn)
+        except boto3.exceptions.botocore.client.ClientError as e:
+            print(e.response["Error"]["Message"].strip("\""))
+
 # List Application Load Balancers method. Returns a dict of the ALB Name with
 # its DNS name.
 
-    def list_alb(self):
-        listalb = self.elbv2c.describe_load_balancers()
+    def list_alb(self, output=None):
+        pages = self.describe_pages(
+            "albs", self.elbv2c, "describe_load_balancers")
         ladict = {}
 
-        for alb in listalb["LoadBalancers"]:
-            print(
-                "LB Name = {LoadBalancerName}  "
-                "DNS Name = {DNSName}".format(**alb))
-            ladict[alb["LoadBalancerName"]] = alb["DNSName"]
+        with self.listing(output, ALBFIELDS, ALBTEXT) as out:
+            for page in pages:
+                for alb in page["LoadBalancers"]:
+                    out.emit({"LoadBalancerName": alb["LoadBalancerName"],
+                              "DNSName": alb["DNSName"],
+                              "State": alb["State"]["Code"]})
+                    ladict[alb["LoadBalancerName"]] = alb["DNSName"]
 
         return(ladict)
 
-# Delete an Application Load Balancer method. Returns the ARN of the deleted
-# Application Load Balancer.
+# Delete an Application Load Balancer method. The load balancer is given by
+# name or ARN. Returns the ARN of the deleted Application Load Balancer.
 
-    def delete_alb(self, albname):
+    def delete_alb(self, albname, wait=False):
         self.albname = albname
 
-        albarn = self.elbv2c.describe_load_balancers(
-                 Names=[albname])["LoadBalancers"][0]["LoadBalancerArn"]
+        albarn = self.resolve("albs", albname)
+        if albarn is None:
+            return(None)
 
         try:
             self.elbv2c.delete_load_balancer(LoadBalancerArn=albarn)
+            self.invalidate("albs", "targetgroups")
+            self.unindex("albs", [albarn])
             print("ALB {} deleted.".format(albname))
+            if wait:
+                self.wait_albs([albarn], "deleted")
             return(albarn)
         except boto3.exceptions.botocore.client.ClientError as e:
             print(e.response["Error"]["Message"].strip("\""))
 
-# Create an ALB target group method. Returns the ARN of the newly-created
-# ALB target group.
-
-    def create_target_group(self, tgname, inst1, inst2, inst3):
+# Wait for load balancers method. Waits until every load balancer (by name or
+# ARN) is "active", or is "deleted". Each check describes only the load
+# balancers still waiting, MAXELBV2 per call. Returns the list of load
+# balancers that reached the state.
+
+    def wait_albs(self, albs, state="active", delay=2, timeout=900,
+                  maxdelay=15):
+        check, waiting, reached = self.alb_check(albs, state)
+        return(self.wait_for("load balancers", state, check, waiting,
+                             reached, delay, timeout, maxdelay))
+
+# Build the check for wait_albs(). A load balancer that fails to provision
+# is reported and dropped from the wait. One that is not found yet while
+# waiting for "active" is still waited on, as new load balancers can take a
+# moment to show up.
+
+    def alb_check(self, albs, state):
+        waiting = set(albs)
+        reached = []
+
+        def check():
+            found = self.describe_elbv2(
+                self.elbv2c.describe_load_balancers, "LoadBalancers",
+                "LoadBalancerArns", "LoadBalancerName", "LoadBalancerArn",
+                waiting)
+            for alb in list(waiting):
+                code = found[alb]["State"]["Code"] if alb in found \
+                    else "deleted"
+                if code == state:
+                    waiting.discard(alb)
+                    reached.append(alb)
+                elif code == "failed":
+                    waiting.discard(alb)
+                    print("Load balancer {} failed".format(alb))
+            return(not waiting)
+
+        return(check, waiting, reached)
+
+# Describe load balancers or target groups given by name or ARN, with one
+# "call" per MAXELBV2 of them. A call fails as a whole if one of them does not
+# exist, so such a chunk is described again one at a time. Returns a dict of
+# the name and the ARN of each one found to its record.
+
+    def describe_elbv2(self, call, listkey, arnsarg, namekey, arnkey, items):
+        arns = sorted(i for i in items if i.startswith("arn:"))
+        names = sorted(i for i in items if not i.startswith("arn:"))
+        chunks = [(arnsarg, arns[i:i + MAXELBV2])
+                  for i in range(0, len(arns), MAXELBV2)]
+        chunks += [("Names", names[i:i + MAXELBV2])
+                   for i in range(0, len(names), MAXELBV2)]
+        found = {}
+        while chunks:
+            arg, chunk = chunks.pop()
+            try:
+                records = call(**{arg: chunk})[listkey]
+            except boto3.exceptions.botocore.client.ClientError as e:
+                if e.response["Error"]["Code"] not in NOTFOUND:
+                    raise
+                if len(chunk) > 1:
+                    chunks += [(arg, [item]) for item in chunk]
+                continue
+            for record in records:
+                found[record[namekey]] = record
+                found[record[arnkey]] = record
+        return(found)
+
+# Create an ALB target group method. The instances, any number of them, are
+# given by ID or Name tag. "tags" is an optional dict of tags. Returns the
+# ARN of the newly-created ALB target group.
+
+    def create_target_group(self, tgname, *insts, tags=None):
         self.tgname = tgname
-        self.inst1 = inst1
-        self.inst2 = inst2
-        self.inst3 = inst3
+        self.insts = insts = [self.resolve("instances", i) for i in insts]
+        if None in insts:
+            return(None)
 
         try:
-            print("Waiting for instances to start")
-            waitrun = self.ec2c.get_waiter("instance_running")
-            waitrun.wait(InstanceIds=[inst1, inst2, inst3])
+            if insts:
+                print("Waiting for instances to start")
+                waitrun = self.ec2c.get_waiter("instance_running")
+                waitrun.wait(InstanceIds=insts)
             newtg = self.elbv2c.create_target_group(
                 Name=tgname,
-                Protocol="HTTP", Port=80, VpcId=self.myvpc)
+                Protocol="HTTP", Port=80, VpcId=self.myvpc,
+                **({"Tags": tag_list(tags)} if tags else {}))
+            self.invalidate("targetgroups")
             tgarn = newtg["TargetGroups"][0]["TargetGroupArn"]
-            self.elbv2c.register_targets(
-                TargetGroupArn=tgarn,
-                Targets=[{"Id": inst1}, {"Id": inst2}, {"Id": inst3}])
+            self.index.add("targetgroups", tgname, tgarn)
+            if insts:
+                self.elbv2c.register_targets(
+                    TargetGroupArn=tgarn,
+                    Targets=[{"Id": instid} for instid in insts])
             print(
                 "Target group created. The target group name is {}".format(
                     newtg["TargetGroups"][0]["TargetGroupName"]))
+            return(tgarn)
         except boto3.exceptions.botocore.client.ClientError as e:
             print(e.response["Error"]["Message"].strip("\""))
 
-        return(tgarn)
+# List ALB target groups method. Returns a dict of each target group name with
+# its ARN.
 
-# List ALB target groups method
+    def list_target_groups(self, output=None):
+        pages = self.describe_pages(
+            "targetgroups", self.elbv2c, "describe_target_groups")
+        tgdict = {}
 
-    def list_target_groups(self):
-        listtg = self.elbv2c.describe_target_groups()
+        with self.listing(output, TGFIELDS, TGTEXT) as out:
+            for page in pages:
+                for tg in page["TargetGroups"]:
+                    out.emit(project(tg, TGFIELDS))
+                    tgdict[tg["TargetGroupName"]] = tg["TargetGroupArn"]
 
-        for tg in listtg["TargetGroups"]:
-            print(
-                "TG Name = {TargetGroupName}  "
-                "ARN = {TargetGroupArn}".format(**tg))
+        return(tgdict)
+
+# Set the targets of an ALB target group method. The target group is given
+# by name or ARN and the instances by ID or Name tag. Instances that are not
+# targets yet are registered once they are running, and targets that are not
+# in the list are deregistered. Returns the ARN of the target group.
+
+    def set_targets(self, tgname, insts):
+        self.tgname = tgname
+        tgarn = self.resolve("targetgroups", tgname)
+        insts = [self.resolve("instances", i) for i in insts]
+        if tgarn is None or None in insts:
+            return(None)
+
+        try:
+            health = self.elbv2c.describe_target_health(TargetGroupArn=tgarn)
+            have = {t["Target"]["Id"]
+                    for t in health["TargetHealthDescriptions"]
+                    if t["TargetHealth"]["State"] != "draining"}
+            add = [i for i in insts if i not in have]
+            drop = sorted(have - set(insts))
+            if add:
+                waitrun = self.ec2c.get_waiter("instance_running")
+                waitrun.wait(InstanceIds=add)
+                self.elbv2c.register_targets(
+                    TargetGroupArn=tgarn,
+                    Targets=[{"Id": instid} for instid in add])
+            if drop:
+                self.elbv2c.deregister_targets(
+                    TargetGroupArn=tgarn,
+                    Targets=[{"Id": instid} for instid in drop])
+            print("Target group {}: {} registered, {} deregistered".format(
+                tgname, len(add), len(drop)))
+            return(tgarn)
+        except boto3.exceptions.botocore.client.ClientError as e:
+            print(e.response["Error"]["Message"].strip("\""))
 
-# Delete ALB target group method. Returns the ARN of the deleted ALB target
-# group.
+# Delete ALB target group method. The target group is given by name or ARN.
+# Returns the ARN of the deleted ALB target group.
 
     def delete_target_group(self, tgname):
         self.tgname = tgname
 
-        tgarn = self.elbv2c.describe_target_groups(
-            Names=[tgname])["TargetGroups"][0]["TargetGroupArn"]
+        tgarn = self.resolve("targetgroups", tgname)
+        if tgarn is None:
+            return(None)
 
         try:
             self.elbv2c.delete_target_group(TargetGroupArn=tgarn)
+            self.invalidate("targetgroups")
+            self.unindex("targetgroups", [tgarn])
             print("Target group {} deleted.".format(tgname))
             return(tgarn)
         except boto3.exceptions.botocore.client.ClientError as e:
             print(e.response["Error"]["Message"].strip("\""))
 
-# Create a key pair method. Prints the key and returns the key name.
-
-    def create_keypair(self, keyname):
+# Wait for target groups method. Target groups are given by name or ARN, and
+# the states are:
+#
+#   free     - no longer used by any load balancer, so it can be deleted
+#   drained  - no target is still draining its connections
+#   healthy  - it has targets and all of them are healthy
+#
+# Each check describes only the target groups still waiting, MAXELBV2 per
+# describe_target_groups call, plus one describe_target_health call per
+# target group still waiting for "drained" or "healthy". Returns the list of
+# target groups that reached the state.
+
+    def wait_tgs(self, tgs, state="free", delay=2, timeout=900, maxdelay=15):
+        check, waiting, reached = self.tg_check(tgs, state)
+        return(self.wait_for("target groups", state, check, waiting,
+                             reached, delay, timeout, maxdelay))
+
+# Build the check for wait_tgs(). A target group that no longer exists counts
+# as free and drained.
+
+    def tg_check(self, tgs, state):
+        waiting = set(tgs)
+        reached = []
+
+        def done(tg):
+            if tg is None:
+                return(state != "healthy")
+            if state == "free":
+                return(not tg["LoadBalancerArns"])
+            health = self.elbv2c.describe_target_health(
+                TargetGroupArn=tg["TargetGroupArn"])
+            states = [t["TargetHealth"]["State"]
+                      for t in health["TargetHealthDescriptions"]]
+            if state == "drained":
+                return("draining" not in states)
+            return(bool(states) and set(states) == {"healthy"})
+
+        def check():
+            found = self.describe_elbv2(
+                self.elbv2c.describe_target_groups, "TargetGroups",
+                "TargetGroupArns", "TargetGroupName", "TargetGroupArn",
+                waiting)
+            for tg in list(waiting):
+                if done(found.get(tg)):
+                    waiting.discard(tg)
+                    reached.append(tg)
+            return(not waiting)
+
+        return(check, waiting, reached)
+
+# Create a key pair method. "tags" is an optional dict of tags. Prints the
+# key and returns the key name.
+
+    def create_keypair(self, keyname, tags=None):
         self.keyname = keyname
 
         try:
-            key = self.ec2c.create_key_pair(KeyName=keyname)
+            key = self.ec2c.create_key_pair(
+                KeyName=keyname, **self.tag_specs("key-pair", tags))
+            self.invalidate("keypairs")
             print("\nKey pair created. The following is the key:\n")
             print(key["KeyMaterial"])
             return(key["KeyName"])
@@ -341,15 +1530,14 @@ runcmd:
 # List key pairs method. Returns a dict of each key name with its corresponding
 # fingerprint.
 
-    def list_keypair(self):
-        listkey = self.ec2c.describe_key_pairs()
+    def list_keypair(self, output=None):
+        listkey = self.describe("keypairs", self.ec2c.describe_key_pairs)
         dckey = {}
 
-        for key in listkey["KeyPairs"]:
-            print(
-                "Key pair = {KeyName}, "
-                "fingerprint = {KeyFingerprint}".format(**key))
-            dckey[key["KeyName"]] = key["KeyFingerprint"]
+        with self.listing(output, KEYFIELDS, KEYTEXT) as out:
+            for key in listkey["KeyPairs"]:
+                out.emit(project(key, KEYFIELDS))
+                dckey[key["KeyName"]] = key["KeyFingerprint"]
 
         return(dckey)
 
@@ -360,6 +1548,7 @@ runcmd:
 
         try:
             self.ec2c.delete_key_pair(KeyName=keyname)
+            self.invalidate("keypairs")
             print("\nThe key pair {} was deleted.".format(keyname))
             return(keyname)
         except boto3.exceptions.botocore.client.ClientError as e:
@@ -374,6 +1563,7 @@ runcmd:
             newbuck = self.s3c.create_bucket(
                 Bucket=buckname,
                 CreateBucketConfiguration={"LocationConstraint": self.region})
+            self.invalidate("buckets")
             print(
                 "\nBucket {Location} was created successfully.".format(
                     **newbuck))
@@ -383,13 +1573,23 @@ runcmd:
         except boto3.exceptions.botocore.client.ClientError as e:
             print(e.response["Error"]["Message"].strip("\""))
 
-# Delete S3 bucket method. Returns the name of the deleted S3 bucket.
+# Delete S3 bucket method. Returns the name of the deleted S3 bucket. With
+# force=True every object version in the bucket is deleted first (see
+# empty_bucket() below), and the bucket is only deleted if that worked.
 
-    def delete_bucket(self, buckname):
+    def delete_bucket(self, buckname, force=False, workers=16):
         self.buckname = buckname
 
+        if force:
+            stats = self.empty_bucket(buckname, workers=workers)
+            if stats["errors"] or not stats["complete"]:
+                print("Bucket {} was not emptied, so it was not "
+                      "deleted.".format(buckname))
+                return(None)
+
         try:
             self.s3c.delete_bucket(Bucket=buckname)
+            self.invalidate("buckets")
             print("Bucket {} was deleted successfully.".format(buckname))
             return(buckname)
         except boto3.exceptions.botocore.exceptions.ParamValidationError as e:
@@ -399,23 +1599,735 @@ runcmd:
 
 # List S3 buckets method. Returns a list of all buckets.
 
-    def list_buckets(self):
-        listbuck = self.s3r.buckets.all()
+    def list_buckets(self, output=None):
+        listbuck = self.describe("buckets", self.s3c.list_buckets)
         lb = []
-        print("\nList of buckets:")
-        for b in listbuck:
-            print(b.name)
-            lb.append(b.name)
-        print("\nNumber of buckets: {}".format(len(lb)))
+        with self.listing(output, BUCKFIELDS, BUCKTEXT,
+                          "\nList of buckets:") as out:
+            for b in listbuck["Buckets"]:
+                out.emit({"Name": b["Name"],
+                          "CreationDate": b["CreationDate"]})
+                lb.append(b["Name"])
+            out.note("\nNumber of buckets: {}".format(len(lb)))
         return(lb)
 
-# List S3 files method. Returns a dict of each file and corresponding bucket.
+# List S3 files method. Returns a dict of each bucket with the list of files
+# in it.
 
-    def list_files(self):
+    def list_files(self, split=False, workers=16, output=None):
         lsdict = {}
-        listfile = self.s3r.buckets.all()
-        for buck in listfile:
-            for obj in buck.objects.all():
-                print("Bucket: {0}  File: {1}".format(buck.name, obj.key))
-                lsdict[buck.name] = obj.key
+        stats = {}
+        with self.listing(output, FILEFIELDS, FILETEXT) as out:
+            for row in self.list_objects(split=split, workers=workers,
+                                         report=False, stats=stats):
+                out.emit_row(row)
+                lsdict.setdefault(row[0], []).append(row[1])
+            out.note(LISTSUMMARY.format(**stats))
         return(lsdict)
+
+# Concurrent S3 object listing method. Yields a (bucket, key, size, etag,
+# last_modified) tuple for every object. See list_objects() below, which
+# fills in the "stats" dict if one is passed in.
+
+    def list_objects(self, buckets=None, prefix="", split=False, workers=16,
+                     report=True, stats=None):
+        return(list_objects(
+            self.s3c, buckets=buckets, prefix=prefix, split=split,
+            workers=workers, stats=stats, report=report))
+
+# Empty S3 bucket method. Deletes every object version and delete marker in
+# the bucket with batched DeleteObjects calls. Returns the stats dict of
+# empty_bucket() below.
+
+    def empty_bucket(self, buckname, workers=16):
+        stats = {}
+        empty_bucket(self.s3c, buckname, workers=workers, stats=stats)
+        return(stats)
+
+# Upload and download S3 file methods. Large files are moved in parts, up to
+# "workers" at a time, straight from or into a memory-mapped copy of the
+# local file. "partsize" (bytes) and "workers" default to the part_size and
+# transfer_workers settings. Return the key or path, or None on failure. The
+# throughput stats are stored in the "stats" dict, if one is passed in.
+
+    def upload_file(self, path, buckname, key=None, partsize=None,
+                    workers=None, stats=None):
+        return(upload_file(
+            self.s3c, path, buckname, key or os.path.basename(path),
+            partsize or self.partsize, workers or self.xferworkers,
+            stats=stats))
+
+    def download_file(self, buckname, key, path=None, partsize=None,
+                      workers=None, stats=None):
+        return(download_file(
+            self.s3c, buckname, key, path or os.path.basename(key),
+            partsize or self.partsize, workers or self.xferworkers,
+            stats=stats))
+
+# Sync a local directory to an S3 bucket prefix method. Only new and changed
+# files are uploaded, "workers" files at a time. With delete=True, keys under
+# the prefix that have no local file are deleted. Returns the stats dict of
+# sync() below.
+
+    def sync(self, localdir, buckname, prefix="", delete=False, workers=8,
+             dryrun=False):
+        return(sync(self.s3c, localdir, buckname, prefix=prefix,
+                    delete=delete, workers=workers, partsize=self.partsize,
+                    partworkers=self.xferworkers, dryrun=dryrun))
+
+
+# Describe calls behind Aws.inventory(). Each one takes an Aws() object and
+# returns a list of dicts with the Id, Name and Detail of every resource of
+# its type in that object's region.
+
+INVENTORY = {
+    "instances": lambda aws: [
+        {"Id": i["InstanceId"], "Name": tag_name(i),
+         "Detail": "{} {}".format(i["State"]["Name"], i["InstanceType"])}
+        for i in aws.query_inst()],
+    "subnets": lambda aws: [
+        {"Id": s["SubnetId"], "Name": tag_name(s),
+         "Detail": "{} {}".format(s["CidrBlock"], s["AvailabilityZone"])}
+        for page in aws.describe_pages(
+            "subnets", aws.ec2c, "describe_subnets")
+        for s in page["Subnets"]],
+    "albs": lambda aws: [
+        {"Id": a["LoadBalancerArn"].split(":", 5)[-1],
+         "Name": a["LoadBalancerName"],
+         "Detail": "{} {}".format(a["State"]["Code"], a["DNSName"])}
+        for page in aws.describe_pages(
+            "albs", aws.elbv2c, "describe_load_balancers")
+        for a in page["LoadBalancers"]],
+    "targetgroups": lambda aws: [
+        {"Id": t["TargetGroupArn"].split(":", 5)[-1],
+         "Name": t["TargetGroupName"],
+         "Detail": "{} {}".format(t.get("Protocol", ""), t.get("Port", ""))}
+        for page in aws.describe_pages(
+            "targetgroups", aws.elbv2c, "describe_target_groups")
+        for t in page["TargetGroups"]],
+    "keypairs": lambda aws: [
+        {"Id": k.get("KeyPairId", ""), "Name": k["KeyName"],
+         "Detail": k["KeyFingerprint"]}
+        for k in aws.describe(
+            "keypairs", aws.ec2c.describe_key_pairs)["KeyPairs"]],
+}
+
+
+# Turn a single value or a list of values into a list.
+
+def listify(values):
+    if isinstance(values, (list, tuple, set)):
+        return(list(values))
+    return([values])
+
+
+# Turn a dict of tags into the list of Key/Value pairs the API takes.
+
+def tag_list(tags):
+    return([{"Key": key, "Value": value}
+            for key, value in (tags or {}).items()])
+
+
+# Get the Name tag of a resource, or "" if it has none.
+
+def tag_name(item):
+    for tag in item.get("Tags", []):
+        if tag["Key"] == "Name":
+            return(tag["Value"])
+    return("")
+
+
+# Pick fields out of a describe record. Each field is a dotted path such as
+# "State.Name" or "Placement.AvailabilityZone". "Tags.<key>" reads a tag and
+# "Name" is short for "Tags.Name". Missing fields are None.
+
+def project(item, fields):
+    record = {}
+    for field in fields:
+        if field == "Name":
+            value = tag_name(item)
+        elif field.startswith("Tags."):
+            value = {t["Key"]: t["Value"]
+                     for t in item.get("Tags", [])}.get(field[5:])
+        else:
+            value = item
+            for part in field.split("."):
+                value = value.get(part) if isinstance(value, dict) else None
+        record[field] = value
+    return(record)
+
+
+# Summary line printed at the end of an S3 listing
+
+LISTSUMMARY = ("\nListed {objects} objects ({bytes} bytes) from {buckets} "
+               "buckets in {pages} pages, {seconds:.2f}s at {rate:.0f} "
+               "objects/s")
+
+
+# S3 listing engine. Every bucket (all of them if none are given) is paged
+# with ListObjectsV2 on a bounded thread pool, and the objects of each page
+# are yielded as (bucket, key, size, etag, last_modified) tuples as soon as
+# the page arrives, so results come back out of order. With split=True the
+# top level of each bucket is listed with a "/" delimiter and every prefix
+# found is paged as its own task, which spreads one large bucket across the
+# pool.
+# Throughput stats are printed at the end (unless report=False) and stored in
+# the stats dict if one is passed in.
+
+def list_objects(s3c, buckets=None, prefix="", split=False, workers=16,
+                 stats=None, report=True):
+    if stats is None:
+        stats = {}
+    if buckets is None:
+        buckets = [b["Name"] for b in s3c.list_buckets()["Buckets"]]
+
+    results = queue.Queue(maxsize=workers * 4)
+    stop = threading.Event()
+    lock = threading.Lock()
+    pending = [0]
+    pool = ThreadPoolExecutor(max_workers=workers)
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.5)
+                return(True)
+            except queue.Full:
+                pass
+        return(False)
+
+    def submit(buck, pfx, delim):
+        with lock:
+            pending[0] += 1
+        pool.submit(page, buck, pfx, delim)
+
+    def page(buck, pfx, delim):
+        args = {"Bucket": buck, "Prefix": pfx}
+        if delim:
+            args["Delimiter"] = "/"
+        try:
+            pages = s3c.get_paginator("list_objects_v2").paginate(**args)
+            for resp in pages:
+                if stop.is_set():
+                    break
+                # Child prefixes are counted before this task reports done,
+                # so the pending count cannot reach zero too early.
+                for cp in resp.get("CommonPrefixes", []):
+                    submit(buck, cp["Prefix"], False)
+                rows = [(buck, obj["Key"], obj["Size"],
+                         obj["ETag"].strip("\""), obj["LastModified"])
+                        for obj in resp.get("Contents", [])]
+                if not put(("page", rows)):
+                    break
+        except boto3.exceptions.botocore.client.ClientError as e:
+            put(("error", "Bucket {}: {}".format(
+                buck, e.response["Error"]["Message"].strip("\""))))
+        except Exception as e:
+            # Connection and read errors (BotoCoreError) and anything else
+            # are reported too, so a short listing is never taken as whole.
+            put(("error", "Bucket {}: {}".format(buck, e)))
+        finally:
+            put(("done", None))
+
+    stats.update({"buckets": len(buckets), "pages": 0, "objects": 0,
+                  "bytes": 0, "errors": 0})
+    start = time.monotonic()
+    try:
+        for buck in buckets:
+            submit(buck, prefix, split)
+        while pending[0]:
+            kind, data = results.get()
+            if kind == "done":
+                with lock:
+                    pending[0] -= 1
+            elif kind == "error":
+                stats["errors"] += 1
+                print(data)
+            else:
+                stats["pages"] += 1
+                for row in data:
+                    stats["objects"] += 1
+                    stats["bytes"] += row[2]
+                    yield row
+    finally:
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+        stats["seconds"] = time.monotonic() - start
+        stats["rate"] = stats["objects"] / max(stats["seconds"], 1e-9)
+        if report:
+            print(LISTSUMMARY.format(**stats))
+
+
+# S3 bucket emptying engine. Every object version and delete marker in the
+# bucket is paged with ListObjectVersions (which also covers buckets that
+# were never versioned), and the keys are sent in batches of up to MAXKEYS per
+# DeleteObjects call on a bounded thread pool while the listing carries on.
+# At most two batches per worker are held at once, so memory stays flat
+# however large the bucket is. Keys that fail to delete are reported per
+# batch. Throughput stats are printed at the end and stored in the stats dict
+# if one is passed in; "complete" is False if the listing failed part way.
+
+def empty_bucket(s3c, bucket, workers=16, stats=None):
+    if stats is None:
+        stats = {}
+    stats.update({"bucket": bucket, "batches": 0, "objects": 0,
+                  "deleted": 0, "errors": 0, "complete": False})
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(workers * 2)
+    sent = [0]
+    start = time.monotonic()
+
+    def send(num, batch):
+        try:
+            resp = s3c.delete_objects(
+                Bucket=bucket, Delete={"Objects": batch, "Quiet": True})
+            errors = [(e.get("Code"), e.get("Message"), e.get("Key"))
+                      for e in resp.get("Errors", [])]
+        except boto3.exceptions.botocore.client.ClientError as e:
+            errors = [(e.response["Error"]["Code"],
+                       e.response["Error"]["Message"], obj["Key"])
+                      for obj in batch]
+        except BotoCoreError as e:
+            errors = [(type(e).__name__, str(e), obj["Key"])
+                      for obj in batch]
+        finally:
+            slots.release()
+        if errors:
+            print("Batch {}: {} of {} keys not deleted, first {}: {} "
+                  "({})".format(num, len(errors), len(batch), *errors[0]))
+        with lock:
+            stats["batches"] += 1
+            stats["deleted"] += len(batch) - len(errors)
+            stats["errors"] += len(errors)
+            if stats["batches"] % 100 == 0:
+                print("Deleted {} objects, {:.0f} objects/s".format(
+                    stats["deleted"],
+                    stats["deleted"] / (time.monotonic() - start)))
+
+    # Anything else a batch raises is counted against all its keys, so the
+    # bucket is never taken for empty after a batch went missing.
+
+    def check(fut, num, batch):
+        if fut.exception() is not None:
+            print("Batch {}: {}".format(num, fut.exception()))
+            with lock:
+                stats["batches"] += 1
+                stats["errors"] += len(batch)
+
+    def submit(batch):
+        slots.acquire()
+        sent[0] += 1
+        stats["objects"] += len(batch)
+        fut = pool.submit(send, sent[0], batch)
+        fut.add_done_callback(
+            lambda f, num=sent[0]: check(f, num, batch))
+
+    print("\nEmptying bucket {}".format(bucket))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        batch = []
+        try:
+            pages = s3c.get_paginator("list_object_versions").paginate(
+                Bucket=bucket)
+            for resp in pages:
+                for obj in (resp.get("Versions", []) +
+                            resp.get("DeleteMarkers", [])):
+                    batch.append({"Key": obj["Key"],
+                                  "VersionId": obj["VersionId"]})
+                    if len(batch) == MAXKEYS:
+                        submit(batch)
+                        batch = []
+            if batch:
+                submit(batch)
+            stats["complete"] = True
+        except boto3.exceptions.botocore.client.ClientError as e:
+            print("Bucket {}: {}".format(
+                bucket, e.response["Error"]["Message"].strip("\"")))
+        except BotoCoreError as e:
+            print("Bucket {}: {}".format(bucket, e))
+
+    stats["seconds"] = time.monotonic() - start
+    stats["rate"] = stats["deleted"] / max(stats["seconds"], 1e-9)
+    print(
+        "Deleted {deleted} of {objects} objects from {bucket} in {batches} "
+        "batches, {errors} errors, {seconds:.2f}s at {rate:.0f} "
+        "objects/s".format(**stats))
+    return(stats)
+
+
+# Read-only file object over one part of a memory-mapped file. botocore reads
+# the request body from it in small chunks, and can seek back to the start to
+# retry, so a part is never copied into memory as a whole.
+
+class FilePart():
+    def __init__(self, mm, start, length):
+        self.mm = mm
+        self.start = start
+        self.length = length
+        self.pos = 0
+
+    def __len__(self):
+        return(self.length)
+
+    def read(self, amount=-1):
+        if amount is None or amount < 0:
+            end = self.length
+        else:
+            end = min(self.length, self.pos + amount)
+        data = self.mm[self.start + self.pos:self.start + end]
+        self.pos = max(self.pos, end)
+        return(data)
+
+    def seek(self, offset, whence=0):
+        base = {0: 0, 1: self.pos, 2: self.length}[whence]
+        self.pos = min(self.length, max(0, base + offset))
+        return(self.pos)
+
+    def tell(self):
+        return(self.pos)
+
+
+# Name of the manifest file that sync() keeps in the local directory.
+
+MANIFEST = ".awssync.json"
+
+
+# Split "size" bytes into (part number, offset, length) parts of "partsize"
+# bytes, raised if needed to stay within the S3 part limits.
+
+def file_parts(size, partsize):
+    partsize = max(partsize, MINPART, -(-size // MAXPARTS))
+    return([(num + 1, offset, min(partsize, size - offset))
+            for num, offset in enumerate(range(0, size, partsize))])
+
+
+# Finish the throughput stats of a transfer and print them.
+
+def xfer_done(stats, verb, start):
+    stats["seconds"] = time.monotonic() - start
+    stats["mbps"] = stats["bytes"] / MB / max(stats["seconds"], 1e-9)
+    print("{} {} ({} bytes) in {} parts, {:.2f}s at {:.1f} MB/s".format(
+        verb, stats["key"], stats["bytes"], stats["parts"],
+        stats["seconds"], stats["mbps"]))
+
+
+# S3 upload engine. A file that fits in one part is sent with PutObject.
+# Larger files are sent with a multipart upload, "workers" parts at a time,
+# each part read from a read-only memory map of the file. The upload is
+# aborted if it does not complete for any reason, so no orphaned parts are
+# left behind. Returns the key, or None on failure. Throughput stats and the
+# ETag of the new object are printed at the end and stored in the stats dict
+# if one is passed in.
+
+def upload_file(s3c, path, bucket, key, partsize=8 * MB, workers=10,
+                stats=None):
+    if stats is None:
+        stats = {}
+    stats.update({"key": key, "bytes": 0, "parts": 0})
+    start = time.monotonic()
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                if size else None
+    except OSError as e:
+        print(e)
+        return(None)
+
+    parts = file_parts(size, partsize)
+    upload = None
+    complete = False
+    try:
+        if size == 0:
+            resp = s3c.put_object(Bucket=bucket, Key=key, Body=b"")
+        elif len(parts) == 1:
+            resp = s3c.put_object(
+                Bucket=bucket, Key=key, Body=FilePart(mm, 0, size))
+            stats.update({"bytes": size, "parts": 1})
+        else:
+            upload = s3c.create_multipart_upload(
+                Bucket=bucket, Key=key)["UploadId"]
+
+            def send(part):
+                num, offset, length = part
+                resp = s3c.upload_part(
+                    Bucket=bucket, Key=key, UploadId=upload, PartNumber=num,
+                    Body=FilePart(mm, offset, length))
+                return({"PartNumber": num, "ETag": resp["ETag"]})
+
+            done = []
+            pool = ThreadPoolExecutor(max_workers=workers)
+            try:
+                for part, etag in zip(parts, pool.map(send, parts)):
+                    done.append(etag)
+                    stats["parts"] += 1
+                    stats["bytes"] += part[2]
+            finally:
+                pool.shutdown(cancel_futures=True)
+            resp = s3c.complete_multipart_upload(
+                Bucket=bucket, Key=key, UploadId=upload,
+                MultipartUpload={"Parts": done})
+        complete = True
+        stats["etag"] = resp["ETag"].strip("\"")
+        xfer_done(stats, "Uploaded", start)
+        return(key)
+    except boto3.exceptions.botocore.client.ClientError as e:
+        print(e.response["Error"]["Message"].strip("\""))
+    except (boto3.exceptions.botocore.exceptions.BotoCoreError,
+            OSError) as e:
+        print(e)
+    finally:
+        if mm is not None:
+            mm.close()
+        if upload and not complete:
+            abort_upload(s3c, bucket, key, upload)
+
+
+# Abort a multipart upload, so its parts are not kept (and billed). A failed
+# abort is reported with the upload ID, to be aborted later.
+
+def abort_upload(s3c, bucket, key, upload):
+    try:
+        s3c.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload)
+    except (boto3.exceptions.botocore.client.ClientError,
+            boto3.exceptions.botocore.exceptions.BotoCoreError) as e:
+        print("Could not abort upload {} of {}: {}".format(upload, key, e))
+
+
+# S3 download engine. The object is fetched with ranged GetObject calls,
+# "workers" parts at a time, each written straight into its place in a
+# memory map of the local file. The parts are pinned to the ETag of the
+# object, so a change to the object part way through fails the download
+# instead of mixing two versions. The data goes to "<path>.part", which is
+# renamed to "path" once every part has arrived. Returns the path, or None
+# on failure. Throughput stats are printed at the end and stored in the
+# stats dict if one is passed in.
+
+def download_file(s3c, bucket, key, path, partsize=8 * MB, workers=10,
+                  stats=None):
+    if stats is None:
+        stats = {}
+    stats.update({"key": key, "bytes": 0, "parts": 0})
+    start = time.monotonic()
+    temp = path + ".part"
+    try:
+        head = s3c.head_object(Bucket=bucket, Key=key)
+        size = head["ContentLength"]
+        with open(temp, "wb+") as f:
+            if size:
+                f.truncate(size)
+                mm = mmap.mmap(f.fileno(), size)
+
+                def fetch(part):
+                    num, offset, length = part
+                    resp = s3c.get_object(
+                        Bucket=bucket, Key=key, IfMatch=head["ETag"],
+                        Range="bytes={}-{}".format(
+                            offset, offset + length - 1))
+                    pos = offset
+                    for chunk in resp["Body"].iter_chunks(MB):
+                        mm[pos:pos + len(chunk)] = chunk
+                        pos += len(chunk)
+                    if pos != offset + length:
+                        raise OSError("Part {} of {} was cut short".format(
+                            num, key))
+                    return(length)
+
+                pool = ThreadPoolExecutor(max_workers=workers)
+                try:
+                    for length in pool.map(fetch, file_parts(size, partsize)):
+                        stats["parts"] += 1
+                        stats["bytes"] += length
+                    mm.flush()
+                finally:
+                    pool.shutdown(cancel_futures=True)
+                    mm.close()
+        os.replace(temp, path)
+        xfer_done(stats, "Downloaded", start)
+        return(path)
+    except boto3.exceptions.botocore.client.ClientError as e:
+        print(e.response["Error"]["Message"].strip("\""))
+    except (boto3.exceptions.botocore.exceptions.BotoCoreError,
+            OSError) as e:
+        print(e)
+    if os.path.exists(temp):
+        os.remove(temp)
+
+
+# MD5 of a local file, as hex. This is also the ETag S3 gives an object
+# uploaded in one part.
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(MB), b""):
+            md5.update(chunk)
+    return(md5.hexdigest())
+
+
+# Load the part of a sync manifest that belongs to one bucket and prefix, as
+# a dict of relative path to {"size", "mtime", "md5", "etag"}. A missing or
+# unreadable manifest is treated as empty.
+
+def load_manifest(path, target):
+    try:
+        with open(path) as f:
+            return(json.load(f).get(target, {}))
+    except (OSError, ValueError):
+        return({})
+
+
+# Save the part of a sync manifest that belongs to one bucket and prefix,
+# keeping the other targets in the file. The file is replaced in one step, so
+# an interrupted sync never leaves half a manifest behind.
+
+def save_manifest(path, target, files):
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    manifest[target] = files
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+# S3 sync engine. Compares the files under "localdir" with the keys under
+# "prefix" in the bucket, using the manifest kept in the MANIFEST file of the
+# directory:
+#
+# - A file whose size and mtime match the manifest keeps its recorded MD5, so
+#   only new and touched files are hashed (on a thread pool)
+# - A file that cannot be read (say it was deleted during the sync) is
+#   reported, counted as an error and skipped, and its key is not deleted
+# - A file is skipped if the key exists with the same size and either the
+#   ETag recorded when the file was last synced, or an ETag equal to its MD5
+# - Every other file is uploaded, "workers" files at a time, each large file
+#   in parts through upload_file()
+# - With delete=True, keys under the prefix with no local file are deleted in
+#   batches of up to MAXKEYS
+#
+# With dryrun=True the changes are printed and nothing is sent. The manifest
+# is saved at the end with what is now known to be in the bucket. Returns the
+# stats dict, which is also filled in if one is passed in.
+
+def sync(s3c, localdir, bucket, prefix="", delete=False, workers=8,
+         partsize=8 * MB, partworkers=4, dryrun=False, stats=None):
+    if stats is None:
+        stats = {}
+    stats.update({"files": 0, "hashed": 0, "uploaded": 0, "skipped": 0,
+                  "deleted": 0, "errors": 0, "bytes": 0})
+    start = time.monotonic()
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    manifest_path = os.path.join(localdir, MANIFEST)
+    target = "s3://{}/{}".format(bucket, prefix)
+    manifest = load_manifest(manifest_path, target)
+
+    local = {}
+    unread = set()
+    for root, dirs, names in os.walk(localdir):
+        for name in names:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, localdir).replace(os.sep, "/")
+            if rel in (MANIFEST, MANIFEST + ".tmp"):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                print("Skipping {}: {}".format(rel, e))
+                unread.add(rel)
+                continue
+            local[rel] = {"size": st.st_size, "mtime": st.st_mtime_ns}
+
+    def known(rel):
+        entry = manifest.get(rel, {})
+        return(entry.get("size") == local[rel]["size"] and
+               entry.get("mtime") == local[rel]["mtime"] and
+               entry.get("md5"))
+
+    def hash_file(rel):
+        try:
+            return(file_md5(os.path.join(localdir, rel)))
+        except OSError as e:
+            print("Skipping {}: {}".format(rel, e))
+
+    tohash = [rel for rel in local if not known(rel)]
+    for rel in set(local) - set(tohash):
+        local[rel]["md5"] = manifest[rel]["md5"]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for rel, md5 in zip(tohash, pool.map(hash_file, tohash)):
+            if md5 is None:
+                del local[rel]
+                unread.add(rel)
+            else:
+                local[rel]["md5"] = md5
+    stats["hashed"] = len(tohash) - len(unread & set(tohash))
+    stats["files"] = len(local)
+    stats["errors"] += len(unread)
+
+    remote = {key[len(prefix):]: (size, etag) for buck, key, size, etag, mod
+              in list_objects(s3c, buckets=[bucket], prefix=prefix)}
+
+    files = {}
+    upload = []
+    for rel, info in sorted(local.items()):
+        size, etag = remote.get(rel, (None, None))
+        entry = manifest.get(rel, {})
+        if size == info["size"] and (
+                (entry.get("md5") == info["md5"] and
+                 entry.get("etag") == etag) or etag == info["md5"]):
+            files[rel] = dict(info, etag=etag)
+            stats["skipped"] += 1
+        else:
+            upload.append(rel)
+    stale = sorted(set(remote) - set(local) - unread) if delete else []
+
+    if dryrun:
+        for rel in upload:
+            print("Would upload {} to s3://{}/{}{}".format(
+                rel, bucket, prefix, rel))
+        for rel in stale:
+            print("Would delete s3://{}/{}{}".format(bucket, prefix, rel))
+        print("{} to upload, {} unchanged, {} to delete".format(
+            len(upload), stats["skipped"], len(stale)))
+        return(stats)
+
+    def send(rel):
+        done = {}
+        key = upload_file(s3c, os.path.join(localdir, rel), bucket,
+                          prefix + rel, partsize, partworkers, stats=done)
+        return(rel, key, done)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for rel, key, done in pool.map(send, upload):
+            if key is None:
+                stats["errors"] += 1
+                continue
+            files[rel] = dict(local[rel], etag=done["etag"])
+            stats["uploaded"] += 1
+            stats["bytes"] += done["bytes"]
+
+    for i in range(0, len(stale), MAXKEYS):
+        batch = stale[i:i + MAXKEYS]
+        try:
+            resp = s3c.delete_objects(Bucket=bucket, Delete={
+                "Objects": [{"Key": prefix + rel} for rel in batch],
+                "Quiet": True})
+            failed = {e["Key"] for e in resp.get("Errors", [])}
+            for e in resp.get("Errors", []):
+                print("{Key}: {Message}".format(**e))
+        except boto3.exceptions.botocore.client.ClientError as e:
+            print(e.response["Error"]["Message"].strip("\""))
+            failed = {prefix + rel for rel in batch}
+        stats["deleted"] += len(batch) - len(failed)
+        stats["errors"] += len(failed)
+
+    save_manifest(manifest_path, target, files)
+    stats["seconds"] = time.monotonic() - start
+    stats["mbps"] = stats["bytes"] / MB / max(stats["seconds"], 1e-9)
+    print(
+        "\nSynced {files} files to {target}: {uploaded} uploaded, {skipped} "
+        "unchanged, {deleted} deleted, {errors} errors, {hashed} hashed, "
+        "{seconds:.2f}s at {mbps:.1f} MB/s".format(target=target, **stats))
+    return(stats)
@@ -0,0 +1,559 @@
+#!/usr/bin/env python3
+
+""" AWS Orchestrator
+
+This module runs the methods of the Aws() class as a dependency graph:
+
+- Each step is a method call such as create_subnet("10.94.11.0/24", az)
+- A step may use the result of other steps by passing the Ref() returned
+  when those steps were added. It then waits for them to finish
+- Steps that do not depend on each other run at the same time on a thread
+  pool, so a stack takes as long as its longest chain instead of the sum of
+  all its steps
+- A step that raises or returns None (which is how the Aws() methods report
+  an AWS error) fails, and every step depending on it is skipped
+- With a journal file, the result of each step is written to it as soon as
+  the step finishes. Running the same stack again resumes from the journal:
+  finished steps are not run again and their results are used as they are,
+  so only the failed and skipped steps run
+- A step given the TOKEN argument gets a client token in its place, the same
+  for that step in every run of the stack with the same journal, so a create
+  call sent again after a failure does not make a second resource
+
+It also contains the Teardown() class, which finds a stack by tag or by its
+root resources, and deletes it in reverse dependency order with everything
+in one level deleted at the same time.
+
+"""
+
+# Import modules
+
+import hashlib
+import json
+import os
+import time
+import uuid
+from awsclass import KINDNAMES, MAXFILTER, listify
+from botocore.exceptions import ClientError
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+# Reference to the result of another step. Returned by Stack.add() and
+# passed as an argument to later steps.
+
+class Ref():
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return("Ref({!r})".format(self.name))
+
+
+# Stand-in for the client token of a step, such as the ClientToken of
+# run_instances. Passed as an argument to Stack.add().
+
+class Token():
+    def __repr__(self):
+        return("TOKEN")
+
+
+TOKEN = Token()
+
+
+# Find the names of all the steps referenced by an argument, looking inside
+# lists, tuples and dicts.
+
+def refs(arg):
+    if isinstance(arg, Ref):
+        return({arg.name})
+    if isinstance(arg, (list, tuple)):
+        return(set().union(*[refs(a) for a in arg]))
+    if isinstance(arg, dict):
+        return(set().union(*[refs(a) for a in arg.values()]))
+    return(set())
+
+
+# Replace every Ref() inside an argument with the result of its step, and
+# TOKEN with the client token of the step.
+
+def resolve(arg, results, token=None):
+    if isinstance(arg, Ref):
+        return(results[arg.name])
+    if isinstance(arg, Token):
+        return(token)
+    if isinstance(arg, (list, tuple)):
+        return(type(arg)(resolve(a, results, token) for a in arg))
+    if isinstance(arg, dict):
+        return({k: resolve(v, results, token) for k, v in arg.items()})
+    return(arg)
+
+
+class Stack():
+    def __init__(self, workers=16, journal=None):
+        self.workers = workers
+        self.journal = journal
+        self.build = None
+        self.steps = {}
+        self.results = {}
+        self.times = {}
+        self.failed = []
+        self.skipped = []
+        self.resumed = []
+
+# Add a step method. Dependencies are taken from the Ref() arguments plus any
+# step names given in "after". Returns a Ref() to the result of the step.
+
+    def add(self, name, func, *args, after=(), **kwargs):
+        if name in self.steps:
+            raise ValueError("Step {} was already added".format(name))
+        deps = refs(args) | refs(kwargs) | set(after)
+        self.steps[name] = (func, args, kwargs, deps)
+        return(Ref(name))
+
+# Check that every dependency exists and that there are no cycles. Returns
+# the step names in dependency order.
+
+    def order(self):
+        done = []
+        state = {}
+
+        def visit(name, path):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ValueError("Dependency cycle: {}".format(
+                    " -> ".join(path + [name])))
+            if name not in self.steps:
+                raise ValueError("Step {} depends on unknown step {}".format(
+                    path[-1], name))
+            state[name] = "visiting"
+            for dep in sorted(self.steps[name][3]):
+                visit(dep, path + [name])
+            state[name] = "done"
+            done.append(name)
+
+        for name in self.steps:
+            visit(name, [])
+        return(done)
+
+# Read the journal of an earlier run, if there is one. The first line holds
+# the build ID the client tokens are made from, and each other line a step
+# that finished. A line cut short by a crash is ignored. A new journal is
+# started with a new build ID. Returns a dict of each finished step with its
+# journal entry.
+
+    def read_journal(self):
+        done = {}
+        self.build = None
+        if self.journal and os.path.exists(self.journal):
+            with open(self.journal) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if "build" in entry:
+                        self.build = self.build or entry["build"]
+                    elif "step" in entry:
+                        done[entry["step"]] = entry
+        if self.build is None:
+            self.build = uuid.uuid4().hex
+            self.log({"build": self.build})
+        return(done)
+
+# Add an entry to the journal. It is on disk before the next step starts. A
+# line cut short by a crash is ended first, so the entry gets a line of its
+# own.
+
+    def log(self, entry):
+        if not self.journal:
+            return
+        line = (json.dumps(entry, default=str) + "\n").encode()
+        with open(self.journal, "a+b") as f:
+            if f.seek(0, os.SEEK_END):
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    line = b"\n" + line
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+# Digest of what a step does: the method, its arguments and its
+# dependencies. A journal entry with another digest is from an older version
+# of the step, and is not resumed.
+
+    def digest(self, name):
+        func, args, kwargs, deps = self.steps[name]
+        text = repr((getattr(func, "__qualname__", func), args,
+                     sorted(kwargs.items()), sorted(deps)))
+        return(hashlib.md5(text.encode()).hexdigest())
+
+# Client token of a step: 32 hex digits, within the 64 characters EC2
+# allows, made from the build ID, the step name and digest, and the
+# arguments with the results of other steps filled in. A step that runs
+# again with the same arguments sends the same token, and one whose
+# arguments changed sends a new one, which EC2 requires.
+
+    def token(self, name, args, kwargs):
+        text = repr((self.build, name, self.digest(name), args,
+                     sorted(kwargs.items())))
+        return(hashlib.md5(text.encode()).hexdigest())
+
+# Resume the steps that finished in an earlier run, in dependency order. A
+# step is only resumed if all its dependencies were too, so a step that
+# runs again is followed by everything that uses its result.
+
+    def resume(self, done, waiting):
+        for name in self.order():
+            entry = done.get(name)
+            if entry is None or not self.steps[name][3] <= set(self.resumed):
+                continue
+            if entry.get("digest") != self.digest(name):
+                print("Step {} changed since the journal was written, so it "
+                      "runs again".format(name))
+                continue
+            self.results[name] = entry["result"]
+            self.resumed.append(name)
+            del waiting[name]
+        for deps in waiting.values():
+            deps.difference_update(self.resumed)
+        if self.resumed:
+            print("Resumed {} steps from {}: {}".format(
+                len(self.resumed), self.journal, ", ".join(self.resumed)))
+
+# Run a single step. Returns the result and the start and end times.
+
+    def _run_step(self, name):
+        func, args, kwargs, deps = self.steps[name]
+        start = time.monotonic()
+        try:
+            args = resolve(args, self.results, TOKEN)
+            kwargs = resolve(kwargs, self.results, TOKEN)
+            token = self.token(name, args, kwargs)
+            result = func(*resolve(args, {}, token),
+                          **resolve(kwargs, {}, token))
+        except Exception as e:
+            print("Step {} failed: {}".format(name, e))
+            result = None
+        return(result, start, time.monotonic())
+
+# Run the stack method. Each step is started as soon as all its dependencies
+# have finished. With a journal, the steps it holds are resumed first, and
+# each step that finishes is added to it. The results must then be JSON
+# values, such as the IDs, names and ARNs the Aws() methods return. Returns a
+# dict of each step name with its result.
+
+    def run(self):
+        self.order()
+        waiting = {name: set(step[3]) for name, step in self.steps.items()}
+        running = {}
+        start = time.monotonic()
+        self.resume(self.read_journal(), waiting)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while waiting or running:
+                for name in [n for n, deps in waiting.items() if not deps]:
+                    del waiting[name]
+                    running[pool.submit(self._run_step, name)] = name
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    name = running.pop(fut)
+                    result, began, ended = fut.result()
+                    self.times[name] = (began - start, ended - start)
+                    if result is None:
+                        self.failed.append(name)
+                        self._skip(name, waiting)
+                        continue
+                    self.results[name] = result
+                    self.log({"step": name, "digest": self.digest(name),
+                              "result": result})
+                    for deps in waiting.values():
+                        deps.discard(name)
+
+        self.elapsed = time.monotonic() - start
+        self.report()
+        return(self.results)
+
+# Skip every step that depends on a failed or skipped step.
+
+    def _skip(self, name, waiting):
+        for dep in [n for n, deps in waiting.items() if name in deps]:
+            if dep in waiting:
+                del waiting[dep]
+                self.skipped.append(dep)
+                print("Step {} skipped because {} did not finish".format(
+                    dep, name))
+                self._skip(dep, waiting)
+
+# Find the critical path: the chain of dependent steps with the longest total
+# duration. Returns the list of step names and the total time.
+
+    def critical_path(self):
+        best = {}
+        for name in self.order():
+            if name not in self.times:
+                continue
+            began, ended = self.times[name]
+            prev = max(
+                (best[d] for d in self.steps[name][3] if d in best),
+                key=lambda b: b[1], default=([], 0.0))
+            best[name] = (prev[0] + [name], prev[1] + ended - began)
+        return(max(best.values(), key=lambda b: b[1], default=([], 0.0)))
+
+# Print a timing report for the last run.
+
+    def report(self):
+        print("\nStep timings:")
+        for name, (began, ended) in sorted(
+                self.times.items(), key=lambda t: t[1]):
+            print("  {:<20} {:7.2f}s -> {:7.2f}s  ({:.2f}s)".format(
+                name, began, ended, ended - began))
+        path, length = self.critical_path()
+        serial = sum(ended - began for began, ended in self.times.values())
+        print("Critical path: {} ({:.2f}s)".format(" -> ".join(path), length))
+        print("Wall time {:.2f}s, serial time would be {:.2f}s".format(
+            self.elapsed, serial))
+        if self.failed or self.skipped:
+            print("Failed steps: {}  Skipped steps: {}".format(
+                ", ".join(self.failed) or "none",
+                ", ".join(self.skipped) or "none"))
+
+
+# Order in which the resource types of a stack are deleted. Each type only
+# depends on types later in the list, so everything in one level can be
+# deleted at the same time.
+
+TEARDOWN_LEVELS = ["listeners", "albs", "targetgroups", "instances", "enis",
+                   "subnets", "keypairs"]
+
+# Instance states that still need terminating
+
+LIVE_STATES = ["pending", "running", "stopping", "stopped"]
+
+
+class Teardown():
+    def __init__(self, aws, workers=16):
+        self.aws = aws
+        self.workers = workers
+        self.found = {level: set() for level in TEARDOWN_LEVELS}
+        self.times = {}
+
+# Discover method. Finds the resources to delete: everything tagged with the
+# given tags (a dict of tag key to value or list of values), the root
+# resources given by ID, name or ARN (key pairs by name), and everything that
+# depends on them. Names that match nothing are reported and left out:
+#
+#   subnets        - instances, load balancers and network interfaces in them
+#   load balancers - their listeners and the target groups they forward to
+#
+# Can be called more than once to add more resources. Returns the dict of
+# resources found per level.
+
+    def discover(self, tags=None, albs=(), tgs=(), instances=(), subnets=(),
+                 keypairs=()):
+        aws = self.aws
+        self.found["instances"].update(aws.resolve_all("instances",
+                                                       instances))
+        self.found["keypairs"].update(keypairs)
+        self.found["subnets"].update(aws.resolve_all("subnets", subnets))
+
+        allalbs = self.paged(aws.elbv2c, "describe_load_balancers",
+                             "LoadBalancers")
+        alltgs = self.paged(aws.elbv2c, "describe_target_groups",
+                            "TargetGroups")
+        self.found["albs"].update(
+            a["LoadBalancerArn"] for a in allalbs
+            if a["LoadBalancerArn"] in albs or a["LoadBalancerName"] in albs)
+        self.found["targetgroups"].update(
+            t["TargetGroupArn"] for t in alltgs
+            if t["TargetGroupArn"] in tgs or t["TargetGroupName"] in tgs)
+
+        if tags:
+            filters = [{"Name": "tag:{}".format(key), "Values": listify(value)}
+                       for key, value in tags.items()]
+            self.found["instances"].update(
+                i["InstanceId"] for i in aws.query_inst(
+                    states=LIVE_STATES, tags=tags))
+            self.found["subnets"].update(
+                s["SubnetId"] for s in self.paged(
+                    aws.ec2c, "describe_subnets", "Subnets", Filters=filters))
+            self.found["keypairs"].update(
+                k["KeyName"] for k in aws.ec2c.describe_key_pairs(
+                    Filters=filters)["KeyPairs"])
+            self.found["albs"].update(self.tagged(
+                [a["LoadBalancerArn"] for a in allalbs], tags))
+            self.found["targetgroups"].update(self.tagged(
+                [t["TargetGroupArn"] for t in alltgs], tags))
+
+        # Everything in the subnets
+
+        subs = sorted(self.found["subnets"])
+        if subs:
+            self.found["instances"].update(
+                i["InstanceId"] for i in aws.query_inst(
+                    states=LIVE_STATES, subnets=subs))
+            self.found["albs"].update(
+                a["LoadBalancerArn"] for a in allalbs
+                if {z["SubnetId"] for z in a["AvailabilityZones"]} & set(subs))
+            for i in range(0, len(subs), MAXFILTER):
+                self.found["enis"].update(
+                    n["NetworkInterfaceId"] for n in self.paged(
+                        aws.ec2c, "describe_network_interfaces",
+                        "NetworkInterfaces", Filters=[{
+                            "Name": "subnet-id",
+                            "Values": subs[i:i + MAXFILTER]}]))
+
+        # The listeners and target groups of the load balancers
+
+        for albarn in sorted(self.found["albs"]):
+            self.found["listeners"].update(
+                ln["ListenerArn"] for ln in self.paged(
+                    aws.elbv2c, "describe_listeners", "Listeners",
+                    LoadBalancerArn=albarn))
+            self.found["targetgroups"].update(
+                t["TargetGroupArn"] for t in alltgs
+                if albarn in t["LoadBalancerArns"])
+
+        for level in TEARDOWN_LEVELS:
+            print("Found {} {}".format(len(self.found[level]), level))
+        return(self.found)
+
+# Get every item of a paginated describe call.
+
+    def paged(self, client, opname, key, **kwargs):
+        pages = client.get_paginator(opname).paginate(**kwargs)
+        return([item for page in pages for item in page[key]])
+
+# Find which of the given ELBv2 ARNs carry all the given tags, 20 ARNs per
+# describe_tags call.
+
+    def tagged(self, arns, tags):
+        found = []
+        for i in range(0, len(arns), 20):
+            descs = self.aws.elbv2c.describe_tags(
+                ResourceArns=arns[i:i + 20])["TagDescriptions"]
+            for desc in descs:
+                have = {t["Key"]: t["Value"] for t in desc["Tags"]}
+                if all(have.get(key) in listify(value)
+                       for key, value in tags.items()):
+                    found.append(desc["ResourceArn"])
+        return(found)
+
+# Run the teardown method. Deletes each level in TEARDOWN_LEVELS order, with
+# everything in a level deleted at the same time. With dryrun=True the
+# resources are only printed. Returns a dict of each level with the list of
+# resources that could not be deleted.
+
+    def run(self, dryrun=False):
+        failed = {}
+        start = time.monotonic()
+        for level in TEARDOWN_LEVELS:
+            items = sorted(self.found[level])
+            if not items:
+                continue
+            print("\n** Deleting {} {} **".format(len(items), level))
+            if dryrun:
+                print("\n".join(items))
+                continue
+            began = time.monotonic()
+            failed[level] = getattr(self, "delete_" + level)(items)
+            if level in KINDNAMES:
+                self.aws.unindex(
+                    level, [i for i in items if i not in failed[level]])
+            self.times[level] = (len(items), time.monotonic() - began)
+
+        if dryrun:
+            return(failed)
+        print("\nTeardown timings:")
+        for level, (count, secs) in self.times.items():
+            print("  {:<14} {:5} deleted  {:5} failed  {:7.2f}s".format(
+                level, count - len(failed[level]), len(failed[level]), secs))
+        print("Total {:.2f}s".format(time.monotonic() - start))
+        return(failed)
+
+# Delete every item of a level at the same time with delete_one(), which
+# makes the call for one item. Returns the items that failed.
+
+    def each(self, items, delete_one):
+        def attempt(item):
+            try:
+                delete_one(item)
+                return(None)
+            except ClientError as e:
+                print("{}: {}".format(
+                    item, e.response["Error"]["Message"].strip("\"")))
+                return(item)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return([item for item in pool.map(attempt, items) if item])
+
+# Delete methods for each level. Each returns the list of items that could
+# not be deleted.
+
+    def delete_listeners(self, arns):
+        return(self.each(arns, lambda arn: self.aws.elbv2c.delete_listener(
+            ListenerArn=arn)))
+
+    def delete_albs(self, arns):
+        failed = self.each(
+            arns, lambda arn: self.aws.elbv2c.delete_load_balancer(
+                LoadBalancerArn=arn))
+        self.aws.invalidate("albs", "targetgroups")
+        self.aws.wait_albs([a for a in arns if a not in failed], "deleted")
+        return(failed)
+
+    def delete_targetgroups(self, arns):
+        self.aws.wait_tgs(arns, "free")
+        failed = self.each(
+            arns, lambda arn: self.aws.elbv2c.delete_target_group(
+                TargetGroupArn=arn))
+        self.aws.invalidate("targetgroups")
+        return(failed)
+
+    def delete_instances(self, instids):
+        done = self.aws.term_insts(instids)
+        return([i for i in instids if i not in done])
+
+    # Network interfaces still attached belong to instances or load balancers
+    # deleted above, and go away with them.
+
+    def delete_enis(self, eniids):
+        live = []
+        for i in range(0, len(eniids), MAXFILTER):
+            live.extend(n["NetworkInterfaceId"] for n in self.paged(
+                self.aws.ec2c, "describe_network_interfaces",
+                "NetworkInterfaces", Filters=[
+                    {"Name": "network-interface-id",
+                     "Values": eniids[i:i + MAXFILTER]},
+                    {"Name": "status", "Values": ["available"]}]))
+        return(self.each(
+            live, lambda eni: self.aws.ec2c.delete_network_interface(
+                NetworkInterfaceId=eni)))
+
+    # A subnet can still hold the network interfaces of a load balancer for
+    # a little while after it is deleted, so DependencyViolation is retried.
+
+    def delete_subnets(self, subids):
+        def delete_one(subid):
+            def check():
+                try:
+                    self.aws.ec2c.delete_subnet(SubnetId=subid)
+                    return(True)
+                except ClientError as e:
+                    if e.response["Error"]["Code"] != "DependencyViolation":
+                        raise
+                    return(False)
+
+            if not self.aws.poll(check, timeout=300):
+                self.aws.ec2c.delete_subnet(SubnetId=subid)
+
+        failed = self.each(subids, delete_one)
+        self.aws.invalidate("subnets")
+        return(failed)
+
+    def delete_keypairs(self, keynames):
+        failed = self.each(
+            keynames, lambda key: self.aws.ec2c.delete_key_pair(KeyName=key))
+        self.aws.invalidate("keypairs")
+        return(failed)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+""" AWS Listing Output
+
+This module contains the Output() class. The listing methods of the Aws()
+class write their records through it, in one of four modes:
+
+- "text": one formatted line per record, as the tools have always printed
+  them
+- "ndjson": one JSON object per line, for jq and other tools
+- "csv": a header row, then one row per record
+- "quiet": nothing at all, for library callers that only want the return
+  value
+
+Records are written as they come in, a page at a time for paginated
+listings, into a buffer that goes to the stream when it fills up and when the
+listing ends. Whole records are written at once, so listings running in
+several threads never split each other's lines.
+
+"""
+
+# Import modules
+
+import csv
+import io
+import json
+import string
+import sys
+import threading
+
+# Output modes, and the size in characters the buffer of a listing reaches
+# before it is written out
+
+MODES = ("text", "ndjson", "csv", "quiet")
+BUFSIZE = 64 * 1024
+
+
+class Output():
+    def __init__(self, mode="text", stream=None, bufsize=BUFSIZE):
+        if mode not in MODES:
+            raise ValueError("Unknown output mode {}. Choose from {}".format(
+                mode, ", ".join(MODES)))
+        self.mode = mode
+        self.stream = stream
+        self.bufsize = bufsize
+        self.lock = threading.Lock()
+
+# Start a listing. "fields" are the keys of its records, in CSV column order,
+# and "text" is the format string of one record in text mode. "title" is
+# printed first in text mode only.
+
+    def listing(self, fields, text, title=None):
+        return(Listing(self, fields, text, title))
+
+# Write to the stream, sys.stdout unless another was given. sys.stdout is
+# looked up on each write so that it can be redirected.
+
+    def write(self, data):
+        with self.lock:
+            stream = self.stream or sys.stdout
+            stream.write(data)
+            stream.flush()
+
+
+# One listing in progress. Used as a context manager, so what is left in the
+# buffer is written out when the listing ends, even if it fails part way.
+# emit() and emit_row() are bound to the writer of the mode when the listing
+# starts, so there is no mode check per record.
+
+class Listing():
+    def __init__(self, output, fields, text, title=None):
+        self.output = output
+        self.mode = output.mode
+        self.fields = fields
+        self.text = text
+        self.buf = io.StringIO()
+        if self.mode == "csv":
+            self.writer = csv.writer(self.buf, lineterminator="\n")
+            self.writer.writerow(fields)
+        elif self.mode == "text":
+            self.rowtext = positional(text, fields)
+            if title is not None:
+                self.buf.write(title + "\n")
+        self.emit = getattr(self, "emit_" + self.mode)
+        self.emit_row = getattr(self, "row_" + self.mode)
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        self.flush()
+
+# Writers of a record, a dict with at least the keys in "fields".
+
+    def emit_text(self, record):
+        self.buf.write(self.text.format(**record) + "\n")
+        self.check()
+
+    def emit_ndjson(self, record):
+        self.buf.write(json.dumps(record, default=str) + "\n")
+        self.check()
+
+    def emit_csv(self, record):
+        self.writer.writerow([record.get(f) for f in self.fields])
+        self.check()
+
+    def emit_quiet(self, record):
+        pass
+
+# Writers of a record given as a tuple of values in the order of "fields",
+# which saves building a dict per record for large listings.
+
+    def row_text(self, values):
+        self.buf.write(self.rowtext.format(*values) + "\n")
+        self.check()
+
+    def row_ndjson(self, values):
+        self.emit_ndjson(dict(zip(self.fields, values)))
+
+    def row_csv(self, values):
+        self.writer.writerow(values)
+        self.check()
+
+    def row_quiet(self, values):
+        pass
+
+    def check(self):
+        if self.buf.tell() >= self.output.bufsize:
+            self.flush()
+
+# Add a line that is only shown in text mode, such as a count at the end.
+
+    def note(self, text):
+        if self.mode == "text":
+            self.buf.write(text + "\n")
+
+    def flush(self):
+        data = self.buf.getvalue()
+        if data:
+            self.output.write(data)
+            self.buf.seek(0)
+            self.buf.truncate()
+
+
+# Turn a format string with field names into one with field positions, so a
+# tuple of values in the order of "fields" can be formatted without a dict.
+
+def positional(text, fields):
+    parts = []
+    for literal, name, spec, conv in string.Formatter().parse(text):
+        parts.append(literal.replace("{", "{{").replace("}", "}}"))
+        if name is not None:
+            parts.append("{" + str(fields.index(name)) +
+                         ("!" + conv if conv else "") +
+                         (":" + spec if spec else "") + "}")
+    return("".join(parts))
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+""" AWS Retry and Rate Limiting
+
+This module contains the Throttle() class. It hooks into the botocore event
+system of every client the Aws() class builds and controls how fast API
+calls are sent and how failed calls are retried:
+
+- Calls are grouped into API families by service and verb (for example
+  ec2.Describe or elbv2.Create). Each family has a token bucket that spaces
+  out its calls. The rate is cut when AWS throttles a call and creeps back
+  up with every call that succeeds
+- Throttling errors, 5xx errors and connection errors are retried with
+  jittered exponential backoff, up to max_attempts tries per call
+- Retries are paid for out of a shared retry budget that is refilled by
+  successful calls, so a failing service is not hammered with retries
+- Calls, retries, throttles and the time spent waiting on the token buckets
+  are counted per family, so the concurrency of bulk jobs can be tuned
+
+"""
+
+# Import modules
+
+import random
+import re
+import threading
+import time
+
+from botocore.exceptions import ConnectionError, HTTPClientError
+
+# Error codes AWS uses to say a caller is sending too many requests
+
+THROTTLECODES = {
+    "Throttling", "ThrottlingException", "ThrottledException",
+    "RequestLimitExceeded", "RequestThrottled", "RequestThrottledException",
+    "TooManyRequestsException", "SlowDown", "BandwidthLimitExceeded",
+    "PriorRequestNotComplete", "EC2ThrottledException",
+    "ProvisionedThroughputExceededException",
+}
+
+# Error codes and HTTP status codes that are worth retrying
+
+TRANSIENTCODES = {
+    "InternalError", "InternalFailure", "ServiceUnavailable",
+    "RequestTimeout", "RequestTimeoutException", "Unavailable",
+}
+TRANSIENTSTATUS = {500, 502, 503, 504}
+
+# Retry budget: its size, what a retry costs, and what a successful call
+# puts back
+
+BUDGET = 500
+RETRYCOST = 5
+SUCCESSREFUND = 1
+
+
+# Token bucket for one API family. Each call takes a token. Tokens come back
+# at "rate" per second, up to "burst". When the bucket is empty, acquire()
+# sleeps until the caller's token is due. A throttled call cuts the rate by
+# "backoff", at most once a second so that a burst of throttles from calls
+# already in flight only counts once, and each successful call adds "step".
+
+class TokenBucket():
+    def __init__(self, rate, burst, maxrate, minrate=0.5, backoff=0.7,
+                 step=0.5):
+        self.rate = rate
+        self.burst = burst
+        self.maxrate = maxrate
+        self.minrate = minrate
+        self.backoff = backoff
+        self.step = step
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.cut = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return(wait)
+
+    def throttled(self):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.cut >= 1:
+                self.rate = max(self.minrate, self.rate * self.backoff)
+                self.cut = now
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.maxrate, self.rate + self.step)
+
+
+class Throttle():
+    def __init__(self, rate=20, burst=40, maxrate=100, max_attempts=8,
+                 basedelay=0.1, maxdelay=20, rates=None):
+        self.rate = rate
+        self.burst = burst
+        self.maxrate = maxrate
+        self.max_attempts = max_attempts
+        self.basedelay = basedelay
+        self.maxdelay = maxdelay
+        self.rates = rates or {}
+        self.budget = BUDGET
+        self.buckets = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+# Hook the throttle into a client. Every attempt of every call first takes a
+# token, and every response goes through needs_retry().
+
+    def register(self, client):
+        service = client.meta.service_model.service_name
+        events = client.meta.events
+
+        def before_send(event_name, **kwargs):
+            self.before_send(service, event_name.split(".")[-1])
+
+        events.register("before-send", before_send)
+        events.register_first("needs-retry", self.needs_retry)
+
+# Find the API family of a call, such as "ec2.Describe".
+
+    def family(self, service, opname):
+        verb = re.match(r"[A-Z][a-z]*", opname).group(0)
+        return("{}.{}".format(service, verb))
+
+# Get the token bucket and counters of an API family, creating them the
+# first time the family is used. "rates" can set the starting rate of a
+# family or of a whole service.
+
+    def bucket(self, family):
+        with self.lock:
+            if family not in self.buckets:
+                rate = self.rates.get(
+                    family, self.rates.get(family.split(".")[0], self.rate))
+                self.buckets[family] = TokenBucket(
+                    rate, max(self.burst, rate), max(self.maxrate, rate))
+                self.counts[family] = {
+                    "calls": 0, "retries": 0, "throttles": 0, "errors": 0,
+                    "gaveup": 0, "nobudget": 0, "waited": 0.0}
+            return(self.buckets[family], self.counts[family])
+
+    def count(self, family, name, amount=1):
+        with self.lock:
+            self.counts[family][name] += amount
+
+# before-send handler. Waits for a token for the family of the call.
+
+    def before_send(self, service, opname):
+        family = self.family(service, opname)
+        bucket, counts = self.bucket(family)
+        waited = bucket.acquire()
+        self.count(family, "calls")
+        if waited:
+            self.count(family, "waited", waited)
+
+# needs-retry handler. Returns the number of seconds to sleep before
+# retrying the call, or None to stop.
+
+    def needs_retry(self, response, operation, attempts, caught_exception,
+                    request_dict, **kwargs):
+        family = self.family(
+            operation.service_model.service_name, operation.name)
+        bucket, counts = self.bucket(family)
+        kind = self.classify(response, caught_exception)
+
+        if kind is None:
+            bucket.succeeded()
+            with self.lock:
+                self.budget = min(BUDGET, self.budget + SUCCESSREFUND)
+            return(None)
+        if kind == "throttle":
+            bucket.throttled()
+            self.count(family, "throttles")
+        elif kind == "error":
+            self.count(family, "errors")
+            return(None)
+
+        if attempts >= self.max_attempts:
+            self.count(family, "gaveup")
+            return(None)
+        with self.lock:
+            if self.budget < RETRYCOST:
+                self.counts[family]["nobudget"] += 1
+                return(None)
+            self.budget -= RETRYCOST
+        self.count(family, "retries")
+        return(random.uniform(
+            0, min(self.maxdelay, self.basedelay * 2 ** attempts)))
+
+# Sort a response into None (success), "throttle", "transient" (worth
+# retrying) or "error" (not worth retrying).
+
+    def classify(self, response, caught_exception):
+        if caught_exception is not None:
+            if isinstance(caught_exception, (ConnectionError,
+                                             HTTPClientError)):
+                return("transient")
+            return("error")
+        http, parsed = response
+        code = parsed.get("Error", {}).get("Code")
+        if code in THROTTLECODES:
+            return("throttle")
+        if code in TRANSIENTCODES or http.status_code in TRANSIENTSTATUS:
+            return("transient")
+        if code or http.status_code >= 400:
+            return("error")
+        return(None)
+
+# Print and return the counters of each API family, with the current rate of
+# its token bucket.
+
+    def stats(self):
+        with self.lock:
+            stats = {family: dict(counts, rate=self.buckets[family].rate)
+                     for family, counts in sorted(self.counts.items())}
+            budget = self.budget
+        for family, counts in stats.items():
+            print(
+                "{0:<22} calls = {calls}  retries = {retries}  "
+                "throttles = {throttles}  errors = {errors}  "
+                "gave up = {gaveup}  "
+                "no budget = {nobudget}  waited = {waited:.2f}s  "
+                "rate = {rate:.1f}/s".format(family, **counts))
+        print("Retry budget left: {} of {}".format(budget, BUDGET))
+        return(stats)
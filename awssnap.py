@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+
+""" AWS Inventory Snapshots
+
+This module saves the inventory of an account to disk and answers questions
+about it offline:
+
+- take() describes instances, subnets, ALBs, target groups, key pairs and S3
+  objects through an Aws() object and writes one columnar file per resource
+  type into a snapshot directory. Strings are stored once per distinct value
+  with a 32-bit code per row, numbers and times as packed 64-bit arrays
+- Taking a snapshot again only fetches the types older than "max_age", and
+  only rewrites the files whose content changed
+- Snapshot() memory-maps the files, so a query only touches the columns it
+  uses. Table.where() filters rows, and count_by() and sum() aggregate them
+
+Example:
+
+    take(Aws(), "inv")
+    subnets = Snapshot("inv").table("subnets")
+    full = subnets.where(AvailableIpAddressCount=lambda n: n < 16)
+    print(full.count_by("AvailabilityZone"))
+
+"""
+
+# Import modules
+
+import hashlib
+import json
+import mmap
+import operator
+import os
+import re
+import struct
+import sys
+import time
+from array import array
+from awsclass import tag_name
+from botocore.exceptions import BotoCoreError, ClientError
+from collections import Counter
+
+# Columns of each resource type, with their type: "str", "int" or "time"
+# (seconds since the epoch).
+
+SCHEMA = {
+    "instances": [("InstanceId", "str"), ("Name", "str"),
+                  ("InstanceType", "str"), ("State", "str"),
+                  ("AvailabilityZone", "str"), ("SubnetId", "str"),
+                  ("PrivateIpAddress", "str"), ("LaunchTime", "time")],
+    "subnets": [("SubnetId", "str"), ("Name", "str"), ("CidrBlock", "str"),
+                ("AvailabilityZone", "str"),
+                ("AvailableIpAddressCount", "int"), ("VpcId", "str")],
+    "albs": [("LoadBalancerName", "str"), ("LoadBalancerArn", "str"),
+             ("DNSName", "str"), ("State", "str"), ("Scheme", "str"),
+             ("VpcId", "str")],
+    "targetgroups": [("TargetGroupName", "str"), ("TargetGroupArn", "str"),
+                     ("Protocol", "str"), ("Port", "int"), ("VpcId", "str")],
+    "keypairs": [("KeyName", "str"), ("KeyFingerprint", "str")],
+    "objects": [("Bucket", "str"), ("Key", "str"), ("Size", "int"),
+                ("ETag", "str"), ("LastModified", "time")],
+}
+
+# Array type codes of the column types, and of string codes and offsets
+
+TYPECODES = {"int": "q", "time": "d"}
+CODE = "i"
+OFFSET = "q"
+
+# File layout: MAGIC, the length of the JSON header as 8 bytes, the header,
+# then the column blocks, each starting on an 8-byte boundary.
+
+MAGIC = b"AWSSNAP1"
+MANIFEST = "snapshot.json"
+
+
+# Fetch the rows of each resource type through an Aws() object. Each returns
+# an iterable of tuples in the column order of SCHEMA, and fills in the
+# "stats" dict of the listing when it has one.
+
+FETCH = {
+    "instances": lambda aws, stats: (
+        (i["InstanceId"], tag_name(i), i["InstanceType"], i["State"]["Name"],
+         i["Placement"]["AvailabilityZone"], i.get("SubnetId"),
+         i.get("PrivateIpAddress"), i.get("LaunchTime"))
+        for i in aws.query_inst()),
+    "subnets": lambda aws, stats: (
+        (s["SubnetId"], tag_name(s), s["CidrBlock"], s["AvailabilityZone"],
+         s["AvailableIpAddressCount"], s.get("VpcId"))
+        for page in aws.describe_pages(
+            "subnets", aws.ec2c, "describe_subnets")
+        for s in page["Subnets"]),
+    "albs": lambda aws, stats: (
+        (a["LoadBalancerName"], a["LoadBalancerArn"], a["DNSName"],
+         a["State"]["Code"], a.get("Scheme"), a.get("VpcId"))
+        for page in aws.describe_pages(
+            "albs", aws.elbv2c, "describe_load_balancers")
+        for a in page["LoadBalancers"]),
+    "targetgroups": lambda aws, stats: (
+        (t["TargetGroupName"], t["TargetGroupArn"], t.get("Protocol"),
+         t.get("Port"), t.get("VpcId"))
+        for page in aws.describe_pages(
+            "targetgroups", aws.elbv2c, "describe_target_groups")
+        for t in page["TargetGroups"]),
+    "keypairs": lambda aws, stats: (
+        (k["KeyName"], k["KeyFingerprint"])
+        for k in aws.describe(
+            "keypairs", aws.ec2c.describe_key_pairs)["KeyPairs"]),
+    "objects": lambda aws, stats: aws.list_objects(report=False,
+                                                   stats=stats),
+}
+
+
+# Take or refresh a snapshot in directory "path". Types that were fetched
+# less than "max_age" seconds ago are left alone (with no max_age every type
+# is fetched). A fetched type is only rewritten if its content changed. A
+# type that fails to fetch is reported and keeps its old file. Returns a dict
+# of each type to "written", "unchanged", "fresh" or "failed".
+
+def take(aws, path, kinds=None, max_age=None):
+    kinds = kinds or list(SCHEMA)
+    unknown = [kind for kind in kinds if kind not in SCHEMA]
+    if unknown:
+        print("Unknown resource types: {}. Choose from {}".format(
+            ", ".join(unknown), ", ".join(SCHEMA)))
+        return(None)
+    os.makedirs(path, exist_ok=True)
+    manifest = load_manifest(path)
+    done = {}
+    for kind in kinds:
+        entry = manifest.get(kind)
+        if entry and max_age is not None and \
+                time.time() - entry["checked"] < max_age:
+            done[kind] = "fresh"
+            continue
+        stats = {}
+        try:
+            columns = build(kind, FETCH[kind](aws, stats))
+        except (ClientError, BotoCoreError) as e:
+            print("{}: {}".format(kind, e))
+            done[kind] = "failed"
+            continue
+        if stats.get("errors"):
+            print("objects: some buckets could not be listed")
+            done[kind] = "failed"
+            continue
+
+        data = list(blocks(columns))
+        digest = hashlib.md5()
+        for block in data:
+            digest.update(block)
+        now = time.time()
+        if entry and entry["digest"] == digest.hexdigest():
+            entry["checked"] = now
+            done[kind] = "unchanged"
+        else:
+            rows = write_table(os.path.join(path, kind + ".col"), kind,
+                               columns, data)
+            manifest[kind] = {"rows": rows, "digest": digest.hexdigest(),
+                              "taken": now, "checked": now}
+            done[kind] = "written"
+        save_manifest(path, manifest)
+        print("{:<13} {:<9} {} rows".format(
+            kind, done[kind], manifest[kind]["rows"]))
+    return(done)
+
+
+# Build the columns of a resource type from its rows. Strings are dictionary
+# encoded as they arrive: each distinct value gets the next code. Returns a
+# list of (name, type, data, values), where "values" is the list of distinct
+# strings of a string column (None otherwise).
+
+def build(kind, rows):
+    columns = []
+    appends = []
+    for name, ctype in SCHEMA[kind]:
+        if ctype == "str":
+            data = array(CODE)
+            index = {}
+            columns.append((name, ctype, data, index))
+            appends.append(lambda v, d=data.append, i=index:
+                           d(i.setdefault(v or "", len(i))))
+        else:
+            data = array(TYPECODES[ctype])
+            columns.append((name, ctype, data, None))
+            if ctype == "time":
+                appends.append(lambda v, d=data.append:
+                               d(v.timestamp() if v else 0.0))
+            else:
+                appends.append(lambda v, d=data.append: d(v or 0))
+    for row in rows:
+        for append, value in zip(appends, row):
+            append(value)
+    return([(name, ctype, data, list(index) if index is not None else None)
+            for name, ctype, data, index in columns])
+
+
+# Turn built columns into the byte blocks of the file, in order: per column
+# its data, then for string columns the offsets and the UTF-8 text of its
+# distinct values.
+
+def blocks(columns):
+    for name, ctype, data, values in columns:
+        yield(data.tobytes())
+        if values is not None:
+            text = [v.encode() for v in values]
+            offsets = array(OFFSET, [0])
+            for t in text:
+                offsets.append(offsets[-1] + len(t))
+            yield(offsets.tobytes())
+            yield(b"".join(text))
+
+
+# Write the columns of a resource type and their blocks to a file, through a
+# temporary file that replaces the old one once complete. Returns the number
+# of rows.
+
+def write_table(path, kind, columns, data):
+    rows = len(columns[0][2]) if columns else 0
+    layout = []
+    offset = 0
+    for block in data:
+        layout.append([offset, len(block)])
+        offset += len(block) + pad(len(block))
+
+    cols = []
+    spans = iter(layout)
+    for name, ctype, _, values in columns:
+        col = {"name": name, "type": ctype, "data": next(spans)}
+        if values is not None:
+            col.update(count=len(values), offsets=next(spans),
+                       text=next(spans))
+        cols.append(col)
+    header = json.dumps({"kind": kind, "rows": rows,
+                         "byteorder": sys.byteorder,
+                         "columns": cols}).encode()
+    start = len(MAGIC) + 8 + len(header)
+    start += pad(start)
+
+    with open(path + ".tmp", "wb") as f:
+        f.write(MAGIC + struct.pack("<Q", len(header)) + header)
+        f.write(b"\0" * (start - f.tell()))
+        for block in data:
+            f.write(block + b"\0" * pad(len(block)))
+    os.replace(path + ".tmp", path)
+    return(rows)
+
+
+def pad(size):
+    return(-size % 8)
+
+
+# Load and save the manifest of a snapshot: a dict of each resource type to
+# its row count, content digest, and when it last changed and was last
+# fetched.
+
+def load_manifest(path):
+    try:
+        with open(os.path.join(path, MANIFEST)) as f:
+            return(json.load(f))
+    except (OSError, ValueError):
+        return({})
+
+
+def save_manifest(path, manifest):
+    tmp = os.path.join(path, MANIFEST + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, os.path.join(path, MANIFEST))
+
+
+# Parse query conditions such as "State=running,AvailableIpAddressCount<16"
+# into the column=condition arguments of Table.where(). Each condition is a
+# column, one of = != < <= > >=, and a value. Raises ValueError if one is not
+# valid.
+
+OPERATORS = {"=": operator.eq, "!=": operator.ne, "<": operator.lt,
+             "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+
+
+def parse_where(table, text):
+    conds = {}
+    for part in text.split(","):
+        match = re.match(r"\s*(\w+)\s*(!=|<=|>=|=|<|>)\s*(.*?)\s*$", part)
+        if not match:
+            raise ValueError("Not a valid condition: {}".format(part))
+        name, op, value = match.groups()
+        col = table.column(name)
+        if col.type != "str":
+            value = float(value) if col.type == "time" else int(value)
+        if op == "=":
+            conds[name] = value
+        else:
+            conds[name] = (lambda v, f=OPERATORS[op], x=value: f(v, x))
+    return(conds)
+
+
+# A snapshot directory. Tables are opened (memory-mapped) on first use.
+
+class Snapshot():
+    def __init__(self, path):
+        self.path = path
+        self.manifest = load_manifest(path)
+        self.tables = {}
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def table(self, kind):
+        if kind not in self.tables:
+            if kind not in self.manifest:
+                raise KeyError("No {} in the snapshot at {}".format(
+                    kind, self.path))
+            self.tables[kind] = Table(os.path.join(self.path, kind + ".col"))
+        return(self.tables[kind])
+
+    def close(self):
+        for table in self.tables.values():
+            table.close()
+        self.tables = {}
+
+
+# One column of a memory-mapped table. "data" is a memoryview of the column
+# block. The distinct values of a string column are decoded on first use.
+
+class Column():
+    def __init__(self, mm, spec, base):
+        self.name = spec["name"]
+        self.type = spec["type"]
+        self.mm = mm
+        self.spec = spec
+        self.base = base
+        self.data = self.view(spec["data"], TYPECODES.get(self.type, CODE))
+        self.decoded = None
+
+    def view(self, span, typecode):
+        start = self.base + span[0]
+        return(memoryview(self.mm)[start:start + span[1]].cast(typecode))
+
+    @property
+    def values(self):
+        if self.decoded is None:
+            offsets = self.view(self.spec["offsets"], OFFSET)
+            start = self.base + self.spec["text"][0]
+            text = self.mm[start:start + self.spec["text"][1]]
+            self.decoded = [text[offsets[n]:offsets[n + 1]].decode()
+                            for n in range(self.spec["count"])]
+            offsets.release()
+        return(self.decoded)
+
+    def value(self, row):
+        if self.type == "str":
+            return(self.values[self.data[row]])
+        return(self.data[row])
+
+# Turn a condition into a test of the stored value of a row: the code of a
+# string, or the number. A condition is a value, a list, set or tuple of
+# values, or a function of the value. For string columns, the test is run
+# once per distinct value, not once per row.
+
+    def test(self, cond):
+        if self.type == "str":
+            if callable(cond):
+                codes = {n for n, v in enumerate(self.values) if cond(v)}
+            else:
+                wanted = set(cond) if isinstance(
+                    cond, (list, set, tuple)) else {cond}
+                codes = {n for n, v in enumerate(self.values) if v in wanted}
+            return(codes.__contains__)
+        if callable(cond):
+            return(cond)
+        if isinstance(cond, (list, set, tuple)):
+            return(set(cond).__contains__)
+        return(lambda v: v == cond)
+
+    def release(self):
+        self.data.release()
+
+
+# A memory-mapped table, or a selection of its rows made by where(). Row
+# numbers of a selection are kept in an array, in order.
+
+class Table():
+    def __init__(self, path, parent=None, selected=None):
+        if parent is None:
+            with open(path, "rb") as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.mm[:len(MAGIC)] != MAGIC:
+                raise ValueError("{} is not a snapshot table".format(path))
+            size = struct.unpack("<Q", self.mm[8:16])[0]
+            header = json.loads(self.mm[16:16 + size])
+            if header["byteorder"] != sys.byteorder:
+                raise ValueError("{} was written on a {}-endian machine"
+                                 .format(path, header["byteorder"]))
+            base = 16 + size + pad(16 + size)
+            self.kind = header["kind"]
+            self.total = header["rows"]
+            self.columns = {spec["name"]: Column(self.mm, spec, base)
+                            for spec in header["columns"]}
+        else:
+            self.mm = parent.mm
+            self.kind = parent.kind
+            self.total = parent.total
+            self.columns = parent.columns
+        self.parent = parent
+        self.selected = selected
+
+    def __len__(self):
+        return(self.total if self.selected is None else len(self.selected))
+
+    @property
+    def fields(self):
+        return(list(self.columns))
+
+    def rows(self):
+        return(range(self.total) if self.selected is None else self.selected)
+
+    def column(self, name):
+        if name not in self.columns:
+            raise KeyError("No column {} in {}. Choose from {}".format(
+                name, self.kind, ", ".join(self.columns)))
+        return(self.columns[name])
+
+# Select the rows matching every condition, given as column=condition (see
+# Column.test()). Returns a new Table over the same file.
+
+    def where(self, **conds):
+        rows = self.rows()
+        for name, cond in conds.items():
+            col = self.column(name)
+            data = col.data
+            test = col.test(cond)
+            if isinstance(rows, range):
+                rows = array(CODE, [r for r, v in enumerate(data) if test(v)])
+            else:
+                rows = array(CODE, [r for r in rows if test(data[r])])
+        return(Table(None, self.parent or self, rows))
+
+# Values of a column for the selected rows.
+
+    def values(self, name):
+        col = self.column(name)
+        if self.selected is None and col.type != "str":
+            return(col.data.tolist())
+        return([col.value(r) for r in self.rows()])
+
+# Count the selected rows per value of a column. Returns a dict of value to
+# count, largest first.
+
+    def count_by(self, name):
+        col = self.column(name)
+        data = col.data
+        if self.selected is None:
+            counts = Counter(data)
+        else:
+            counts = Counter(data[r] for r in self.selected)
+        if col.type == "str":
+            values = col.values
+            counts = {values[code]: n for code, n in counts.items()}
+        return(dict(sorted(counts.items(), key=lambda item: -item[1])))
+
+# Sum a numeric column over the selected rows, or per value of column "by".
+# Returns the total, or a dict of value to total, largest first.
+
+    def sum(self, name, by=None):
+        data = self.column(name).data
+        if by is None:
+            if self.selected is None:
+                return(sum(data))
+            return(sum(data[r] for r in self.selected))
+        col = self.column(by)
+        keys = col.data
+        totals = {}
+        for r in self.rows():
+            totals[keys[r]] = totals.get(keys[r], 0) + data[r]
+        if col.type == "str":
+            totals = {col.values[code]: n for code, n in totals.items()}
+        return(dict(sorted(totals.items(), key=lambda item: -item[1])))
+
+# Yield the selected rows as tuples of the given fields (all of them by
+# default), in that order.
+
+    def records(self, fields=None):
+        cols = [self.column(f) for f in fields or self.fields]
+        for r in self.rows():
+            yield(tuple(col.value(r) for col in cols))
+
+# Release the memory map. Only the table that opened the file closes it.
+
+    def close(self):
+        if self.parent is None:
+            for col in self.columns.values():
+                col.release()
+            self.mm.close()
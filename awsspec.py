@@ -0,0 +1,552 @@
+#!/usr/bin/env python3
+
+""" AWS Stack Specs
+
+This module contains the Spec() class, which keeps a stack of key pairs,
+subnets, instances, target groups and load balancers in line with a
+declarative spec:
+
+- A spec is a dict, usually loaded from a JSON file, that names each
+  resource of the stack and what it uses, by the names in the spec
+- plan() finds the live resources of the stack by their tags, with a few
+  batched describe calls made at the same time, and compares them with the
+  spec. The result is the smallest list of operations that makes them match:
+  create what is missing, modify what can be changed in place, replace what
+  cannot, and delete what is no longer in the spec
+- apply() runs only those operations as a Stack() of Aws() method calls, so
+  a stack with one changed instance makes one call for it
+
+What can be changed in place is the type and state of an instance, the
+instances of a target group, and the subnets and target group of a load
+balancer. A subnet that moves to another AZ or CIDR block, and an instance
+that moves to another subnet or key pair, are replaced.
+
+Example spec:
+
+    {"stack": "web",
+     "keypairs": {"webkey": {}},
+     "subnets": {"sub-a": {"cidr": "/24", "az": "a"},
+                 "sub-b": {"cidr": "/24", "az": "b"},
+                 "sub-c": {"cidr": "10.94.13.0/24", "az": "us-west-2c"}},
+     "instances": {"web-a": {"subnet": "sub-a", "key": "webkey"},
+                   "web-b": {"subnet": "sub-b", "key": "webkey",
+                             "type": "t3.small", "state": "stopped"}},
+     "targetgroups": {"web-tg": {"instances": ["web-a", "web-b"]}},
+     "albs": {"web-alb": {"subnets": ["sub-a", "sub-b", "sub-c"],
+                          "targetgroup": "web-tg"}}}
+
+"""
+
+# Import modules
+
+import ipaddress
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from awsclass import KINDNAMES
+from awsorch import LIVE_STATES, TOKEN, Ref, Stack, Teardown
+
+# Tags that mark the resources of a stack: the stack name, and the name of
+# the resource in the spec
+
+STACKTAG = "awstool:stack"
+NAMETAG = "awstool:name"
+
+# Resource types of a spec. Each type only uses types before it in the list.
+
+KINDS = ["keypairs", "subnets", "instances", "targetgroups", "albs"]
+
+# Listing of a plan
+
+PLANFIELDS = ["Action", "Kind", "Name", "Change"]
+PLANTEXT = "{Action:<8} {Kind:<13} {Name:<24} {Change}"
+
+
+# Load a spec from a JSON file. Returns the spec.
+
+def load_spec(path):
+    with open(path) as f:
+        return(check_spec(json.load(f)))
+
+
+# Check that a spec names its stack, that each resource only uses resources
+# of the spec (key pairs may also be existing ones), and that each load
+# balancer has three subnets. Raises ValueError for the first problem found.
+# Returns the spec.
+
+def check_spec(spec):
+    if not spec.get("stack"):
+        raise ValueError("The spec has no stack name")
+    for kind in spec:
+        if kind != "stack" and kind not in KINDS:
+            raise ValueError("Unknown resource type {} in the spec".format(
+                kind))
+
+    def uses(kind, name, what, names):
+        for used in names:
+            if used not in spec.get(what, {}):
+                raise ValueError("{} {} uses {} {}, which is not in the "
+                                 "spec".format(kind, name, what[:-1], used))
+
+    for name, sub in spec.get("subnets", {}).items():
+        if not sub.get("cidr") or not sub.get("az"):
+            raise ValueError("Subnet {} needs a cidr and an az".format(name))
+    for name, inst in spec.get("instances", {}).items():
+        uses("Instance", name, "subnets", [inst.get("subnet")])
+        if inst.get("state", "running") not in ("running", "stopped"):
+            raise ValueError("Instance {} state must be running or "
+                             "stopped".format(name))
+    for name, tg in spec.get("targetgroups", {}).items():
+        uses("Target group", name, "instances", tg.get("instances", []))
+    for name, alb in spec.get("albs", {}).items():
+        if len(alb.get("subnets", [])) != 3:
+            raise ValueError("ALB {} needs three subnets".format(name))
+        uses("ALB", name, "subnets", alb["subnets"])
+        uses("ALB", name, "targetgroups", [alb.get("targetgroup")])
+    return(spec)
+
+
+# One operation of a plan. "change" says what differs, and "id" is the ID or
+# ARN of the live resource it works on.
+
+def op(action, kind, name, change="", ident=None):
+    return({"Action": action, "Kind": kind, "Name": name, "Change": change,
+            "id": ident})
+
+
+class Spec():
+    def __init__(self, aws, spec, workers=16):
+        self.aws = aws
+        self.spec = check_spec(spec)
+        self.name = spec["stack"]
+        self.workers = workers
+        self.want = self.desired()
+        self.live = None
+        self.ops = None
+
+# The spec with its defaults filled in: the key pair and type of instances
+# from the settings, and an AZ given as a single letter in the region.
+
+    def desired(self):
+        aws = self.aws
+        want = {kind: {} for kind in KINDS}
+        for name in self.spec.get("keypairs", {}):
+            want["keypairs"][name] = {}
+        for name, sub in self.spec.get("subnets", {}).items():
+            az = sub["az"]
+            want["subnets"][name] = {
+                "cidr": sub["cidr"],
+                "az": aws.region + az if len(az) == 1 else az}
+        for name, inst in self.spec.get("instances", {}).items():
+            want["instances"][name] = {
+                "subnet": inst["subnet"], "key": inst.get("key", aws.mykey),
+                "type": inst.get("type", aws.ec2type),
+                "state": inst.get("state", "running")}
+        for name, tg in self.spec.get("targetgroups", {}).items():
+            want["targetgroups"][name] = {
+                "instances": sorted(tg.get("instances", []))}
+        for name, alb in self.spec.get("albs", {}).items():
+            want["albs"][name] = {"subnets": sorted(alb["subnets"]),
+                                  "targetgroup": alb["targetgroup"]}
+        return(want)
+
+# Tags of a resource of the stack.
+
+    def tags(self, name):
+        return({STACKTAG: self.name, NAMETAG: name})
+
+# Fetch method. Finds the live resources of the stack by their tags. The
+# subnets, instances, key pairs, load balancers and target groups are
+# described at the same time, then the listeners and targets of the load
+# balancers and target groups of the stack. Resources are named by their
+# name in the spec, and refer to each other by those names. A second
+# resource with the same name is kept as "<name> (<ID>)", so that the plan
+# deletes it. Returns a dict of each type with a dict of names to records.
+
+    def fetch(self):
+        aws = self.aws
+        teardown = Teardown(aws)
+        filters = [{"Name": "tag:" + STACKTAG, "Values": [self.name]}]
+        live = {kind: {} for kind in KINDS}
+
+        def add(kind, tags, ident, record):
+            tags = {t["Key"]: t["Value"] for t in tags}
+            name = tags.get(NAMETAG, ident)
+            if name in live[kind]:
+                name = "{} ({})".format(name, ident)
+            live[kind][name] = dict(record, id=ident)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            subs = pool.submit(teardown.paged, aws.ec2c, "describe_subnets",
+                               "Subnets", Filters=filters)
+            insts = pool.submit(teardown.paged, aws.ec2c,
+                                "describe_instances", "Reservations",
+                                Filters=filters + [{
+                                    "Name": "instance-state-name",
+                                    "Values": LIVE_STATES}])
+            keys = pool.submit(aws.ec2c.describe_key_pairs, Filters=filters)
+            albs = pool.submit(teardown.paged, aws.elbv2c,
+                               "describe_load_balancers", "LoadBalancers")
+            tgs = pool.submit(teardown.paged, aws.elbv2c,
+                              "describe_target_groups", "TargetGroups")
+
+            # The load balancers and target groups of the stack are found
+            # from their tags, and their listeners and targets are read at
+            # the same time.
+
+            albs = {a["LoadBalancerArn"]: a for a in albs.result()}
+            tgs = {t["TargetGroupArn"]: t for t in tgs.result()}
+            elbtags = {}
+            for arns in (list(albs), list(tgs)):
+                for i in range(0, len(arns), 20):
+                    descs = aws.elbv2c.describe_tags(
+                        ResourceArns=arns[i:i + 20])["TagDescriptions"]
+                    for desc in descs:
+                        if {"Key": STACKTAG, "Value": self.name} in \
+                                desc["Tags"]:
+                            elbtags[desc["ResourceArn"]] = desc["Tags"]
+            listeners = {arn: pool.submit(
+                teardown.paged, aws.elbv2c, "describe_listeners",
+                "Listeners", LoadBalancerArn=arn)
+                for arn in albs if arn in elbtags}
+            targets = {arn: pool.submit(
+                aws.elbv2c.describe_target_health, TargetGroupArn=arn)
+                for arn in tgs if arn in elbtags}
+
+            for key in keys.result()["KeyPairs"]:
+                add("keypairs", key.get("Tags", []), key["KeyName"], {})
+            for sub in subs.result():
+                add("subnets", sub.get("Tags", []), sub["SubnetId"],
+                    {"cidr": sub["CidrBlock"],
+                     "az": sub["AvailabilityZone"]})
+            for res in insts.result():
+                for inst in res["Instances"]:
+                    add("instances", inst.get("Tags", []),
+                        inst["InstanceId"], {
+                            "subnet": inst["SubnetId"],
+                            "key": inst.get("KeyName"),
+                            "type": inst["InstanceType"],
+                            "state": "running" if inst["State"]["Name"] in
+                            ("pending", "running") else "stopped"})
+            for arn, health in targets.items():
+                add("targetgroups", elbtags[arn], arn, {"instances": [
+                    t["Target"]["Id"] for t in
+                    health.result()["TargetHealthDescriptions"]
+                    if t["TargetHealth"]["State"] != "draining"]})
+            for arn, found in listeners.items():
+                forward = [a.get("TargetGroupArn") for ln in found.result()
+                           if ln["Port"] == 80 for a in ln["DefaultActions"]]
+                add("albs", elbtags[arn], arn, {
+                    "subnets": [z["SubnetId"]
+                                for z in albs[arn]["AvailabilityZones"]],
+                    "targetgroup": forward[0] if forward else None})
+
+        # Refer to other resources by their names in the spec
+
+        names = {kind: {r["id"]: name for name, r in live[kind].items()}
+                 for kind in KINDS}
+        for inst in live["instances"].values():
+            inst["subnet"] = names["subnets"].get(
+                inst["subnet"], inst["subnet"])
+        for tg in live["targetgroups"].values():
+            tg["instances"] = sorted(names["instances"].get(i, i)
+                                     for i in tg["instances"])
+        for alb in live["albs"].values():
+            alb["subnets"] = sorted(names["subnets"].get(s, s)
+                                    for s in alb["subnets"])
+            alb["targetgroup"] = names["targetgroups"].get(
+                alb["targetgroup"], alb["targetgroup"])
+        self.live = live
+        return(live)
+
+# Plan method. Compares the spec with the live stack and prints the
+# operations that would make them match, through the "output" mode of the
+# Aws() object (see awsout.py). Types are compared in KINDS order, so a
+# resource that uses a replaced one is replaced or modified too. Returns the
+# list of operations.
+
+    def plan(self, output=None):
+        live = self.fetch()
+        ops = []
+        new = set()
+
+        for kind in KINDS:
+            for name, want in self.want[kind].items():
+                have = live[kind].get(name)
+                if have is None:
+                    ops.append(op("create", kind, name))
+                    new.add((kind, name))
+                    continue
+                why = self.replacing(kind, want, have, new)
+                albs = self.blockers(name) if why and kind == "subnets" \
+                    else []
+                if albs:
+                    ops.append(op("blocked", kind, name, "{}, but ALB {} "
+                                  "uses it: pick a block that does not "
+                                  "overlap".format(why, ", ".join(albs)),
+                                  have["id"]))
+                    continue
+                if why:
+                    ops.append(op("replace", kind, name, why, have["id"]))
+                    new.add((kind, name))
+                    continue
+                changes = self.changes(kind, want, have, new)
+                if changes:
+                    ops.append(op("modify", kind, name, ", ".join(changes),
+                                  have["id"]))
+            for name, have in live[kind].items():
+                if name not in self.want[kind]:
+                    ops.append(op("delete", kind, name, "", have["id"]))
+
+        with self.aws.listing(output, PLANFIELDS, PLANTEXT,
+                              "\nPlan for stack {}:".format(self.name)) as out:
+            for each in ops:
+                out.emit(each)
+            out.note("{} to create, {} to replace, {} to modify, {} to "
+                     "delete, {} blocked".format(
+                         *[sum(o["Action"] == a for o in ops)
+                           for a in ("create", "replace", "modify", "delete",
+                                     "blocked")]))
+        self.ops = ops
+        return(ops)
+
+# A subnet whose new CIDR block overlaps its old one has to be deleted
+# before it is created again, but a load balancer that is kept has to move
+# to the new subnet before the old one can go. Returns the names of such
+# load balancers, so plan() can mark the subnet as blocked.
+
+    def blockers(self, name):
+        if not self.overlaps(name):
+            return([])
+        return(sorted(alb for alb, have in self.live["albs"].items()
+                      if name in have["subnets"] and alb in self.want["albs"]))
+
+# Why a live resource has to be replaced, or "" if it does not.
+
+    def replacing(self, kind, want, have, new):
+        if kind == "subnets":
+            if want["az"] != have["az"]:
+                return("az {} -> {}".format(have["az"], want["az"]))
+            if want["cidr"].startswith("/"):
+                if have["cidr"].endswith(want["cidr"]):
+                    return("")
+            elif ipaddress.ip_network(want["cidr"]) == \
+                    ipaddress.ip_network(have["cidr"]):
+                return("")
+            return("cidr {} -> {}".format(have["cidr"], want["cidr"]))
+        if kind == "instances":
+            if ("subnets", want["subnet"]) in new or \
+                    want["subnet"] != have["subnet"]:
+                return("subnet {}".format(want["subnet"]))
+            if want["key"] != have["key"]:
+                return("key {} -> {}".format(have["key"], want["key"]))
+        return("")
+
+# What has to be changed in a live resource that is kept. Returns a list of
+# changes, empty if it already matches the spec.
+
+    def changes(self, kind, want, have, new):
+        changes = []
+        if kind == "instances":
+            for field in ("type", "state"):
+                if want[field] != have[field]:
+                    changes.append("{} {} -> {}".format(
+                        field, have[field], want[field]))
+        elif kind == "targetgroups":
+            if want["instances"] != have["instances"] or any(
+                    ("instances", i) in new for i in want["instances"]):
+                changes.append("instances")
+        elif kind == "albs":
+            if want["subnets"] != have["subnets"] or any(
+                    ("subnets", s) in new for s in want["subnets"]):
+                changes.append("subnets")
+            if want["targetgroup"] != have["targetgroup"] or \
+                    ("targetgroups", want["targetgroup"]) in new:
+                changes.append("targetgroup {}".format(want["targetgroup"]))
+        return(changes)
+
+# Apply method. Runs the operations of a plan, planning first if no plan was
+# given, as one Stack() so that independent operations run at the same time:
+#
+#   create  - the Aws() create method, with the stack tags
+#   modify  - modify_inst(), set_targets() or set_alb()
+#   replace - a create, then a delete of the old resource once nothing uses
+#             it. A subnet whose new CIDR block overlaps the old one is
+#             deleted first instead, so the instances in it are deregistered
+#             from their target groups and deleted before the target groups
+#             get their new instances
+#   delete  - the Teardown() delete of its type, load balancers first
+#
+# Nothing is run if the plan has a blocked operation (see blockers()).
+# Returns the dict of step results, or None if a step failed or the
+# operations cannot be run.
+
+    def apply(self, ops=None):
+        if ops is None:
+            ops = self.plan() if self.ops is None else self.ops
+        if not ops:
+            print("Stack {} is up to date".format(self.name))
+            return({})
+        blocked = [o["Name"] for o in ops if o["Action"] == "blocked"]
+        if blocked:
+            print("Cannot apply the plan: subnet {} is blocked".format(
+                ", ".join(blocked)))
+            return(None)
+        aws = self.aws
+        stack = Stack(self.workers)
+        made = {}
+        deletes = {kind: [] for kind in KINDS}
+        modifies = {kind: [] for kind in KINDS}
+
+        def ref(kind, name):
+            if (kind, name) in made:
+                return(made[(kind, name)])
+            if name in self.live[kind]:
+                return(self.live[kind][name]["id"])
+            return(name)
+
+        for each in ops:
+            kind, name = each["Kind"], each["Name"]
+            step = "{} {} {}".format(each["Action"], kind, name)
+            if each["Action"] in ("delete", "replace"):
+                deletes[kind].append(("delete {} {}".format(kind, name),
+                                      name, each["id"]))
+            if each["Action"] == "modify":
+                modifies[kind].append(step)
+                self.add_modify(stack, step, kind, name, each["id"], ref)
+            elif each["Action"] in ("create", "replace"):
+                step = "create {} {}".format(kind, name)
+                after = []
+                if kind == "subnets" and each["Action"] == "replace" and \
+                        self.overlaps(name):
+                    after = ["delete subnets " + name]
+                made[(kind, name)] = self.add_create(
+                    stack, step, kind, name, ref, after)
+
+        # Deletes wait for what stops using the resource: load balancers
+        # first, target groups once no load balancer forwards to them,
+        # instances once they are out of their target groups, and subnets
+        # once their instances and load balancers have left. An instance in
+        # a subnet that has to go first cannot wait for the target groups to
+        # get the new instances, which need the new subnet, so it is
+        # deregistered by a step of its own.
+
+        first = {each["Name"] for each in ops if each["Kind"] == "subnets"
+                 and each["Action"] == "replace" and self.overlaps(
+                     each["Name"])}
+        albsteps = [s for s, _, _ in deletes["albs"]] + modifies["albs"]
+        waits = {
+            "keypairs": [], "albs": [],
+            "targetgroups": albsteps,
+            "instances": modifies["targetgroups"],
+            "subnets": [s for s, _, _ in deletes["instances"]] + albsteps,
+        }
+        for kind in KINDS:
+            for step, name, ident in deletes[kind]:
+                after = waits[kind]
+                if kind == "instances" and \
+                        self.live[kind][name]["subnet"] in first:
+                    after = ["deregister instances " + name]
+                    stack.add(after[0], self.deregister, name)
+                stack.add(step, self.delete, kind, ident, after=after)
+
+        try:
+            stack.order()
+        except ValueError as e:
+            print("Cannot apply the plan: {}".format(e))
+            return(None)
+        results = stack.run()
+        aws.invalidate(*KINDS)
+        if stack.failed or stack.skipped:
+            return(None)
+        return(results)
+
+# Add the create step of a resource. Returns the Ref() to its result.
+
+    def add_create(self, stack, step, kind, name, ref, after):
+        aws = self.aws
+        want = self.want[kind][name]
+        tags = self.tags(name)
+        if kind == "keypairs":
+            return(stack.add(step, aws.create_keypair, name, tags=tags,
+                             after=after))
+        if kind == "subnets":
+            return(stack.add(step, aws.create_subnet, want["cidr"],
+                             want["az"], tags=tags, after=after))
+        if kind == "instances":
+            new = stack.add(step, aws.create_inst,
+                            ref("subnets", want["subnet"]),
+                            ref("keypairs", want["key"]), name, tags=tags,
+                            insttype=want["type"], token=TOKEN, after=after)
+            if want["state"] == "stopped":
+                stack.add("stop instances " + name, aws.modify_inst, new,
+                          state="stopped")
+            return(new)
+        if kind == "targetgroups":
+            return(stack.add(step, aws.create_target_group, name,
+                             *[ref("instances", i)
+                               for i in want["instances"]],
+                             tags=tags, after=after))
+        return(stack.add(step, aws.create_alb, name,
+                         *[ref("subnets", s) for s in want["subnets"]],
+                         ref("targetgroups", want["targetgroup"]),
+                         tags=tags, after=after))
+
+# Add the modify step of a resource.
+
+    def add_modify(self, stack, step, kind, name, ident, ref):
+        aws = self.aws
+        want = self.want[kind][name]
+        have = self.live[kind][name]
+        if kind == "instances":
+            stack.add(step, aws.modify_inst, ident,
+                      insttype=want["type"], state=want["state"])
+        elif kind == "targetgroups":
+            stack.add(step, aws.set_targets, ident,
+                      [ref("instances", i) for i in want["instances"]])
+        else:
+            subnets = [ref("subnets", s) for s in want["subnets"]]
+            tg = ref("targetgroups", want["targetgroup"])
+            if want["subnets"] == have["subnets"] and not any(
+                    isinstance(s, Ref) for s in subnets):
+                subnets = None
+            if want["targetgroup"] == have["targetgroup"] and \
+                    not isinstance(tg, Ref):
+                tg = None
+            stack.add(step, aws.set_alb, ident, subnets=subnets, tgarn=tg)
+
+# Whether the CIDR block a replaced subnet asks for overlaps its old one, so
+# the old one has to go first. A "/NN" block never does, as the allocator
+# only hands out free blocks.
+
+    def overlaps(self, name):
+        cidr = self.want["subnets"][name]["cidr"]
+        if cidr.startswith("/"):
+            return(False)
+        return(ipaddress.ip_network(cidr).overlaps(
+            ipaddress.ip_network(self.live["subnets"][name]["cidr"])))
+
+# Deregister a live instance from the live target groups of the stack that
+# have it. Returns its ID, or None if a target group could not be changed.
+
+    def deregister(self, name):
+        ident = self.live["instances"][name]["id"]
+        arns = [tg["id"] for tg in self.live["targetgroups"].values()
+                if name in tg["instances"]]
+        failed = Teardown(self.aws).each(
+            arns, lambda arn: self.aws.elbv2c.deregister_targets(
+                TargetGroupArn=arn, Targets=[{"Id": ident}]))
+        if failed:
+            return(None)
+        return(ident)
+
+# Delete one live resource with the Teardown() delete of its type. Returns
+# its ID or ARN, or None if it could not be deleted.
+
+    def delete(self, kind, ident):
+        failed = getattr(Teardown(self.aws), "delete_" + kind)([ident])
+        if failed:
+            return(None)
+        if kind in KINDNAMES:
+            self.aws.unindex(kind, [ident])
+        return(ident)
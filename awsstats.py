@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+""" AWS Call Statistics
+
+This module contains the CallStats() class. It hooks into the botocore event
+system of every client the Aws() class builds and records each API call:
+
+- Calls, errors, retries and response bytes are counted per operation (for
+  example ec2.DescribeInstances)
+- The latency of each call, from the moment it is made to the moment its
+  response is parsed (retries and throttle waits included), goes into a
+  histogram with buckets 25% apart, from which p50, p95 and p99 are read
+- The results can be printed as a table sorted by total time, which shows
+  the slow calls and the calls made far more often than expected (N+1
+  patterns), or exported as JSON or as Prometheus text
+
+"""
+
+# Import modules
+
+import json
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets: 1ms up to about
+# 9 minutes, each 25% wider than the last. Slower calls go in one last bucket.
+
+BOUNDS = [0.001 * 1.25 ** i for i in range(60)]
+
+
+# Counters of one operation.
+
+class OpStats():
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BOUNDS) + 1)
+
+    def add(self, seconds, retries, size, error):
+        self.calls += 1
+        self.errors += bool(error)
+        self.retries += retries
+        self.bytes += size
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        index = 0
+        while index < len(BOUNDS) and seconds > BOUNDS[index]:
+            index += 1
+        self.buckets[index] += 1
+
+# Latency at quantile q (0 to 1), as the upper bound of the bucket it falls
+# in, capped at the slowest call seen.
+
+    def quantile(self, q):
+        if not self.calls:
+            return(0.0)
+        rank = q * self.calls
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                break
+        return(min(self.max, BOUNDS[index] if index < len(BOUNDS)
+                   else self.max))
+
+    def summary(self):
+        return({"calls": self.calls, "errors": self.errors,
+                "retries": self.retries, "bytes": self.bytes,
+                "total": self.total, "mean": self.total / max(self.calls, 1),
+                "max": self.max, "p50": self.quantile(0.5),
+                "p95": self.quantile(0.95), "p99": self.quantile(0.99)})
+
+
+class CallStats():
+    def __init__(self):
+        self.ops = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+# Hook the recorder into a client. The start time is stored in the context of
+# the call, which botocore passes to every event of that call. before-call is
+# registered first so the time is taken before any other handler runs.
+
+    def register(self, client):
+        events = client.meta.events
+        events.register_first("before-call", self.before_call)
+        events.register("after-call", self.after_call)
+        events.register("after-call-error", self.after_call_error)
+
+    def before_call(self, model, context, **kwargs):
+        context["callstats"] = ("{}.{}".format(
+            model.service_model.service_name, model.name), time.monotonic())
+
+# after-call handler. Runs once per call after the last attempt, whether it
+# succeeded or not. Streaming responses (such as S3 GetObject) are measured
+# by their Content-Length, so their body is not read here.
+
+    def after_call(self, http_response, parsed, model, context, **kwargs):
+        if "callstats" not in context:
+            return
+        if model.has_streaming_output:
+            size = int(http_response.headers.get("content-length", 0))
+        else:
+            size = len(http_response.content or b"")
+        retries = parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        self.record(context, retries, size,
+                    http_response.status_code >= 300 or "Error" in parsed)
+
+# after-call-error handler. Runs when a call fails without a response, such as
+# a connection error on the last attempt.
+
+    def after_call_error(self, exception, context, **kwargs):
+        if "callstats" in context:
+            self.record(context, 0, 0, True)
+
+    def record(self, context, retries, size, error):
+        name, start = context.pop("callstats")
+        seconds = time.monotonic() - start
+        with self.lock:
+            if name not in self.ops:
+                self.ops[name] = OpStats()
+            self.ops[name].add(seconds, retries, size, error)
+
+# Return the summary of every operation, slowest in total first.
+
+    def snapshot(self):
+        with self.lock:
+            stats = {name: op.summary() for name, op in self.ops.items()}
+        return(dict(sorted(stats.items(), key=lambda item: -item[1]["total"])))
+
+    def reset(self):
+        with self.lock:
+            self.ops = {}
+            self.started = time.time()
+
+# Print the summary of every operation as a table, slowest in total first.
+# Returns the summary.
+
+    def report(self):
+        stats = self.snapshot()
+        print("\n{:<40} {:>6} {:>5} {:>5} {:>9} {:>8} {:>8} {:>8} {:>10}"
+              .format("Operation", "Calls", "Errs", "Retry", "Total s",
+                      "p50 ms", "p95 ms", "p99 ms", "Bytes"))
+        for name, op in stats.items():
+            print("{:<40} {calls:>6} {errors:>5} {retries:>5} {total:>9.2f} "
+                  "{:>8.1f} {:>8.1f} {:>8.1f} {bytes:>10}".format(
+                      name, op["p50"] * 1000, op["p95"] * 1000,
+                      op["p99"] * 1000, **op))
+        print("{} calls to {} operations, {:.2f}s in API calls".format(
+            sum(op["calls"] for op in stats.values()), len(stats),
+            sum(op["total"] for op in stats.values())))
+        return(stats)
+
+    def to_json(self):
+        return(json.dumps({"started": self.started, "exported": time.time(),
+                           "operations": self.snapshot()}, indent=1))
+
+# Prometheus text format. Latency is exported as a summary with the p50, p95
+# and p99 quantiles, and the counters as one series per operation.
+
+    def to_prometheus(self):
+        lines = [
+            "# HELP awstool_call_seconds Latency of AWS API calls.",
+            "# TYPE awstool_call_seconds summary"]
+        stats = self.snapshot()
+        for name, op in stats.items():
+            service, operation = name.split(".", 1)
+            labels = 'service="{}",operation="{}"'.format(service, operation)
+            for q in ("p50", "p95", "p99"):
+                lines.append('awstool_call_seconds{{{},quantile="0.{}"}} {}'
+                             .format(labels, q[1:], op[q]))
+            lines.append("awstool_call_seconds_sum{{{}}} {}".format(
+                labels, op["total"]))
+            lines.append("awstool_call_seconds_count{{{}}} {}".format(
+                labels, op["calls"]))
+        for counter, field, text in (
+                ("errors", "errors", "AWS API calls that failed."),
+                ("retries", "retries", "Retries of AWS API calls."),
+                ("response_bytes", "bytes", "Bytes in AWS API responses.")):
+            metric = "awstool_call_{}_total".format(counter)
+            lines.append("# HELP {} {}".format(metric, text))
+            lines.append("# TYPE {} counter".format(metric))
+            for name, op in stats.items():
+                service, operation = name.split(".", 1)
+                lines.append(
+                    '{}{{service="{}",operation="{}"}} {}'.format(
+                        metric, service, operation, op[field]))
+        return("\n".join(lines) + "\n")
@@ -6,43 +6,42 @@ This program is a menu-driven AWS utility that performs the following:
 
 - Create, list, and delete subnets in the VPC
 - Create, list, and delete S3 buckets. Also list the files in the buckets
+  and sync a local directory to a bucket
 - Create, list, and rename EC2 instances
 - Start, stop, and terminate EC2 instances
 - Create, list, and delete EC2 keypair
 - Create, list and delete Application Load Balancers
 
+Commands can also be run from the command line, one at a time or from a batch
+file with --batch. Run 'awstool.py --help' for the list.
+
 """
 
 # Import modules
 
+import argparse
 import boto3
+import os
+import shlex
 import sys
-from configparser import ConfigParser
-
-# Load the configuration settings from the "credentials" file
-
+from concurrent.futures import ThreadPoolExecutor
+from awsclass import Aws, empty_bucket, sync
+from awsout import MODES, Output
+from awssnap import Snapshot, parse_where, take
+from awsspec import Spec, load_spec
 
-awscfg = ConfigParser()
-awscfg.read("/home/ec2-user/.aws/credentials")
-region = awscfg.get("default", "region")
-mykey = awscfg.get("default", "key")
-mysg = awscfg.get("default", "secgroup")
-myami = awscfg.get("default", "ami")
-ec2type = awscfg.get("default", "ec2type")
-myvpc = awscfg.get("default", "vpc")
+# Load the configuration settings from the "credentials" file. The "client"
+# and "resource" objects for EC2, S3 and ELBv2 are built by the Aws() class
+# the first time a command uses them, so starting the tool stays fast.
 
-# Set the "resource" and "client" variables for EC2 and S3
-# AWS functions are separated between the "client" and "resource"
-# variables.
 
-
-ec2r = boto3.resource("ec2")
-ec2c = boto3.client("ec2")
-s3r = boto3.resource("s3")
-s3c = boto3.client("s3")
-elbv2c = boto3.client("elbv2")
-
-vpc = ec2r.Vpc(myvpc)
+aws = Aws()
+region = aws.region
+mykey = aws.mykey
+mysg = aws.mysg
+myami = aws.myami
+ec2type = aws.ec2type
+myvpc = aws.myvpc
 
 # Help menu
 
@@ -71,6 +70,9 @@ Type 'cbuck' to create an S3 bucket
 Type 'dbuck' to delete an S3 buckets
 Type 'lbuck' to list the S3 buckets
 Type 'ls' to list all S3 files
+Type 'sync' to sync a directory to an S3 bucket
+Type 'inv' to list the resources of several regions
+Type 'stats' to show the API call statistics of this session
 Type 'x' to exit
 
 """
@@ -107,12 +109,17 @@ def help_menu():
 
 
 def create_subnet():
-    subnetvar = input("Enter the subnet (Ex: 192.168.94.0/24): ").strip()
+    subnetvar = input("Enter the subnet (Ex: 192.168.94.0/24, or /24 for the "
+                      "next free block): ").strip()
     az = input("Enter the availability zone (Ex: us-west-2a): ").strip()
+    if subnetvar.startswith("/"):
+        aws.create_subnet(subnetvar, az)
+        return
 
     try:
-        newsub = vpc.create_subnet(CidrBlock=subnetvar, AvailabilityZone=az)
-        vpc.create_tags(
+        newsub = aws.vpc.create_subnet(
+            CidrBlock=subnetvar, AvailabilityZone=az)
+        aws.vpc.create_tags(
             Resources=[newsub.id],
             Tags=[{"Key": "Name", "Value": "subnet-{}-{}".format(
                 newsub.availability_zone[-2:],
@@ -129,7 +136,7 @@ def delete_subnet():
     subid = input("Enter the subnet ID: ").strip()
 
     try:
-        ec2c.delete_subnet(SubnetId=subid)
+        aws.ec2c.delete_subnet(SubnetId=subid)
         print("\nThe subnet {} was deleted.".format(subid))
     except boto3.exceptions.botocore.client.ClientError as e:
         print(e.response["Error"]["Message"].strip("\""))
@@ -138,33 +145,13 @@ def delete_subnet():
 
 
 def list_subnets_all():
-    listsub = ec2c.describe_subnets()
-    lsdict = {}
-
-    for sub in listsub["Subnets"]:
-        # print(
-        # "Subnet ID = {0} with CIDR of {1} in AZ {2} with {3} available IPs"
-        # .format(sub["SubnetId"], sub["CidrBlock"], sub["AvailabilityZone"],
-        # str(sub["AvailableIpAddressCount"])))
-        print(
-            "Subnet ID = {SubnetId} with CIDR of {CidrBlock} in AZ "
-            "{AvailabilityZone} with {AvailableIpAddressCount} available "
-            "IPs".format(**sub))
-        lsdict[sub["SubnetId"]] = sub["CidrBlock"]
-    return(lsdict)
+    return(aws.list_subnets_all())
 
 # List subnets for a particular AZ function
 
 
 def list_subnets_az(subaz):
-    listsubaz = ec2c.describe_subnets(
-        Filters=[{"Name": "availabilityZone", "Values": [subaz]}])
-
-    for sub in listsubaz["Subnets"]:
-        print(
-            "Subnet ID = {SubnetId} with CIDR of {CidrBlock} in AZ "
-            "{AvailabilityZone} with {AvailableIpAddressCount} available "
-            "IPs".format(**sub))
+    return(aws.list_subnets_az(subaz))
 
 # Create new EC2 instances function
 
@@ -175,13 +162,13 @@ def create_inst():
     instname = input("Enter the name: ").strip()
 
     try:
-        newinst = ec2c.run_instances(
+        newinst = aws.ec2c.run_instances(
             ImageId=myami, MinCount=1, MaxCount=1, KeyName=mykey,
             InstanceType=ec2type, SecurityGroupIds=[mysg], SubnetId=subid,
-            UserData=userdata)
-        ec2c.create_tags(
-            Resources=[newinst["Instances"][0]["InstanceId"]],
-            Tags=[{"Key": "Name", "Value": instname}])
+            UserData=userdata,
+            TagSpecifications=[{
+                "ResourceType": "instance",
+                "Tags": [{"Key": "Name", "Value": instname}]}])
         print(
             "\nThe instance ID created was {} and is named {}".format(
                 newinst["Instances"][0]["InstanceId"], instname))
@@ -196,7 +183,7 @@ def start_inst():
     instid = input("Enter the instance ID: ").strip()
 
     try:
-        ec2c.start_instances(InstanceIds=[instid])
+        aws.ec2c.start_instances(InstanceIds=[instid])
         print("Started instance {}".format(instid))
     except boto3.exceptions.botocore.client.ClientError as e:
         print(e.response["Error"]["Message"].strip("\""))
@@ -207,7 +194,7 @@ def stop_inst():
     instid = input("Enter the instance ID: ").strip()
 
     try:
-        ec2c.stop_instances(InstanceIds=[instid])
+        aws.ec2c.stop_instances(InstanceIds=[instid])
         print("Stopped instance {}".format(instid))
     except boto3.exceptions.botocore.client.ClientError as e:
         print(e.response["Error"]["Message"].strip("\""))
@@ -220,7 +207,7 @@ def term_inst():
     instid = input("Enter the instance ID: ").strip()
 
     try:
-        ec2c.terminate_instances(InstanceIds=[instid])
+        aws.ec2c.terminate_instances(InstanceIds=[instid])
         print("Terminated instance {}".format(instid))
     except boto3.exceptions.botocore.client.ClientError as e:
         print(e.response["Error"]["Message"].strip("\""))
@@ -229,16 +216,7 @@ def term_inst():
 
 
 def list_inst():
-    listinst = ec2c.describe_instances()
-    dcinst = {}
-    for res in listinst["Reservations"]:
-        for inst in res["Instances"]:
-            print(
-                "ID: {InstanceId}  Type: {InstanceType}  AZ: "
-                "{Placement[AvailabilityZone]}  State: {State[Name]}  "
-                "Name: {Tags[0][Value]}".format(**inst))
-            dcinst.update({inst["State"]["Name"]: inst["Tags"][0]["Value"]})
-    return(dcinst)
+    return(aws.list_inst())
 
 # Rename an EC2 instance function
 
@@ -249,7 +227,7 @@ def ren_inst():
     newname = input("Enter the new name: ").strip()
 
     try:
-        ec2c.create_tags(
+        aws.ec2c.create_tags(
             Resources=[instid], Tags=[{"Key": "Name", "Value": newname}])
         print("The instance was renamed to {}".format(newname))
     except boto3.exceptions.botocore.client.ClientError as e:
@@ -260,22 +238,21 @@ def ren_inst():
 
 def create_alb():
     albname = input("Enter the name of the ALB: ").strip()
-    list_subnets_az("us-west-2a")
-    sub1 = input("Enter the subnet for {}a: ".format(region)).strip()
-    list_subnets_az("us-west-2b")
-    sub2 = input("Enter the subnet for {}b: ".format(region)).strip()
-    list_subnets_az("us-west-2c")
-    sub3 = input("Enter the subnet for {}c: ".format(region)).strip()
+    subs = []
+    for az in aws.list_azs()[:3]:
+        list_subnets_az(az)
+        subs.append(input("Enter the subnet for {}: ".format(az)).strip())
     list_target_groups()
     tgname = input("Enter the target group: ").strip()
-    tgarn = elbv2c.describe_target_groups(
-        Names=[tgname])["TargetGroups"][0]["TargetGroupArn"]
+    tgarn = aws.resolve("targetgroups", tgname)
+    if tgarn is None:
+        return
 
     try:
-        newalb = elbv2c.create_load_balancer(
-            Name=albname, Subnets=[sub1, sub2, sub3], SecurityGroups=[mysg],
+        newalb = aws.elbv2c.create_load_balancer(
+            Name=albname, Subnets=subs, SecurityGroups=[mysg],
             Scheme="internet-facing", IpAddressType="ipv4")
-        elbv2c.create_listener(
+        aws.elbv2c.create_listener(
             LoadBalancerArn=newalb["LoadBalancers"][0]["LoadBalancerArn"],
             Protocol="HTTP", Port=80,
             DefaultActions=[{"Type": "forward", "TargetGroupArn": tgarn}])
@@ -289,12 +266,7 @@ def create_alb():
 
 
 def list_alb():
-    listalb = elbv2c.describe_load_balancers()
-
-    for alb in listalb["LoadBalancers"]:
-        print(
-            "LB Name = {LoadBalancerName}  "
-            "DNS Name = {DNSName}".format(**alb))
+    return(aws.list_alb())
 
 # Delete an Application Load Balancer function
 
@@ -302,10 +274,12 @@ def list_alb():
 def delete_alb():
     list_alb()
     albname = input("Enter the ALB name: ").strip()
-    albarn = elbv2c.describe_load_balancers(
-        Names=[albname])["LoadBalancers"][0]["LoadBalancerArn"]
+    albarn = aws.resolve("albs", albname)
+    if albarn is None:
+        return
     try:
-        elbv2c.delete_load_balancer(LoadBalancerArn=albarn)
+        aws.elbv2c.delete_load_balancer(LoadBalancerArn=albarn)
+        aws.unindex("albs", [albarn])
         print("ALB {} deleted.".format(albname))
     except boto3.exceptions.botocore.client.ClientError as e:
         print(e.response["Error"]["Message"].strip("\""))
@@ -321,10 +295,10 @@ def create_target_group():
     inst3 = input("Enter the third instance for the group: ").strip()
 
     try:
-        newtg = elbv2c.create_target_group(
+        newtg = aws.elbv2c.create_target_group(
             Name=tgname, Protocol="HTTP", Port=80, VpcId=myvpc)
         tgarn = newtg["TargetGroups"][0]["TargetGroupArn"]
-        elbv2c.register_targets(
+        aws.elbv2c.register_targets(
             TargetGroupArn=tgarn,
             Targets=[{"Id": inst1}, {"Id": inst2}, {"Id": inst3}])
         print(
@@ -337,23 +311,20 @@ def create_target_group():
 
 
 def list_target_groups():
-    listtg = elbv2c.describe_target_groups()
-
-    for tg in listtg["TargetGroups"]:
-        print(
-            "TG Name = {TargetGroupName}  "
-            "ARN = {TargetGroupArn}".format(**tg))
+    return(aws.list_target_groups())
 
 # Delete ALB target group function
 
 
 def delete_target_group():
     tgname = input("Enter the name of the target group: ").strip()
-    tgarn = elbv2c.describe_target_groups(
-        Names=[tgname])["TargetGroups"][0]["TargetGroupArn"]
+    tgarn = aws.resolve("targetgroups", tgname)
+    if tgarn is None:
+        return
 
     try:
-        elbv2c.delete_target_group(TargetGroupArn=tgarn)
+        aws.elbv2c.delete_target_group(TargetGroupArn=tgarn)
+        aws.unindex("targetgroups", [tgarn])
         print("Target group {} deleted.".format(tgname))
     except boto3.exceptions.botocore.client.ClientError as e:
         print(e.response["Error"]["Message"].strip("\""))
@@ -365,7 +336,7 @@ def create_keypair():
     keyname = input("Enter the key pair name: ").strip()
 
     try:
-        key = ec2c.create_key_pair(KeyName=keyname)
+        key = aws.ec2c.create_key_pair(KeyName=keyname)
         print("\nKey pair created. The following is the key:\n")
         print(key["KeyMaterial"])
     except boto3.exceptions.botocore.client.ClientError as e:
@@ -375,15 +346,7 @@ def create_keypair():
 
 
 def list_keypair():
-    listkey = ec2c.describe_key_pairs()
-    dckey = {}
-
-    for key in listkey["KeyPairs"]:
-        print(
-            "Key pair = {KeyName}, fingerprint = {KeyFingerprint}".format(
-                **key))
-        dckey[key["KeyName"]] = key["KeyFingerprint"]
-    return(dckey)
+    return(aws.list_keypair())
 
 # Delete a key pair
 
@@ -393,7 +356,7 @@ def delete_keypair():
     keyname = input("Enter the key pair name: ").strip()
 
     try:
-        ec2c.delete_key_pair(KeyName=keyname)
+        aws.ec2c.delete_key_pair(KeyName=keyname)
         print("\nThe key pair {} was deleted.".format(keyname))
     except boto3.exceptions.botocore.client.ClientError as e:
         print(e.response["Error"]["Message"].strip("\""))
@@ -405,7 +368,7 @@ def create_bucket():
     buckname = input("Enter the bucket name: ").strip()
 
     try:
-        newbuck = s3c.create_bucket(
+        newbuck = aws.s3c.create_bucket(
             Bucket=buckname,
             CreateBucketConfiguration={"LocationConstraint": region})
         print("\nBucket {Location} was created successfully.".format(
@@ -420,9 +383,17 @@ def create_bucket():
 
 def delete_bucket():
     buckname = input("Enter the bucket name: ").strip()
+    force = input("Delete all files in the bucket first? (y/n): ").strip()
+
+    if force.lower() == "y":
+        stats = empty_bucket(aws.s3c, buckname)
+        if stats["errors"] or not stats["complete"]:
+            print("Bucket {} was not emptied, so it was not deleted.".format(
+                buckname))
+            return
 
     try:
-        s3c.delete_bucket(Bucket=buckname)
+        aws.s3c.delete_bucket(Bucket=buckname)
         print("Bucket {} was deleted successfully.".format(buckname))
     except boto3.exceptions.botocore.exceptions.ParamValidationError as e:
         print(e)
@@ -433,24 +404,52 @@ def delete_bucket():
 
 
 def list_buckets():
-    listbuck = s3r.buckets.all()
-    lb = []
-    print("\nList of buckets:")
-    for b in listbuck:
-        print(b.name)
-        lb.append(b.name)
-    print("\nNumber of buckets: {}".format(len(lb)))
-    return(lb)
+    return(aws.list_buckets())
 
 # List S3 files function
 
 
 def list_files():
-    listfile = s3r.buckets.all()
-    for buck in listfile:
-        for obj in buck.objects.all():
-            print("Bucket: {0}  File: {1}".format(buck.name, obj.key))
-    return(listfile)
+    return(aws.list_files())
+
+# Sync a local directory to an S3 bucket function
+
+
+def sync_dir():
+    localdir = input("Enter the local directory: ").strip()
+    buckname = input("Enter the bucket name: ").strip()
+    prefix = input(
+        "Enter the key prefix (Ex: site/, blank for none): ").strip()
+    delete = input("Delete keys with no local file? (y/n): ").strip()
+
+    if not os.path.isdir(localdir):
+        print("{} is not a directory".format(localdir))
+        return
+    sync(aws.s3c, localdir, buckname, prefix=prefix,
+         delete=delete.lower() == "y", partsize=aws.partsize,
+         partworkers=aws.xferworkers)
+
+# API call statistics function. Prints the calls, latency percentiles,
+# retries and response bytes of each operation this session, and can save
+# them as JSON or, for a file ending in .prom, Prometheus text.
+
+
+def call_stats():
+    aws.call_stats()
+    path = input("Export to file (blank for none): ").strip()
+    if path:
+        aws.export_stats("prom" if path.endswith(".prom") else "json", path)
+        print("Statistics saved to {}".format(path))
+
+# Inventory function. Lists the instances, subnets, ALBs, target groups and
+# key pairs of several regions at once.
+
+
+def inventory():
+    regions = input("Enter the regions, comma-separated ('all' for every "
+                    "region, blank for {}): ".format(
+                        ", ".join(aws.regions))).strip()
+    aws.list_regions(regions=regions or None)
 
 # Quit function
 
@@ -458,9 +457,292 @@ def list_files():
 def quit():
     sys.exit(0)
 
+# Command-line commands. Each one takes its arguments on the command line and
+# calls the Aws() method for it, with no listing and no prompts, so they can
+# be scripted. The arguments of a command are given as "name" (required),
+# "name+" (one or more), "name?" (optional), "--flag" (on/off) or "--name="
+# (option with a value). Each command returns None if it failed.
+#
+# The bulk instance commands resolve their names first, as one Name tag can
+# stand for several instances. They fail if a name matches nothing or if
+# AWS did not accept every instance found.
+
+
+def cli_bulk(call, ids, wait):
+    instids = []
+    missing = 0
+    for value in ids:
+        found = aws.resolve_all("instances", [value])
+        missing += not found
+        instids.extend(found)
+    instids = list(dict.fromkeys(instids))
+    done = call(instids, wait=wait) if instids else []
+    return(done if not missing and len(done) == len(instids) else None)
+
+
+# Snapshot commands. "snap" takes or refreshes a snapshot and fails if any
+# resource type could not be fetched. "sq" filters a table of a snapshot
+# with --where, then prints its rows, the number of rows per value of --by,
+# or the sum of --sum (per value of --by if given). Returns the number of
+# rows selected.
+
+
+def cli_snap(a):
+    done = take(aws, a.dir, a.kinds.split(",") if a.kinds else None,
+                float(a.max_age) if a.max_age else None)
+    return(None if done is None or "failed" in done.values() else done)
+
+
+def cli_query(a):
+    with Snapshot(a.dir) as snap:
+        try:
+            table = snap.table(a.kind)
+            if a.where:
+                table = table.where(**parse_where(table, a.where))
+            if a.sum and a.by:
+                fields = [a.by, a.sum]
+                rows = table.sum(a.sum, by=a.by).items()
+            elif a.sum:
+                fields = [a.sum]
+                rows = [(table.sum(a.sum),)]
+            elif a.by:
+                fields = [a.by, "Count"]
+                rows = table.count_by(a.by).items()
+            else:
+                fields = a.fields.split(",") if a.fields else table.fields
+                rows = table.records(fields)
+        except (KeyError, ValueError) as e:
+            print(e.args[0])
+            return(None)
+
+        text = "  ".join("{%s}" % f for f in fields)
+        with aws.listing(None, fields, text) as out:
+            for row in rows:
+                out.emit_row(row)
+            out.note("\n{} of {} rows".format(len(table), table.total))
+        return(len(table))
+
+
+# Stack spec commands. "plan" prints the operations that would make the stack
+# of a spec file match it, and "apply" runs them. Returns the list of
+# operations or the results of the steps run, or None if the spec is not
+# valid or a step failed.
+
+
+def cli_spec(path, apply):
+    try:
+        spec = Spec(aws, load_spec(path))
+    except (OSError, ValueError) as e:
+        print(e)
+        return(None)
+    ops = spec.plan()
+    return(spec.apply(ops) if apply else ops)
+
+
+commands = {
+    "csub": ("create a subnet, or the next free /NN block", ["cidr", "az"],
+             lambda a: aws.create_subnet(a.cidr, a.az)),
+    "dsub": ("delete subnets", ["subnet+"],
+             lambda a: all([aws.delete_subnet(s) for s in a.subnet]) or None),
+    "lsub": ("list the subnets, or those of one AZ", ["--az="],
+             lambda a: aws.list_subnets_az(a.az) if a.az
+             else aws.list_subnets_all()),
+    "imake": ("create an instance", ["subnet", "name", "--key="],
+              lambda a: aws.create_inst(a.subnet, a.key or mykey, a.name)),
+    "istart": ("start instances", ["instance+", "--wait"],
+               lambda a: cli_bulk(aws.start_insts, a.instance, a.wait)),
+    "istop": ("stop instances", ["instance+", "--wait"],
+              lambda a: cli_bulk(aws.stop_insts, a.instance, a.wait)),
+    "iterm": ("terminate instances", ["instance+", "--wait"],
+              lambda a: cli_bulk(aws.term_insts, a.instance, a.wait)),
+    "ilist": ("list the instances", [], lambda a: aws.list_inst()),
+    "iren": ("rename an instance", ["instance", "name"],
+             lambda a: aws.ren_inst(a.instance, a.name)),
+    "calb": ("create an ALB", ["name", "sub1", "sub2", "sub3", "tg"],
+             lambda a: aws.create_alb(a.name, a.sub1, a.sub2, a.sub3, a.tg)),
+    "lalb": ("list the ALBs", [], lambda a: aws.list_alb()),
+    "dalb": ("delete an ALB", ["name", "--wait"],
+             lambda a: aws.delete_alb(a.name, wait=a.wait)),
+    "ctg": ("create a target group", ["name", "inst1", "inst2", "inst3"],
+            lambda a: aws.create_target_group(
+                a.name, a.inst1, a.inst2, a.inst3)),
+    "ltg": ("list target groups", [],
+            lambda a: aws.list_target_groups() or {}),
+    "dtg": ("delete a target group", ["name"],
+            lambda a: aws.delete_target_group(a.name)),
+    "ckey": ("create a key pair", ["name"],
+             lambda a: aws.create_keypair(a.name)),
+    "lkey": ("list key pairs", [], lambda a: aws.list_keypair()),
+    "dkey": ("delete a key pair", ["name"],
+             lambda a: aws.delete_keypair(a.name)),
+    "cbuck": ("create an S3 bucket", ["name"],
+              lambda a: aws.create_bucket(a.name)),
+    "dbuck": ("delete an S3 bucket, emptying it first with --force",
+              ["name", "--force"],
+              lambda a: aws.delete_bucket(a.name, force=a.force)),
+    "lbuck": ("list the S3 buckets", [], lambda a: aws.list_buckets()),
+    "ls": ("list all S3 files", [], lambda a: aws.list_files()),
+    "put": ("upload a file to S3", ["path", "bucket", "key?"],
+            lambda a: aws.upload_file(a.path, a.bucket, a.key)),
+    "get": ("download a file from S3", ["bucket", "key", "path?"],
+            lambda a: aws.download_file(a.bucket, a.key, a.path)),
+    "sync": ("sync a directory to an S3 bucket",
+             ["dir", "bucket", "--prefix=", "--delete", "--dryrun"],
+             lambda a: aws.sync(a.dir, a.bucket, a.prefix or "",
+                                delete=a.delete, dryrun=a.dryrun)),
+    "inv": ("list resources across regions, 'all' or comma-separated",
+            ["--regions=", "--kinds="],
+            lambda a: aws.list_regions(
+                a.kinds.split(",") if a.kinds else None, a.regions)),
+    "snap": ("take or refresh an inventory snapshot in a directory",
+             ["dir", "--kinds=", "--max-age="], cli_snap),
+    "sq": ("query a table of a snapshot",
+           ["dir", "kind", "--where=", "--fields=", "--by=", "--sum="],
+           cli_query),
+    "plan": ("show the changes that would make a stack match its spec file",
+             ["spec"], lambda a: cli_spec(a.spec, False)),
+    "apply": ("make a stack match its spec file", ["spec"],
+              lambda a: cli_spec(a.spec, True)),
+    "stats": ("show the API call statistics", ["--export="],
+              lambda a: aws.export_stats(
+                  "prom" if a.export.endswith(".prom") else "json", a.export)
+              if a.export else aws.call_stats()),
+}
+
+# Instance commands whose lines in a batch file are merged into one bulk call
+
+BULK = {"istart": aws.start_insts, "istop": aws.stop_insts,
+        "iterm": aws.term_insts}
+
+# Build the command-line parser, with one subcommand per command.
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="awstool.py",
+        description="Run one command, run a batch file of commands with "
+        "--batch, or start the menu with no arguments.")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="run the commands in FILE, one per line")
+    parser.add_argument("--workers", type=int, default=16,
+                        help="commands a batch runs at the same time")
+    parser.add_argument("--output", choices=MODES,
+                        help="how listing commands print their records")
+    subs = parser.add_subparsers(dest="command", metavar="command")
+    for name, (text, args, func) in commands.items():
+        sub = subs.add_parser(name, help=text, description=text)
+        for arg in args:
+            if arg.endswith("="):
+                sub.add_argument(arg[:-1])
+            elif arg.startswith("--"):
+                sub.add_argument(arg, action="store_true")
+            elif arg[-1] in "+?":
+                sub.add_argument(arg[:-1], nargs=arg[-1])
+            else:
+                sub.add_argument(arg)
+    return(parser)
+
+# Read a batch file. Each line is a command with its arguments, as on the
+# command line. Blank lines and "#" comments are skipped, and a "wait" line
+# waits for every command above it to finish before going on. Returns the
+# list of steps, each a list of (line number, parsed arguments), or None if
+# any line is not a valid command.
+
+
+def read_batch(parser, path):
+    steps = [[]]
+    bad = 0
+    with open(path) as f:
+        for num, line in enumerate(f, 1):
+            words = shlex.split(line, comments=True)
+            if not words:
+                continue
+            if words == ["wait"]:
+                steps.append([])
+                continue
+            try:
+                args = parser.parse_args(words)
+            except SystemExit:
+                args = None
+            if args is None or not args.command or args.batch or \
+                    args.output:
+                print("Line {}: not a valid command: {}".format(
+                    num, line.strip()))
+                bad += 1
+                continue
+            steps[-1].append((num, args))
+    return(None if bad else [step for step in steps if step])
+
+# Run a batch file. Within each step, every istart, istop and iterm line is
+# merged into one bulk call per command (and --wait setting), and all the
+# calls run at the same time, "workers" at most. Returns the number of
+# commands that failed.
+
+
+def run_batch(parser, path, workers):
+    steps = read_batch(parser, path)
+    if steps is None:
+        return(1)
+    failed = 0
+    for step in steps:
+        tasks = []
+        bulk = {}
+        for num, args in step:
+            if args.command in BULK:
+                key = (args.command, args.wait)
+                bulk.setdefault(key, []).extend(args.instance)
+            else:
+                tasks.append(("line {}".format(num),
+                              commands[args.command][2], args))
+        seen = {}
+        for (command, wait), ids in bulk.items():
+            ids = list(dict.fromkeys(ids))
+            for instid in ids:
+                if seen.setdefault(instid, command) != command:
+                    print("Warning: {} is given to both {} and {} in the "
+                          "same step".format(instid, seen[instid], command))
+            tasks.append(("{} of {} instances".format(command, len(ids)),
+                          lambda a, c=command, i=ids, w=wait:
+                          cli_bulk(BULK[c], i, w), None))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(run_task, tasks)
+            for (what, func, args), (result, error) in zip(tasks, results):
+                if error is not None:
+                    print("Failed: {}: {}".format(what, error))
+                    failed += 1
+                elif result is None:
+                    print("Failed: {}".format(what))
+                    failed += 1
+    print("\nBatch done: {} commands failed".format(failed))
+    return(failed)
+
+
+# Run one task of a batch. An exception, such as a connection error or a bad
+# argument, only fails that task. Returns the result and the exception.
+
+
+def run_task(task):
+    what, func, args = task
+    try:
+        return(func(args), None)
+    except Exception as e:
+        return(None, e)
+
 
 if __name__ == "__main__":
 
+    # Command line and batch mode. With no arguments, the menu is started.
+
+    parser = build_parser()
+    args = parser.parse_args()
+    if args.output:
+        aws.output = Output(args.output)
+    if args.batch:
+        sys.exit(1 if run_batch(parser, args.batch, args.workers) else 0)
+    if args.command:
+        sys.exit(0 if commands[args.command][2](args) is not None else 1)
+
     # Using dict as switch for calling menu items
 
   ## CHB: nice use a dict to select your options!
@@ -487,6 +769,9 @@ if __name__ == "__main__":
                    "lbuck": list_buckets,
                    "dbuck": delete_bucket,
                    "ls": list_files,
+                   "sync": sync_dir,
+                   "inv": inventory,
+                   "stats": call_stats,
                    "help": help_menu,
                    "h": help_menu,
                    "x": quit,
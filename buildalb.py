@@ -6,72 +6,91 @@
 
 # Import modules
 
+import os
+import sys
 from awsclass import Aws
-import time
+from awsorch import TOKEN, Stack, Teardown
+
+# Journal of the build. If the build fails part way, running this script
+# again resumes it: the steps that finished are not run again, and the
+# resources they made are used as they are.
+
+JOURNAL = "buildalb.journal"
 
 # Instantiate the class
 
 casey = Aws()
 
+# Build the stack. Each step runs as soon as the steps it uses have finished,
+# so the subnets are created together and each instance starts as soon as its
+# subnet and the key pair exist.
+
+print("\n** Building stack **")
+stack = Stack(journal=JOURNAL)
+
 # Create an EC2 key pair
 
-print("\n** Creating key pair **")
-mykey = casey.create_keypair("webkey")
+key = stack.add("keypair", casey.create_keypair, "webkey")
 
-# Create the subnets where the EC2 instances will exist
+# Create the subnets where the EC2 instances will exist, each in the next
+# free /24 of the VPC
 
-print("\n** Creating subnets **")
-sub1 = casey.create_subnet("10.94.11.0/24", "us-west-2a")
-sub2 = casey.create_subnet("10.94.111.0/24", "us-west-2b")
-sub3 = casey.create_subnet("10.94.211.0/24", "us-west-2c")
+sub1 = stack.add("sub1", casey.create_subnet, "/24", casey.region + "a")
+sub2 = stack.add("sub2", casey.create_subnet, "/24", casey.region + "b")
+sub3 = stack.add("sub3", casey.create_subnet, "/24", casey.region + "c")
 
-# Create the EC2 instances using the created key pair and the subnets
+# Create the EC2 instances using the created key pair and the subnets. The
+# client token of each launch stays the same when the build is resumed, so an
+# instance whose launch was sent but not journaled is not launched twice.
 
-print("\n** Creating instances **")
-inst1 = casey.create_inst(sub1, mykey, "web-2a")
-inst2 = casey.create_inst(sub2, mykey, "web-2b")
-inst3 = casey.create_inst(sub3, mykey, "web-2c")
+inst1 = stack.add("inst1", casey.create_inst, sub1, key, "web-2a",
+                  token=TOKEN)
+inst2 = stack.add("inst2", casey.create_inst, sub2, key, "web-2b",
+                  token=TOKEN)
+inst3 = stack.add("inst3", casey.create_inst, sub3, key, "web-2c",
+                  token=TOKEN)
 
 # Create the ALB target group
 
-print("\n** Creating ALB target group **")
-tg = casey.create_target_group("web-tg", inst1, inst2, inst3)
+tg = stack.add("tg", casey.create_target_group, "web-tg", inst1, inst2, inst3)
 
 # Create the Application Load Balancer
 
-print("\n** Creating Application Load Balancer **")
-alb = casey.create_alb("web-alb", sub1, sub2, sub3, tg)
+alb = stack.add("alb", casey.create_alb, "web-alb", sub1, sub2, sub3, tg)
+
+built = stack.run()
+if stack.failed or stack.skipped:
+    print("\nThe build did not finish. Run this script again to resume it "
+          "from {}".format(JOURNAL))
+    sys.exit(1)
+mykey = built.get("keypair")
+sub1, sub2, sub3 = built.get("sub1"), built.get("sub2"), built.get("sub3")
+inst1, inst2, inst3 = (
+    built.get("inst1"), built.get("inst2"), built.get("inst3"))
 
 # Pause before deleting the infrastructure
 
 print("Now ready to delete the infrastructure")
 input("Press Enter to continue...")
 
-# Delete the Application Load Balancer
-
-print("\n** Deleting Application Load Balancer **")
-dalb = casey.delete_alb("web-alb")
-time.sleep(20)
-
-# Delete the ALB target group
-
-print("\n** Deleting ALB target group **")
-dtg = casey.delete_target_group("web-tg")
-
-# Terminate the EC2 instances
-
-print("\n** Terminating instances **")
-dinst1 = casey.term_inst(inst1)
-dinst2 = casey.term_inst(inst2)
-dinst3 = casey.term_inst(inst3)
-
-# Delete the subnets
-
-print("\n** Deleting subnets **")
-dsub1 = casey.delete_subnet(sub1)
-dsub2 = casey.delete_subnet(sub2)
-dsub3 = casey.delete_subnet(sub3)
-
-# Delete the EC2 key pair
-print("\n** Deleting keypair **")
-dkey = casey.delete_keypair(mykey)
+# Delete the infrastructure. The teardown finds everything that depends on
+# the load balancer and the subnets (listeners, target groups, instances and
+# network interfaces) and deletes it level by level in reverse dependency
+# order, with everything in one level deleted at the same time. The journal
+# is removed first, so running this script again after a teardown that did
+# not finish builds a new stack instead of resuming the deleted one.
+
+print("\n** Deleting stack **")
+if os.path.exists(JOURNAL):
+    os.remove(JOURNAL)
+teardown = Teardown(casey)
+teardown.discover(
+    albs=["web-alb"], tgs=["web-tg"],
+    instances=[i for i in (inst1, inst2, inst3) if i],
+    subnets=[s for s in (sub1, sub2, sub3) if s],
+    keypairs=[mykey] if mykey else [])
+teardown.run()
+
+# Print where the time went: calls, latency and retries of each API operation
+
+casey.call_stats()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+""" Tests for awscidr
+
+Run from the top of the repository with "python -m pytest tests".
+
+"""
+
+# Import modules
+
+import ipaddress
+import random
+import threading
+import unittest
+
+from awscidr import CidrAllocator
+
+
+def net(cidr):
+    return(ipaddress.ip_network(cidr))
+
+
+class AllocateTest(unittest.TestCase):
+    def test_packs_from_the_bottom(self):
+        cidrs = CidrAllocator(["10.0.0.0/16"])
+        self.assertEqual(cidrs.allocate(24), net("10.0.0.0/24"))
+        self.assertEqual(cidrs.allocate(24), net("10.0.1.0/24"))
+        self.assertEqual(cidrs.allocate(20), net("10.0.16.0/20"))
+        self.assertEqual(cidrs.allocate(24), net("10.0.2.0/24"))
+
+    def test_skips_used_blocks(self):
+        cidrs = CidrAllocator(["10.0.0.0/16"], {"10.0.0.0/24": "subnet-a",
+                                                "10.0.2.0/23": "subnet-b"})
+        self.assertEqual(cidrs.allocate(24), net("10.0.1.0/24"))
+        self.assertEqual(cidrs.allocate(23), net("10.0.4.0/23"))
+        self.assertEqual(cidrs.available(), 65536 - 256 * 6)
+
+    def test_ignores_used_blocks_of_other_vpcs(self):
+        cidrs = CidrAllocator(["10.0.0.0/24"], {"10.1.0.0/24": "subnet-a"})
+        self.assertEqual(cidrs.available(), 256)
+
+    def test_full(self):
+        cidrs = CidrAllocator(["10.0.0.0/24"])
+        self.assertEqual(cidrs.allocate(25), net("10.0.0.0/25"))
+        self.assertEqual(cidrs.allocate(25), net("10.0.0.128/25"))
+        self.assertIsNone(cidrs.allocate(28))
+        self.assertEqual(cidrs.available(), 0)
+
+    def test_too_large(self):
+        cidrs = CidrAllocator(["10.0.0.0/24"])
+        self.assertIsNone(cidrs.allocate(23))
+
+    def test_prefix_limits(self):
+        cidrs = CidrAllocator(["10.0.0.0/16"])
+        for prefix in (15, 29):
+            with self.assertRaises(ValueError):
+                cidrs.allocate(prefix)
+        self.assertEqual(cidrs.allocate(16), net("10.0.0.0/16"))
+
+    def test_several_vpc_blocks(self):
+        cidrs = CidrAllocator(["10.1.0.0/24", "10.0.0.0/25"])
+        self.assertEqual(cidrs.allocate(25), net("10.0.0.0/25"))
+        self.assertEqual(cidrs.allocate(24), net("10.1.0.0/24"))
+        self.assertIsNone(cidrs.allocate(28))
+
+    def test_unaligned_free_space(self):
+        # 10.0.0.64/26 in use leaves the /26 below it and the /25 above it
+        cidrs = CidrAllocator(["10.0.0.0/24"], {"10.0.0.64/26": None})
+        self.assertEqual(cidrs.allocate(25), net("10.0.0.128/25"))
+        self.assertEqual(cidrs.allocate(26), net("10.0.0.0/26"))
+        self.assertIsNone(cidrs.allocate(28))
+
+    def test_owners(self):
+        cidrs = CidrAllocator(["10.0.0.0/16"])
+        block = cidrs.allocate(24, "us-east-1a")
+        self.assertEqual(cidrs.owners["us-east-1a"], block)
+        cidrs.assign(block, "subnet-1")
+        self.assertEqual(cidrs.used[block], "subnet-1")
+        self.assertNotIn("us-east-1a", cidrs.owners)
+
+
+class ClaimTest(unittest.TestCase):
+    # The halves split off around the claimed block are the smallest free
+    # blocks, so they are used up first
+    def test_claim_splits_the_free_block(self):
+        cidrs = CidrAllocator(["10.0.0.0/16"])
+        self.assertEqual(cidrs.claim("10.0.5.0/24"), net("10.0.5.0/24"))
+        self.assertEqual(cidrs.available(), 65536 - 256)
+        blocks = [cidrs.allocate(24) for _ in range(6)]
+        self.assertEqual([str(b) for b in blocks], [
+            "10.0.4.0/24", "10.0.6.0/24", "10.0.7.0/24", "10.0.0.0/24",
+            "10.0.1.0/24", "10.0.2.0/24"])
+
+    def test_claim_used_block(self):
+        cidrs = CidrAllocator(["10.0.0.0/16"], {"10.0.0.0/24": "subnet-a"})
+        for cidr in ("10.0.0.0/24", "10.0.0.128/25", "10.0.0.0/23"):
+            with self.assertRaises(ValueError):
+                cidrs.claim(cidr)
+
+    def test_claim_outside_the_vpc(self):
+        cidrs = CidrAllocator(["10.0.0.0/16"])
+        with self.assertRaises(ValueError):
+            cidrs.claim("10.1.0.0/24")
+        with self.assertRaises(ValueError):
+            cidrs.claim("10.0.0.0/15")
+
+    def test_claim_twice(self):
+        cidrs = CidrAllocator(["10.0.0.0/16"])
+        cidrs.claim("10.0.8.0/21", "subnet-a")
+        with self.assertRaises(ValueError):
+            cidrs.claim("10.0.8.0/21")
+        self.assertEqual(cidrs.owners["subnet-a"], net("10.0.8.0/21"))
+
+
+class ReleaseTest(unittest.TestCase):
+    def test_release_merges_buddies(self):
+        cidrs = CidrAllocator(["10.0.0.0/16"])
+        blocks = [cidrs.allocate(24) for _ in range(4)]
+        for block in blocks:
+            self.assertEqual(cidrs.release(block), block)
+        self.assertEqual(cidrs.free, {(16, int(net("10.0.0.0/16")
+                                                .network_address))})
+        self.assertEqual(cidrs.allocate(16), net("10.0.0.0/16"))
+
+    def test_release_by_owner(self):
+        cidrs = CidrAllocator(["10.0.0.0/16"])
+        block = cidrs.allocate(24, "subnet-a")
+        self.assertEqual(cidrs.release("subnet-a"), block)
+        self.assertNotIn("subnet-a", cidrs.owners)
+        self.assertEqual(cidrs.available(), 65536)
+
+    def test_release_used_block(self):
+        cidrs = CidrAllocator(["10.0.0.0/24"], {"10.0.0.0/25": "subnet-a"})
+        self.assertEqual(cidrs.release("subnet-a"), net("10.0.0.0/25"))
+        self.assertEqual(cidrs.allocate(24), net("10.0.0.0/24"))
+
+    def test_release_unknown(self):
+        cidrs = CidrAllocator(["10.0.0.0/16"])
+        cidrs.allocate(24)
+        self.assertIsNone(cidrs.release("10.0.1.0/24"))
+        self.assertIsNone(cidrs.release("subnet-none"))
+        self.assertEqual(cidrs.available(), 65536 - 256)
+
+    def test_release_keeps_buddy_in_use(self):
+        cidrs = CidrAllocator(["10.0.0.0/24"])
+        low, high = cidrs.allocate(25), cidrs.allocate(25)
+        cidrs.release(low)
+        self.assertIsNone(cidrs.allocate(24))
+        self.assertEqual(cidrs.allocate(25), low)
+        self.assertNotEqual(low, high)
+
+    def test_release_does_not_merge_vpc_blocks(self):
+        cidrs = CidrAllocator(["10.0.0.0/17", "10.0.128.0/17"])
+        cidrs.release(cidrs.allocate(17))
+        self.assertIsNone(cidrs.allocate(16))
+        self.assertEqual(cidrs.allocate(17), net("10.0.0.0/17"))
+
+
+class StressTest(unittest.TestCase):
+    # Random allocations, claims and releases never overlap, stay in the
+    # VPC and account for every address
+    def test_random(self):
+        rand = random.Random(1)
+        vpcs = [net("10.0.0.0/18"), net("10.0.64.0/19")]
+        cidrs = CidrAllocator([str(v) for v in vpcs])
+        held = set()
+        for _ in range(3000):
+            action = rand.random()
+            if action < 0.45:
+                block = cidrs.allocate(rand.randint(20, 28))
+            elif action < 0.6:
+                vpc = rand.choice(vpcs)
+                prefix = rand.randint(22, 28)
+                start = int(vpc.network_address) + rand.randrange(
+                    0, vpc.num_addresses, 1 << (32 - prefix))
+                try:
+                    block = cidrs.claim(net((start, prefix)))
+                except ValueError:
+                    self.assertTrue(any(h.overlaps(net((start, prefix)))
+                                        for h in held))
+                    block = None
+            elif held:
+                block = rand.choice(sorted(held))
+                self.assertEqual(cidrs.release(block), block)
+                held.remove(block)
+                block = None
+            else:
+                block = None
+            if block is not None:
+                self.assertTrue(any(block.subnet_of(v) for v in vpcs))
+                self.assertFalse(any(block.overlaps(h) for h in held))
+                held.add(block)
+            self.assertEqual(cidrs.available() + sum(
+                h.num_addresses for h in held),
+                sum(v.num_addresses for v in vpcs))
+
+    def test_threads(self):
+        cidrs = CidrAllocator(["10.0.0.0/16"])
+        blocks = []
+
+        def grab():
+            for _ in range(64):
+                blocks.append(cidrs.allocate(24))
+
+        threads = [threading.Thread(target=grab) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(blocks)), 256)
+        self.assertNotIn(None, blocks)
+        self.assertIsNone(cidrs.allocate(28))
+
+
+if __name__ == "__main__":
+    unittest.main()
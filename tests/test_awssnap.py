@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+""" Tests for awssnap
+
+Run from the top of the repository with "python -m pytest tests".
+
+"""
+
+# Import modules
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import awssnap
+from awssnap import Snapshot, Table, build, blocks, parse_where, write_table
+
+SUBNETS = [
+    ("subnet-1", "web-a", "10.0.0.0/24", "us-east-1a", 250, "vpc-1"),
+    ("subnet-2", "web-b", "10.0.1.0/24", "us-east-1b", 12, "vpc-1"),
+    ("subnet-3", "", "10.0.2.0/24", "us-east-1a", 3, "vpc-1"),
+    ("subnet-4", "db-a", "10.1.0.0/24", "us-east-1a", 100, None),
+]
+
+WHEN = datetime.datetime(2024, 5, 1, tzinfo=datetime.timezone.utc)
+
+OBJECTS = [
+    ("logs", "a.gz", 10, "e1", WHEN),
+    ("logs", "b.gz", 30, "e2", None),
+    ("data", "c.csv", 5, "e3", WHEN),
+]
+
+
+class SnapTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def table(self, kind, rows):
+        path = os.path.join(self.dir, kind + ".col")
+        columns = build(kind, rows)
+        self.assertEqual(write_table(path, kind, columns,
+                                     list(blocks(columns))), len(rows))
+        table = Table(path)
+        self.addCleanup(table.close)
+        return(table)
+
+
+class BuildTest(SnapTest):
+    def test_strings_are_stored_once(self):
+        columns = {name: (ctype, data, values) for name, ctype, data, values
+                   in build("subnets", SUBNETS)}
+        ctype, data, values = columns["AvailabilityZone"]
+        self.assertEqual(ctype, "str")
+        self.assertEqual(values, ["us-east-1a", "us-east-1b"])
+        self.assertEqual(data.tolist(), [0, 1, 0, 0])
+        self.assertEqual(columns["VpcId"][2], ["vpc-1", ""])
+        ctype, data, values = columns["AvailableIpAddressCount"]
+        self.assertEqual((ctype, data.tolist(), values),
+                         ("int", [250, 12, 3, 100], None))
+
+    def test_round_trip(self):
+        table = self.table("subnets", SUBNETS)
+        self.assertEqual(len(table), 4)
+        self.assertEqual(table.fields, [c for c, _ in
+                                        awssnap.SCHEMA["subnets"]])
+        self.assertEqual(list(table.records()), [
+            tuple(v if v is not None else "" for v in row)
+            for row in SUBNETS])
+        self.assertEqual(table.values("AvailableIpAddressCount"),
+                         [250, 12, 3, 100])
+
+    def test_times(self):
+        table = self.table("objects", OBJECTS)
+        self.assertEqual(table.values("LastModified"),
+                         [WHEN.timestamp(), 0.0, WHEN.timestamp()])
+
+    def test_not_a_table(self):
+        path = os.path.join(self.dir, "bad.col")
+        with open(path, "wb") as f:
+            f.write(b"NOTASNAPSHOT" * 2)
+        with self.assertRaises(ValueError):
+            Table(path)
+
+
+class QueryTest(SnapTest):
+    def setUp(self):
+        super().setUp()
+        self.subnets = self.table("subnets", SUBNETS)
+
+    def test_where_value(self):
+        rows = self.subnets.where(AvailabilityZone="us-east-1a")
+        self.assertEqual(rows.values("SubnetId"),
+                         ["subnet-1", "subnet-3", "subnet-4"])
+
+    def test_where_list_and_function(self):
+        rows = self.subnets.where(
+            SubnetId=["subnet-1", "subnet-2", "subnet-9"],
+            AvailableIpAddressCount=lambda n: n < 100)
+        self.assertEqual(rows.values("SubnetId"), ["subnet-2"])
+        rows = self.subnets.where(Name=lambda name: name.startswith("web"))
+        self.assertEqual(len(rows), 2)
+
+    def test_where_of_where(self):
+        rows = self.subnets.where(VpcId="vpc-1").where(
+            AvailabilityZone="us-east-1a")
+        self.assertEqual(rows.values("SubnetId"), ["subnet-1", "subnet-3"])
+
+    def test_where_nothing(self):
+        rows = self.subnets.where(AvailabilityZone="us-west-2a")
+        self.assertEqual(len(rows), 0)
+        self.assertEqual(rows.count_by("AvailabilityZone"), {})
+        self.assertEqual(rows.sum("AvailableIpAddressCount"), 0)
+        self.assertEqual(list(rows.records()), [])
+
+    def test_unknown_column(self):
+        with self.assertRaises(KeyError):
+            self.subnets.where(Nope=1)
+
+    def test_count_by(self):
+        self.assertEqual(self.subnets.count_by("AvailabilityZone"),
+                         {"us-east-1a": 3, "us-east-1b": 1})
+        rows = self.subnets.where(AvailableIpAddressCount=lambda n: n > 50)
+        self.assertEqual(rows.count_by("AvailabilityZone"),
+                         {"us-east-1a": 2})
+
+    def test_sum(self):
+        self.assertEqual(self.subnets.sum("AvailableIpAddressCount"), 365)
+        self.assertEqual(
+            self.subnets.sum("AvailableIpAddressCount", by="AvailabilityZone"),
+            {"us-east-1a": 353, "us-east-1b": 12})
+        rows = self.subnets.where(VpcId="vpc-1")
+        self.assertEqual(rows.sum("AvailableIpAddressCount"), 265)
+        self.assertEqual(rows.sum("AvailableIpAddressCount", by="Name"),
+                         {"web-a": 250, "web-b": 12, "": 3})
+
+    def test_records(self):
+        rows = self.subnets.where(AvailableIpAddressCount=12)
+        self.assertEqual(list(rows.records(["Name", "CidrBlock"])),
+                         [("web-b", "10.0.1.0/24")])
+
+    def test_parse_where(self):
+        conds = parse_where(self.subnets,
+                            "AvailabilityZone=us-east-1a,"
+                            "AvailableIpAddressCount < 100")
+        rows = self.subnets.where(**conds)
+        self.assertEqual(rows.values("SubnetId"), ["subnet-3"])
+        rows = self.subnets.where(**parse_where(self.subnets, "Name!=web-a"))
+        self.assertEqual(len(rows), 3)
+        for text in ("Nope=1", "AvailableIpAddressCount=lots", "Name"):
+            with self.assertRaises((KeyError, ValueError)):
+                parse_where(self.subnets, text)
+
+
+class EmptyTest(SnapTest):
+    def test_empty_table(self):
+        table = self.table("objects", [])
+        self.assertEqual(len(table), 0)
+        self.assertEqual(list(table.records()), [])
+        self.assertEqual(table.values("Key"), [])
+        self.assertEqual(table.values("Size"), [])
+        self.assertEqual(table.count_by("Bucket"), {})
+        self.assertEqual(table.sum("Size"), 0)
+        self.assertEqual(table.sum("Size", by="Bucket"), {})
+        self.assertEqual(len(table.where(Bucket="logs")), 0)
+
+    def test_empty_strings(self):
+        table = self.table("keypairs", [("key-1", ""), ("key-2", None)])
+        self.assertEqual(table.values("KeyFingerprint"), ["", ""])
+        self.assertEqual(table.count_by("KeyFingerprint"), {"": 2})
+
+
+# Stand-in for the parts of Aws() that take() uses for key pairs and
+# subnets
+
+class FakeEc2():
+    def describe_key_pairs(self):
+        pass
+
+
+class FakeAws():
+    def __init__(self):
+        self.keys = [{"KeyName": "key-1", "KeyFingerprint": "ab:cd"}]
+        self.ec2c = FakeEc2()
+
+    def describe(self, kind, call):
+        return({"KeyPairs": self.keys})
+
+    def describe_pages(self, kind, client, method):
+        yield({"Subnets": [dict(zip(
+            ["SubnetId", "Name", "CidrBlock", "AvailabilityZone",
+             "AvailableIpAddressCount", "VpcId"], row)) for row in SUBNETS]})
+
+
+class TakeTest(SnapTest):
+    def test_take_and_refresh(self):
+        aws = FakeAws()
+        kinds = ["keypairs", "subnets"]
+        self.assertEqual(awssnap.take(aws, self.dir, kinds),
+                         {"keypairs": "written", "subnets": "written"})
+        self.assertEqual(awssnap.take(aws, self.dir, kinds, max_age=3600),
+                         {"keypairs": "fresh", "subnets": "fresh"})
+        aws.keys.append({"KeyName": "key-2", "KeyFingerprint": "ef:01"})
+        self.assertEqual(awssnap.take(aws, self.dir, kinds),
+                         {"keypairs": "written", "subnets": "unchanged"})
+        with Snapshot(self.dir) as snap:
+            self.assertEqual(snap.table("keypairs").values("KeyName"),
+                             ["key-1", "key-2"])
+            self.assertEqual(snap.table("subnets").sum(
+                "AvailableIpAddressCount"), 365)
+            with self.assertRaises(KeyError):
+                snap.table("albs")
+
+    def test_take_nothing(self):
+        aws = FakeAws()
+        aws.keys = []
+        self.assertEqual(awssnap.take(aws, self.dir, ["keypairs"]),
+                         {"keypairs": "written"})
+        with Snapshot(self.dir) as snap:
+            self.assertEqual(len(snap.table("keypairs")), 0)
+
+    def test_unknown_kind(self):
+        self.assertIsNone(awssnap.take(FakeAws(), self.dir, ["nope"]))
+
+
+if __name__ == "__main__":
+    unittest.main()